@@ -0,0 +1,170 @@
+"""
+Compare the stream and datagram FEC transfer modes over a lossy link.
+
+The server, the client and a UDP relay that drops, delays and rate limits
+packets all run in this process, over loopback, so real aioquic congestion
+control and loss recovery are measured without network access.
+
+Usage: python -m benchmarks.lossy_transfer [--size BYTES] [--latency S] [--loss P ...]
+"""
+import argparse
+import asyncio
+import contextlib
+import functools
+import io
+import os
+import random
+import tempfile
+import time
+from typing import Optional, Tuple
+
+from aioquic.asyncio import serve
+
+from client.sinks import MemorySink
+from common import engine, peer_credentials
+from common.memory_transport import LinkProfile
+from server.images import MemoryImageSource
+
+MODES = ("stream", "datagram-fec")
+# Seconds a single transfer may take before it counts as failed
+TRANSFER_TIMEOUT = 300.0
+
+
+class LossyRelay(asyncio.DatagramProtocol):
+    """
+    Relays UDP packets between one client and the server, applying a
+    ``LinkProfile`` to each direction.
+
+    Args:
+        server_address (Tuple[str, int]): Where the server listens.
+        uplink (LinkProfile): Conditions from the client to the server.
+        downlink (LinkProfile): Conditions from the server to the client.
+        seed (Optional[int]): Seed for the loss and reordering decisions.
+    """
+
+    def __init__(
+        self,
+        server_address: Tuple[str, int],
+        uplink: LinkProfile,
+        downlink: LinkProfile,
+        seed: Optional[int] = None,
+    ):
+        self.server_address = server_address
+        self.uplink = uplink
+        self.downlink = downlink
+        self.rng = random.Random(seed)
+        self.client_address = None
+        self.transport = None
+        self.busy_until = {id(uplink): 0.0, id(downlink): 0.0}
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        if addr == self.server_address:
+            link, destination = self.downlink, self.client_address
+        else:
+            self.client_address = addr
+            link, destination = self.uplink, self.server_address
+        if destination is None or self.rng.random() < link.loss:
+            return
+
+        loop = asyncio.get_running_loop()
+        departure = loop.time()
+        if link.bandwidth is not None:
+            departure = max(departure, self.busy_until[id(link)])
+            departure += len(data) / link.bandwidth
+            self.busy_until[id(link)] = departure
+        arrival = departure + link.latency
+        if link.reorder and self.rng.random() < link.reorder:
+            arrival += link.reorder_delay
+        loop.call_at(arrival, self.transport.sendto, data, destination)
+
+
+async def transfer(
+    mode: str, image: bytes, cert_file: str, key_file: str, link: LinkProfile, seed: int
+) -> float:
+    """
+    Run one update session through a lossy relay.
+
+    Returns:
+        float: Seconds from connecting until the image was installed.
+    """
+    loop = asyncio.get_running_loop()
+    server = await serve(
+        "127.0.0.1",
+        0,
+        configuration=engine.build_server_quic_config(cert_file, key_file),
+        create_protocol=functools.partial(
+            engine.AsyncQuicServer,
+            scope={"image_source": MemoryImageSource(image, "9.0.0")},
+        ),
+    )
+    server_address = server._transport.get_extra_info("sockname")
+    relay_transport, _ = await loop.create_datagram_endpoint(
+        lambda: LossyRelay(server_address, LinkProfile(latency=link.latency), link, seed),
+        local_addr=("127.0.0.1", 0),
+    )
+    relay_port = relay_transport.get_extra_info("sockname")[1]
+
+    configuration = engine.build_client_quic_config(
+        cert_file, datagrams=mode == "datagram-fec"
+    )
+    configuration.server_name = peer_credentials.PEER_SERVER_NAME
+    sink = MemorySink()
+    try:
+        start = time.perf_counter()
+        scope = await asyncio.wait_for(
+            engine.run_client(
+                "127.0.0.1", relay_port, configuration, {"sink": sink, "transfer": mode}
+            ),
+            TRANSFER_TIMEOUT,
+        )
+        elapsed = time.perf_counter() - start
+    finally:
+        relay_transport.close()
+        server.close()
+    if not scope.get("installed") or sink.data != image:
+        raise RuntimeError(f"{mode} transfer did not install the image")
+    return elapsed
+
+
+async def main(args) -> None:
+    image = os.urandom(args.size)
+    with tempfile.TemporaryDirectory() as directory:
+        cert_file, key_file, _ = peer_credentials.load_or_create(directory)
+        print(f"{args.size} byte image, {2 * args.latency * 1000:g} ms round trip")
+        print(f"{'loss':>6} {'mode':>13} {'seconds':>8} {'kB/s':>8}")
+        for loss in args.loss:
+            link = LinkProfile(latency=args.latency, bandwidth=args.bandwidth, loss=loss)
+            for mode in MODES:
+                times = []
+                for seed in range(args.repeat):
+                    # The state machines report every segment
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        times.append(
+                            await transfer(mode, image, cert_file, key_file, link, seed)
+                        )
+                elapsed = sorted(times)[len(times) // 2]
+                print(
+                    f"{loss:>6.2f} {mode:>13} {elapsed:>8.2f}"
+                    f" {args.size / elapsed / 1000:>8.1f}"
+                )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--size", type=int, default=1_000_000, help="Image size in bytes")
+    parser.add_argument(
+        "--latency", type=float, default=0.075, help="One-way delay in seconds"
+    )
+    parser.add_argument(
+        "--bandwidth", type=float, default=None, help="Downlink bytes per second"
+    )
+    parser.add_argument(
+        "--loss", type=float, nargs="+", default=[0.0, 0.05, 0.1], help="Downlink loss"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Runs per setting; the median is shown"
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,75 @@
+"""
+Measure how many update sessions per second the in-memory transport runs.
+
+Runs complete sessions between the server and client state machines over
+ideal in-memory links, in both transfer modes, one at a time and many at
+once, and reports sessions per second.
+
+Usage: python -m benchmarks.memory_sessions [--sessions N] [--size BYTES] [--concurrency N ...]
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import time
+
+import common.pdu as pdu
+from client.sinks import MemorySink
+from common.memory_transport import run_session
+from server.images import MemoryImageSource
+
+MODES = (pdu.TRANSFER_STREAM, pdu.TRANSFER_DATAGRAM_FEC)
+
+
+async def sessions_per_second(
+    mode: str, image: bytes, sessions: int, concurrency: int
+) -> float:
+    """
+    Run ``sessions`` sessions, ``concurrency`` at a time.
+
+    Returns:
+        float: Completed sessions per second.
+    """
+    source = MemoryImageSource(image, "9.0.0")
+
+    async def session() -> None:
+        sink = MemorySink()
+        scope = await run_session(
+            {"image_source": source}, {"sink": sink, "transfer": mode}
+        )
+        if not scope.get("installed") or sink.data != image:
+            raise RuntimeError(f"{mode} session did not install the image")
+
+    start = time.perf_counter()
+    for done in range(0, sessions, concurrency):
+        await asyncio.gather(*(session() for _ in range(min(concurrency, sessions - done))))
+    return sessions / (time.perf_counter() - start)
+
+
+async def main(args) -> None:
+    image = os.urandom(args.size)
+    print(f"{args.sessions} sessions with a {args.size} byte image, in sessions/s")
+    print(f"{'concurrency':>11} " + " ".join(f"{mode:>13}" for mode in MODES))
+    for concurrency in args.concurrency:
+        rates = []
+        for mode in MODES:
+            # The state machines report every segment
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                rates.append(
+                    await sessions_per_second(mode, image, args.sessions, concurrency)
+                )
+        print(f"{concurrency:>11} " + " ".join(f"{rate:>13.0f}" for rate in rates))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--sessions", type=int, default=2000, help="Sessions per setting")
+    parser.add_argument("--size", type=int, default=20_000, help="Image size in bytes")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        nargs="+",
+        default=[1, 100],
+        help="Sessions run at once",
+    )
+    asyncio.run(main(parser.parse_args()))
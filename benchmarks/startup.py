@@ -0,0 +1,116 @@
+"""
+Measure how fast a freshly started client gets going.
+
+Starts a local server, then runs the client as a new process again and
+again, as a device would on boot, and reports the median import time, time
+to the first received byte and total time from the client's --timing line.
+Runs with a TLS session ticket cache show the gain of session resumption.
+
+Usage: python -m benchmarks.startup [--runs N] [-c CERT] [-k KEY]
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+# Seconds the server gets to start listening
+SERVER_STARTUP = 1.5
+# Seconds a client run may take
+CLIENT_TIMEOUT = 30.0
+
+TIMING = re.compile(
+    r"Imports (?P<imports>[\d.]+) ms, first byte (?P<first_byte>[\d.]+) ms, "
+    r"done (?P<done>[\d.]+) ms"
+)
+
+
+def run_client(args, port: int, directory: str, extra: List[str]) -> Dict[str, float]:
+    """
+    Run one client process and parse its --timing line.
+
+    Returns:
+        Dict[str, float]: Milliseconds for imports, first byte, done and the
+            whole process including interpreter startup.
+    """
+    command = [
+        sys.executable,
+        "rsu.py",
+        "client",
+        "-p",
+        str(port),
+        "-c",
+        args.cert_file,
+        "-o",
+        os.path.join(directory, "firmware.bin"),
+        "--timing",
+        *extra,
+    ]
+    start = time.perf_counter()
+    result = subprocess.run(
+        command, capture_output=True, text=True, timeout=CLIENT_TIMEOUT, check=True
+    )
+    process = (time.perf_counter() - start) * 1000
+    match = TIMING.search(result.stdout)
+    if match is None:
+        raise RuntimeError(f"No timing reported:\n{result.stdout}{result.stderr}")
+    timing = {name: float(value) for name, value in match.groupdict().items()}
+    timing["process"] = process
+    return timing
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--runs", type=int, default=10, help="Client runs per setting")
+    parser.add_argument("-p", "--port", type=int, default=4455, help="Server port")
+    parser.add_argument(
+        "-c", "--cert-file", default="./certs/quic_certificate.pem", help="Certificate file"
+    )
+    parser.add_argument(
+        "-k", "--key-file", default="./certs/quic_private_key.pem", help="Key file"
+    )
+    args = parser.parse_args()
+
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "rsu.py",
+            "server",
+            "-p",
+            str(args.port),
+            "-c",
+            args.cert_file,
+            "-k",
+            args.key_file,
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        time.sleep(SERVER_STARTUP)
+        with tempfile.TemporaryDirectory() as directory:
+            tickets = os.path.join(directory, "tickets.json")
+            # One run to obtain a session ticket
+            run_client(args, args.port, directory, ["--ticket-cache", tickets])
+
+            settings = {"full handshake": [], "resumed session": ["--ticket-cache", tickets]}
+            print(f"Median of {args.runs} runs, in ms")
+            print(f"{'':>16} {'imports':>8} {'1st byte':>8} {'done':>8} {'process':>8}")
+            for name, extra in settings.items():
+                runs = [run_client(args, args.port, directory, extra) for _ in range(args.runs)]
+                medians = [
+                    statistics.median(run[key] for run in runs)
+                    for key in ("imports", "first_byte", "done", "process")
+                ]
+                print(f"{name:>16} " + " ".join(f"{value:>8.1f}" for value in medians))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,19 @@
-from typing import Optional, Union
+import asyncio
+import hashlib
+from typing import Dict, Optional, Union
 
+import common.fec as fec
 import common.pdu as pdu
+from client.sinks import FileSink
 from client.version import ClientVer
-from common.data_processor import DataAssembler
+from common.custom_exceptions import ImageVerificationFailed
+from common.fec import BlockDecoder, ReedSolomon
 from common.quic import QuicStreamEvent
 
+DEFAULT_SAVE_PATH = "./client/firmware/firmware.bin"
+# Seconds without new symbols, after the server finished sending, before asking for repair
+REPAIR_DELAY = 0.1
+
 
 class ClientState:
     """Base class for client state"""
@@ -27,10 +36,38 @@ class IdleState(ClientState):
 
     async def _send_ver_exchange_request(self):
         # Create a new datagram for version exchange
+        options = {}
+        if self.client.scope.get("use_peers"):
+            options["use_peers"] = True
+        if self.client.scope.get("serve_peers"):
+            options["serve_peers"] = list(self.client.scope["serve_peers"])
+            options["peer_cert"] = self.client.scope["peer_cert"]
+        if self.client.scope.get("failed_peers"):
+            options["failed_peers"] = self.client.scope["failed_peers"]
+        if (
+            self.client.scope.get("transfer") == pdu.TRANSFER_DATAGRAM_FEC
+            and self.client.conn.receive_datagram is not None
+        ):
+            options["transfer"] = [pdu.TRANSFER_DATAGRAM_FEC]
+
+        # Offer to resume an interrupted transfer the sink kept
+        device_id = self.client.scope.get("device_id")
+        if device_id:
+            options["device_id"] = device_id
+            partial = getattr(self.client.sink, "partial", None)
+            held = partial() if partial is not None else None
+            if held is not None:
+                options["resume"] = {
+                    "sha256": held[0],
+                    "offset": held[1],
+                    "token": held[2],
+                }
+
         datagram = pdu.Datagram(
             mtype=pdu.MSG_TYPE_VERSION_EXCHANGE,
+            payload=pdu.encode_options(options),
             protocol_ver=ClientVer.protocol,
-            firmware_ver=ClientVer.firmware,
+            firmware_ver=self.client.scope.get("current_ver", ClientVer.firmware),
         )
 
         # Start a new stream and get its id
@@ -52,15 +89,64 @@ class RequestVersionExchangeState(ClientState):
         # Check if version are compatible
         dgram_in = pdu.Datagram.from_bytes(event.data)
         if dgram_in.mtype == pdu.MSG_TYPE_VERSION_ACK:
+            options = pdu.decode_options(dgram_in.payload)
+            image_hash = options.get("sha256")
+
+            # When fetching from a peer, only the origin's hash is trusted
+            expected_hash = self.client.scope.get("expected_sha256")
+            if expected_hash and image_hash != expected_hash:
+                raise ImageVerificationFailed("Peer offers a different image")
+            self.client.image_hash = expected_hash or image_hash
+            self.client.firmware_ver = dgram_in.firmware_ver
+
+            peers = options.get("peers")
+            if peers:
+                # Leave the transfer to the peers; the caller retries with them
+                print(f"Received {len(peers)} peer hint(s) from server")
+                self.client.scope["peer_hints"] = [tuple(peer) for peer in peers]
+                self.client.scope["expected_sha256"] = image_hash
+                self.client.set_state(IdleState(self.client))
+                return
+
+            size = self.client.image_size = options.get("size", 0)
+            self.client.transfer = options.get("transfer", pdu.TRANSFER_STREAM)
+            self.client.fec = options.get("fec")
+            if "resume" in options:
+                # The server already continues sending from the offset
+                self._resume(dgram_in.firmware_ver, image_hash, size, options["resume"])
+                return
+
+            if not self.client.sink.open(dgram_in.firmware_ver, image_hash, size):
+                print("Image already present, skipping transfer")
+                self.client.set_state(IdleState(self.client))
+                return
+            # Sinks that keep interrupted transfers keep the token to resume them
+            token = options.get("resume_token")
+            set_resume_token = getattr(self.client.sink, "set_resume_token", None)
+            if isinstance(token, str) and set_resume_token is not None:
+                set_resume_token(token)
+
             await self._firmware_request(event)
 
+    def _resume(self, firmware_ver, image_hash, size, offset):
+        digest = hashlib.sha256()
+        for data in self.client.sink.resume(firmware_ver, image_hash, size, offset):
+            digest.update(data)
+        self.client.digest = digest
+        print(f"Resuming transfer at byte {offset}")
+        self.client.set_state(ReceivingFirmwareState(self.client))
+
     async def _firmware_request(self, event):
         # Create a new datagram with a test message
         datagram = pdu.Datagram(mtype=pdu.MSG_TYPE_REQUEST_UPDATE, payload=b"")
 
-        # Create a QuicStreamEvent with the stream id and the datagram data in bytes
+        # Create a QuicStreamEvent with the stream id and the datagram data in bytes.
+        # The datagram transfer mode keeps the stream open for repair requests.
+        self.client.control_stream_id = event.stream_id
         qs = QuicStreamEvent(
-            stream_id=event.stream_id, data=datagram.to_bytes(), end_stream=True
+            stream_id=event.stream_id,
+            data=datagram.to_bytes(),
+            end_stream=self.client.transfer == pdu.TRANSFER_STREAM,
         )
         await self.client.conn.send(qs)
         print("Request for firmware sent")
@@ -71,11 +157,19 @@ class ReceivingFirmwareState(ClientState):
     """State for the client to receive firmware from the server."""
 
     async def handle_incoming_event(self, event: Optional[QuicStreamEvent]):
-        await self._receive_data()
-
-    async def _receive_data(self, save_path: str = "./client/firmware/firmware.bin"):
-        firmware_received = b""
-        assembler = DataAssembler()
+        try:
+            if self.client.transfer == pdu.TRANSFER_DATAGRAM_FEC:
+                await self._receive_data_fec()
+            else:
+                await self._receive_data()
+        except (ConnectionError, asyncio.TimeoutError, asyncio.CancelledError) as exc:
+            # The sink may keep what arrived, for a resumed transfer
+            self.client.sink.abort(exc)
+            raise
+
+    async def _receive_data(self):
+        sink = self.client.sink
+        digest = self.client.digest or hashlib.sha256()
 
         # Receive multiple segments of data from server
         while True:
@@ -83,29 +177,156 @@ class ReceivingFirmwareState(ClientState):
             self.client.set_state(ReceivingFirmwareState(self.client))
             dgram_in = pdu.Datagram.from_bytes(event.data)
 
-            assembler.add_segment(dgram_in.payload)
+            digest.update(dgram_in.payload)
+            sink.write(dgram_in.payload)
 
             if dgram_in.mtype == pdu.MSG_TYPE_FINISH_SND_DATA:
                 self.client.set_state(SendingAckState(self.client))
                 break
 
-        if dgram_in.mtype == pdu.MSG_TYPE_FINISH_SND_DATA:
-            print("Last segment received, sending ACK")
-            # Send ack
-            ack_datagram = pdu.Datagram(pdu.MSG_TYPE_SEND_ACK, b"All data received")
-            qs = QuicStreamEvent(
-                stream_id=event.stream_id, data=ack_datagram.to_bytes(), end_stream=True
-            )
-            await self.client.conn.send(qs)
-
-        # Save firmware as a binary file
-        firmware_received = assembler.assemble()
-        with open(save_path, "wb") as firmware_file:
-            firmware_file.write(firmware_received)
-            print(f"Firmware received and saved at {save_path}")
+        print("Last segment received")
+        await self._install(event.stream_id, digest)
+
+    async def _receive_data_fec(self):
+        digest = hashlib.sha256()
+        symbol_len = self.client.fec["symbol_len"]
+        code = ReedSolomon(self.client.fec["block_len"])
+        size = self.client.image_size
+
+        # The zero padding of the last block is never sent, add it up front
+        symbol_count = -(-size // symbol_len)
+        decoders = [BlockDecoder(code) for _ in range(-(-symbol_count // code.k))]
+        for index in range(symbol_count - (len(decoders) - 1) * code.k, code.k):
+            decoders[-1].add(index, bytes(symbol_len))
+        remaining = sum(1 for decoder in decoders if decoder.needed)
+        hashed = 0
+
+        # Collect symbols until every block decodes. Once the server is done
+        # sending and no more symbols arrive, ask for repair symbols.
+        stream_task = None
+        datagram_task = None
+        finished = False
+        try:
+            while remaining:
+                datagram_task = asyncio.ensure_future(self.client.conn.receive_datagram())
+                if stream_task is None:
+                    stream_task = asyncio.ensure_future(self.client.conn.receive())
+                done, _ = await asyncio.wait(
+                    {datagram_task, stream_task},
+                    timeout=REPAIR_DELAY if finished else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+
+                if datagram_task in done:
+                    data = datagram_task.result()
+                    block_num, index = fec.SYMBOL_HEADER.unpack_from(data)
+                    symbol = data[fec.SYMBOL_HEADER.size :]
+                    if block_num < len(decoders) and decoders[block_num].add(
+                        index, symbol
+                    ):
+                        remaining -= 1
+                        hashed = self._store_blocks(decoders, block_num, hashed, digest)
+                else:
+                    datagram_task.cancel()
+
+                if stream_task in done:
+                    dgram_in = pdu.Datagram.from_bytes(stream_task.result().data)
+                    finished = dgram_in.mtype == pdu.MSG_TYPE_FINISH_SND_DATA
+                    stream_task = None
+                elif finished and not done:
+                    await self._request_repair(decoders)
+                    finished = False
+        finally:
+            # Don't leave receives pending if the transfer ends early
+            for task in (datagram_task, stream_task):
+                if task is not None:
+                    task.cancel()
+
+        print("All FEC blocks decoded")
+        await self._install(self.client.control_stream_id, digest)
+
+    def _store_blocks(self, decoders, block_num, hashed, digest) -> int:
+        """
+        Write a decoded block and hash the decoded blocks following those
+        already hashed. Sinks with ``write_at`` get each block at its offset
+        as soon as it decodes, other sinks get the blocks in order.
+
+        Returns:
+            int: Number of blocks hashed so far.
+        """
+        sink = self.client.sink
+        write_at = getattr(sink, "write_at", None)
+        if write_at is not None:
+            for offset, segment in self._block_segments(decoders, block_num):
+                write_at(offset, segment)
+
+        while hashed < len(decoders) and decoders[hashed].data:
+            for _, segment in self._block_segments(decoders, hashed):
+                digest.update(segment)
+                if write_at is None:
+                    sink.write(segment)
+            decoders[hashed].data = []  # Release the symbols
+            hashed += 1
+        return hashed
+
+    def _block_segments(self, decoders, block_num):
+        # Offsets of the block's symbols in the image, without the padding
+        size = self.client.image_size
+        symbol_len = self.client.fec["symbol_len"]
+        offset = block_num * decoders[block_num].code.k * symbol_len
+        for symbol in decoders[block_num].data:
+            if offset >= size:
+                return
+            yield offset, symbol[: size - offset]
+            offset += symbol_len
+
+    async def _request_repair(self, decoders):
+        needed = {
+            str(block_num): decoder.needed
+            for block_num, decoder in enumerate(decoders)
+            if decoder.needed
+        }
+        print(f"Requesting repair symbols for {len(needed)} block(s)")
+        datagram = pdu.Datagram(
+            pdu.MSG_TYPE_REPAIR_REQUEST, pdu.encode_options({"blocks": needed})
+        )
+        qs = QuicStreamEvent(
+            stream_id=self.client.control_stream_id,
+            data=datagram.to_bytes(),
+            end_stream=False,
+        )
+        await self.client.conn.send(qs)
 
+    async def _install(self, stream_id: int, digest):
+        sink = self.client.sink
+
+        # Verify the image before installing it. The server hands out devices
+        # that acknowledged an image as peers, so only an installed image is
+        # acknowledged, and a corrupt one is reported as an error.
+        image_hash = digest.hexdigest()
+        if self.client.image_hash and image_hash != self.client.image_hash:
+            error = ImageVerificationFailed()
+            sink.abort(error)
+            print("Image does not match its hash, sending error")
+            await self._send_final(stream_id, pdu.MSG_TYPE_ERROR, error.message)
+            raise error
+
+        sink.commit()
+        self.client.scope["installed"] = True
+        self.client.scope["firmware_ver"] = self.client.firmware_ver
+        self.client.scope["image_sha256"] = image_hash
+
+        print("Image installed, sending ACK")
+        await self._send_final(stream_id, pdu.MSG_TYPE_SEND_ACK, "All data received")
         self.client.set_state(IdleState(self.client))
 
+    async def _send_final(self, stream_id: int, mtype: int, message: str):
+        datagram = pdu.Datagram(mtype, message.encode("utf-8"))
+        qs = QuicStreamEvent(
+            stream_id=stream_id, data=datagram.to_bytes(), end_stream=True
+        )
+        await self.client.conn.send(qs)
+
 
 class SendingAckState(ClientState):
     """
@@ -119,8 +340,19 @@ class SendingAckState(ClientState):
 class ClientContext:
     """Context for the client state machine."""
 
-    def __init__(self, conn):
+    def __init__(self, conn, scope: Optional[Dict] = None):
         self.conn = conn
+        self.scope = scope if scope is not None else {}
+        self.sink = self.scope.get("sink") or FileSink(
+            self.scope.get("save_path", DEFAULT_SAVE_PATH)
+        )
+        self.image_hash: Optional[str] = None
+        self.image_size: int = 0
+        self.firmware_ver: str = ""
+        self.transfer: str = pdu.TRANSFER_STREAM
+        self.fec: Optional[Dict] = None
+        self.control_stream_id: Optional[int] = None
+        self.digest = None
         self.state = IdleState(self)
 
     def set_state(self, state: ClientState):
@@ -3,7 +3,7 @@ import json
 from typing import Dict
 
 import common.pdu as pdu
-from client.dfa import ClientContext
+from client.dfa import ClientContext, ReceivingFirmwareState
 from common.data_processor import DataAssembler
 from common.quic import QuicConnection, QuicStreamEvent
 
@@ -19,7 +19,7 @@ async def run(scope: Dict, conn: QuicConnection):
     Returns: None
     """
 
-    client: ClientContext = ClientContext(conn=conn)
+    client: ClientContext = ClientContext(conn=conn, scope=scope)
     # Start client and send version exchange
     await client.handle_incoming_event(event=None)
 
@@ -27,5 +27,9 @@ async def run(scope: Dict, conn: QuicConnection):
     event_ver_ack = await conn.receive()
     await client.handle_incoming_event(event=event_ver_ack)
 
+    # The server pointed us at peers instead of sending the image itself
+    if not isinstance(client.state, ReceivingFirmwareState):
+        return
+
     # Receive the firmware update and send the firmware update acknowledgment
     await client.handle_incoming_event(event=None)
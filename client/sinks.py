@@ -0,0 +1,264 @@
+import json
+import os
+from typing import Iterator, Optional, Tuple
+
+from common.custom_exceptions import ImageVerificationFailed
+from common.data_processor import DataAssembler
+
+
+class FileSink:
+    """
+    Assembles the received image in memory and writes it to a file once verified.
+
+    A sink receives the image while ``ReceivingFirmwareState`` downloads it:
+    ``open`` when the server announces the image, ``write`` for every segment
+    in order, then ``commit`` after the hash was verified or ``abort`` with
+    the error that stopped the transfer. ``open`` returns False if the sink
+    already holds the image, in which case the transfer is skipped.
+
+    Args:
+        path (str): Where to install the received firmware.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.assembler: Optional[DataAssembler] = None
+
+    def open(self, firmware_ver: str, image_hash: Optional[str], size: int) -> bool:
+        self.assembler = DataAssembler()
+        return True
+
+    def write(self, data: bytes) -> None:
+        self.assembler.add_segment(data)
+
+    def commit(self) -> None:
+        firmware_received = self.assembler.assemble()
+        with open(self.path, "wb") as firmware_file:
+            firmware_file.write(firmware_received)
+            print(f"Firmware received and saved at {self.path}")
+        self.assembler = None
+
+    def abort(self, error: Optional[BaseException] = None) -> None:
+        self.assembler = None
+
+
+class MemorySink:
+    """
+    Keeps the received image in memory, e.g. for simulated sessions.
+
+    See ``FileSink`` for the sink interface. The installed image is available
+    as ``data`` after ``commit``.
+    """
+
+    def __init__(self):
+        self.buffer: Optional[bytearray] = None
+        self.data: Optional[bytes] = None
+
+    def open(self, firmware_ver: str, image_hash: Optional[str], size: int) -> bool:
+        self.buffer = bytearray()
+        return True
+
+    def write(self, data: bytes) -> None:
+        self.buffer += data
+
+    def commit(self) -> None:
+        self.data = bytes(self.buffer)
+        self.buffer = None
+
+    def abort(self, error: Optional[BaseException] = None) -> None:
+        self.buffer = None
+
+
+class SlotSink:
+    """
+    Installs images A/B style: the image is written straight into the
+    inactive slot file, and the active slot pointer switches after the image
+    was verified.
+
+    Besides the sink interface of ``FileSink``, ``write_at`` writes data at
+    its offset in the image, so segments can land in any order. The pointer
+    file names the active slot and the image it holds. It is replaced
+    atomically, so after a crash either the old or the new slot is active.
+
+    If a transfer is cut off, ``abort`` keeps what was written to the
+    inactive slot and records it in a ``partial`` file, together with the
+    resume token the server handed out for the transfer. ``partial`` reports
+    it to the server, and ``resume`` continues the transfer where it stopped.
+
+    Args:
+        slot_dir (str): Directory holding ``slot_a.bin``, ``slot_b.bin`` and
+            the ``active`` pointer.
+    """
+
+    SLOTS = ("a", "b")
+
+    def __init__(self, slot_dir: str):
+        self.slot_dir = slot_dir
+        self.active: Optional[dict] = None
+        self._file = None
+        self._slot: Optional[str] = None
+        self._pending: Optional[dict] = None
+        self._offset = 0
+        self._written = 0
+        os.makedirs(slot_dir, exist_ok=True)
+        self._load_pointer()
+
+    def _pointer_path(self) -> str:
+        return os.path.join(self.slot_dir, "active")
+
+    def _partial_path(self) -> str:
+        return os.path.join(self.slot_dir, "partial")
+
+    def slot_path(self, slot: str) -> str:
+        return os.path.join(self.slot_dir, f"slot_{slot}.bin")
+
+    def _load_pointer(self) -> None:
+        try:
+            with open(self._pointer_path()) as f:
+                self.active = json.load(f)
+        except (OSError, ValueError):
+            self.active = None
+
+    @property
+    def path(self) -> Optional[str]:
+        """Path of the active slot, or None if nothing was installed yet."""
+        return self.slot_path(self.active["slot"]) if self.active else None
+
+    @property
+    def firmware_ver(self) -> Optional[str]:
+        """Firmware version in the active slot, or None if nothing was installed yet."""
+        return self.active["firmware_ver"] if self.active else None
+
+    def open(self, firmware_ver: str, image_hash: Optional[str], size: int) -> bool:
+        if self.active and image_hash and self.active["sha256"] == image_hash:
+            return False
+
+        self._slot = next(slot for slot in self.SLOTS if slot != self._active_slot())
+        self._pending = {"firmware_ver": firmware_ver, "sha256": image_hash}
+        self._file = open(self.slot_path(self._slot), "wb")
+        self._file.truncate(size)
+        self._offset = 0
+        self._written = 0
+        self._drop_partial()
+        return True
+
+    def set_resume_token(self, token: str) -> None:
+        """
+        Remember the server's resume token for the transfer being written.
+        """
+        self._pending["resume_token"] = token
+
+    def partial(self) -> Optional[Tuple[str, int, Optional[str]]]:
+        """
+        Get the interrupted transfer held in the inactive slot.
+
+        Returns:
+            Optional[Tuple[str, int, Optional[str]]]: Hash of the image, the
+                number of bytes held from its start and the resume token, or
+                None.
+        """
+        try:
+            with open(self._partial_path()) as f:
+                partial = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self.active and partial["slot"] == self.active["slot"]:
+            return None
+        return partial["sha256"], partial["offset"], partial.get("resume_token")
+
+    def resume(
+        self, firmware_ver: str, image_hash: Optional[str], size: int, offset: int
+    ) -> Iterator[bytes]:
+        """
+        Continue an interrupted transfer at ``offset``.
+
+        Yields the bytes already held, up to ``offset``, so the caller can
+        hash them before the rest of the image arrives.
+        """
+        partial = self.partial()
+        if partial is None or partial[0] != image_hash or partial[1] < offset:
+            raise ValueError("No partial image to resume")
+
+        # The token stays valid in case the transfer is cut off again
+        self._slot = next(slot for slot in self.SLOTS if slot != self._active_slot())
+        self._pending = {
+            "firmware_ver": firmware_ver,
+            "sha256": image_hash,
+            "resume_token": partial[2],
+        }
+        self._file = open(self.slot_path(self._slot), "r+b")
+        self._file.truncate(size)
+        self._offset = self._written = offset
+        self._drop_partial()
+
+        remaining = offset
+        while remaining:
+            data = self._file.read(min(remaining, 64 * 1024))
+            if not data:
+                raise ValueError("Partial image is shorter than recorded")
+            remaining -= len(data)
+            yield data
+
+    def _active_slot(self) -> str:
+        return self.active["slot"] if self.active else self.SLOTS[1]
+
+    def _drop_partial(self) -> None:
+        try:
+            os.remove(self._partial_path())
+        except FileNotFoundError:
+            pass
+
+    def write(self, data: bytes) -> None:
+        self.write_at(self._offset, data)
+
+    def write_at(self, offset: int, data: bytes) -> None:
+        self._file.seek(offset)
+        self._file.write(data)
+        self._offset = offset + len(data)
+        if offset <= self._written:
+            # Only the contiguous prefix is worth resuming from
+            self._written = max(self._written, self._offset)
+
+    def commit(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+        active = dict(self._pending, slot=self._slot)
+        tmp_path = self._pointer_path() + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(active, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._pointer_path())
+        if hasattr(os, "O_DIRECTORY"):
+            # Make the switch itself durable
+            dir_fd = os.open(self.slot_dir, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        self.active = active
+        print(f"Firmware installed in slot {self._slot.upper()} at {self.path}")
+
+    def abort(self, error: Optional[BaseException] = None) -> None:
+        # The inactive slot is simply overwritten by the next transfer, unless
+        # the transfer was cut off and what arrived can be resumed
+        if self._file is None:
+            return
+        keep = self._written and not isinstance(error, ImageVerificationFailed)
+        if keep:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+        if not keep:
+            return
+
+        partial = dict(self._pending, slot=self._slot, offset=self._written)
+        tmp_path = self._partial_path() + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(partial, f)
+        os.replace(tmp_path, self._partial_path())
+        print(f"Kept {self._written} bytes in slot {self._slot.upper()} to resume")
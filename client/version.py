@@ -1,3 +1,3 @@
 class ClientVer:
     firmware = "1.0.0"
-    protocol = "2.0.0"
+    protocol = "3.0.0"
@@ -8,3 +8,15 @@ class IncompatibleFirmwareVersion(Exception):
     def __init__(self, message="Server does not have latest firmware version"):
         self.message = message
         super().__init__(self.message)
+
+
+class ImageVerificationFailed(Exception):
+    def __init__(self, message="Received firmware image does not match its hash"):
+        self.message = message
+        super().__init__(self.message)
+
+
+class RepairLimitExceeded(Exception):
+    def __init__(self, message="Device asked for more FEC repair than a transfer may send"):
+        self.message = message
+        super().__init__(self.message)
@@ -1,5 +1,26 @@
-import base64
-from typing import Dict, Tuple
+import functools
+import hashlib
+import os
+from typing import Tuple
+
+
+def image_digest(path: str) -> str:
+    """
+    SHA-256 hex digest of a firmware image.
+
+    The digest is cached until the file's size or modification time changes.
+    """
+    stat = os.stat(path)
+    return _cached_digest(path, stat.st_size, stat.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=16)
+def _cached_digest(path: str, size: int, mtime_ns: int) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(65536), b""):
+            digest.update(block)
+    return digest.hexdigest()
 
 
 class DataSegmenter:
@@ -8,7 +29,7 @@ class DataSegmenter:
         self.data_path = data_path
         self.segment_len = segment_len
         self.data: bytes = b""
-        self.segments: Tuple[int, bytes] = ()
+        self.segments: Tuple[Tuple[int, memoryview], ...] = ()
         self._load_data()
         self._segment_data()
 
@@ -17,28 +38,25 @@ class DataSegmenter:
             self.data = f.read()
 
     def _segment_data(self):
-        self._load_data()
-        segment_num = 0
-        for i in range(0, len(self.data), self.segment_len):
-            self.segments += ((segment_num, self.data[i : i + self.segment_len]),)
-            segment_num += 1
-
-    def get_segments(self) -> Tuple[int, bytes]:
+        # Segments are views into the loaded image, so no bytes are copied
+        view = memoryview(self.data)
+        self.segments = tuple(
+            (segment_num, view[i : i + self.segment_len])
+            for segment_num, i in enumerate(range(0, len(self.data), self.segment_len))
+        )
+
+    def get_segments(self) -> Tuple[Tuple[int, memoryview], ...]:
         print("Data segmented successfully")
         return self.segments
 
 
 class DataAssembler:
     def __init__(self) -> None:
-        self.data: bytes = b""
-        self.segments: list[bytes] = []
+        self.data: bytearray = bytearray()
 
-    def add_segment(self, segment: str) -> None:
-        segment_byte = base64.b64decode(segment)
-        self.segments.append(segment_byte)
+    def add_segment(self, segment: bytes) -> None:
+        self.data += segment
 
     def assemble(self):
-        for segment in self.segments:
-            self.data += segment
         print("Data assembled successfully")
         return self.data
@@ -1,17 +1,46 @@
 import asyncio
+import base64
+import dataclasses
+import datetime
+import functools
 import json
-from typing import Callable, Dict, Optional
+import os
+import signal
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
 
-from aioquic.asyncio import connect, serve
+from aioquic.asyncio.client import connect
 from aioquic.asyncio.protocol import QuicConnectionProtocol
 from aioquic.quic.configuration import QuicConfiguration
-from aioquic.quic.events import StreamDataReceived
-from aioquic.tls import SessionTicket
-
-import client.entry as client_entry
-import server.entry as server_entry
+from aioquic.quic.events import (
+    ConnectionTerminated,
+    DatagramFrameReceived,
+    HandshakeCompleted,
+    StreamDataReceived,
+    StreamReset,
+)
+from aioquic.tls import CipherSuite, SessionTicket
+
+from common.custom_exceptions import ImageVerificationFailed
+from common.flow_control import (
+    DEFAULT_CONNECTION_BUDGET,
+    DEFAULT_SEND_BUFFER,
+    DEFAULT_STREAM_WINDOW,
+    ReceiveBudget,
+    check_aioquic,
+    send_buffered,
+)
+from common.pdu import DatagramFramer
+from common.peer_credentials import PEER_SERVER_NAME
 from common.quic import QuicConnection, QuicStreamEvent
 
+# The client and server state machines and the relay cache are imported where
+# they are used, so a device only loads the client side on startup.
+
+# Backpressure relies on aioquic internals, so refuse any release without them
+check_aioquic()
+
 # ALPN_PROTOCOL: A string representing the ALPN (Application-Layer Protocol Negotiation) protocol used by the QUIC connections.
 # SERVER_MODE: An integer constant representing the server mode.
 # CLIENT_MODE: An integer constant representing the client mode.
@@ -19,35 +48,72 @@ ALPN_PROTOCOL = "rsu-protocol"
 SERVER_MODE = 0
 CLIENT_MODE = 1
 
+# MAX_DATAGRAM_FRAME_SIZE: The largest QUIC DATAGRAM frame accepted, enabling the datagram transfer mode.
+# DATAGRAM_QUEUE_LEN: Received datagrams buffered per connection; further datagrams are dropped.
+MAX_DATAGRAM_FRAME_SIZE = 65536
+DATAGRAM_QUEUE_LEN = 1024
+
+# DEFAULT_SESSION_TIMEOUT: Seconds a handler may wait for the peer's next message before the connection is closed.
+DEFAULT_SESSION_TIMEOUT = 60.0
+
+# MAX_SESSION_TICKETS: Session tickets a server keeps for clients to resume TLS sessions with.
+MAX_SESSION_TICKETS = 4096
 
-def build_server_quic_config(cert_file, key_file) -> QuicConfiguration:
+# DEFAULT_CHECK_INTERVAL: Seconds between update checks of a client daemon.
+DEFAULT_CHECK_INTERVAL = 3600.0
+
+# PEER_IDLE_TIMEOUT: Seconds without packets after which a connection to a peer is given up, so offline peers fail fast.
+PEER_IDLE_TIMEOUT = 5.0
+
+# RELAY_FIRMWARE_VER: The firmware version a relay reports upstream, so the origin always offers its latest image.
+RELAY_FIRMWARE_VER = "0.0.0"
+
+
+def build_server_quic_config(
+    cert_file, key_file, stream_window: int = DEFAULT_STREAM_WINDOW
+) -> QuicConfiguration:
     """
     Build the QuicConfiguration for the server.
 
     Args:
         cert_file (str): The path to the certificate file.
         key_file (str): The path to the private key file.
+        stream_window (int): Flow control window of each receive stream.
 
     Returns:
         QuicConfiguration: The QuicConfiguration object.
     """
-    configuration = QuicConfiguration(alpn_protocols=[ALPN_PROTOCOL], is_client=False)
+    configuration = QuicConfiguration(
+        alpn_protocols=[ALPN_PROTOCOL],
+        is_client=False,
+        max_stream_data=stream_window,
+        max_datagram_frame_size=MAX_DATAGRAM_FRAME_SIZE,
+    )
     configuration.load_cert_chain(cert_file, key_file)
 
     return configuration
 
 
-def build_client_quic_config(cert_file=None):
+def build_client_quic_config(
+    cert_file=None, stream_window: int = DEFAULT_STREAM_WINDOW, datagrams: bool = False
+):
     """
     Build the QuicConfiguration for the client.
 
     Args:
         cert_file (str, optional): The path to the certificate file. Defaults to None.
+        stream_window (int): Flow control window of each receive stream.
+        datagrams (bool): Whether to accept QUIC DATAGRAM frames.
 
     Returns:
         QuicConfiguration: The QuicConfiguration object.
     """
-    configuration = QuicConfiguration(alpn_protocols=[ALPN_PROTOCOL], is_client=True)
+    configuration = QuicConfiguration(
+        alpn_protocols=[ALPN_PROTOCOL],
+        is_client=True,
+        max_stream_data=stream_window,
+        max_datagram_frame_size=MAX_DATAGRAM_FRAME_SIZE if datagrams else None,
+    )
     if cert_file:
         configuration.load_verify_locations(cert_file)
 
@@ -67,7 +133,12 @@ def create_msg_payload(msg) -> bytes:
     return json.dumps(msg).encode("utf-8")
 
 
-async def run_server(server: str, server_port: int, configuration: QuicConfiguration):
+async def run_server(
+    server: str,
+    server_port: int,
+    configuration: QuicConfiguration,
+    scope: Optional[Dict] = None,
+):
     """
     Run the QUIC server.
 
@@ -75,20 +146,30 @@ async def run_server(server: str, server_port: int, configuration: QuicConfigura
         server (str): The server address.
         server_port (int): The server port.
         configuration (QuicConfiguration): The server configuration.
+        scope (Optional[Dict]): Settings shared by every server connection.
     """
+    from aioquic.asyncio.server import serve
+
     print("[server] Server starting ...")
+    tickets = SessionTicketStore()
     await serve(
         host=server,
         port=server_port,
         configuration=configuration,
-        create_protocol=AsyncQuicServer,
-        session_ticket_fetcher=SessionTicketStore().pop,
-        session_ticket_handler=SessionTicketStore().add,
+        create_protocol=functools.partial(AsyncQuicServer, scope=scope or {}),
+        session_ticket_fetcher=tickets.pop,
+        session_ticket_handler=tickets.add,
     )
     await asyncio.Future()  # Runs the server indefinitely
 
 
-async def run_client(server, server_port, configuration):
+async def run_client(
+    server,
+    server_port,
+    configuration,
+    scope: Optional[Dict] = None,
+    tickets: Optional["SessionTicketCache"] = None,
+):
     """
     Run the QUIC client.
 
@@ -96,24 +177,233 @@ async def run_client(server, server_port, configuration):
         server (str): The server address.
         server_port (int): The server port.
         configuration (QuicConfiguration): The client configuration.
+        scope (Optional[Dict]): Settings for the client connection.
+        tickets (Optional[SessionTicketCache]): Session tickets for resuming
+            the TLS session of an earlier connection.
+
+    Returns:
+        Dict: The client scope, updated with the outcome of the update.
     """
     print("[client] Client starting ...")
+    ticket_handler = None
+    if tickets is not None:
+        configuration = dataclasses.replace(
+            configuration, session_ticket=tickets.get(server, server_port)
+        )
+        ticket_handler = functools.partial(tickets.add, server, server_port)
     async with connect(
         host=server,
         port=server_port,
         configuration=configuration,
-        create_protocol=AsyncQuicServer,
+        create_protocol=functools.partial(AsyncQuicServer, scope=scope or {}),
+        session_ticket_handler=ticket_handler,
     ) as client:
         await asyncio.ensure_future(client._client_handler.launch())
+        return client._client_handler.scope
+
+
+async def run_peer_assisted_client(
+    server,
+    server_port,
+    configuration,
+    scope: Dict,
+    tickets: Optional["SessionTicketCache"] = None,
+    peer_timeout: float = 30.0,
+):
+    """
+    Run the QUIC client, fetching the image from peers when the server hints at them.
+
+    Each hinted peer is tried in turn and the image is verified against the hash
+    the origin server announced. A peer is only trusted with the certificate the
+    origin handed out for it. If no peer delivers, the image is fetched from the
+    origin server, which is told which peers failed.
+
+    Args:
+        server (str): The origin server address.
+        server_port (int): The origin server port.
+        configuration (QuicConfiguration): The client configuration.
+        scope (Dict): Settings for the client connection.
+        tickets (Optional[SessionTicketCache]): Session tickets for resuming
+            TLS sessions with the origin server and peers.
+        peer_timeout (float): Time allowed for a transfer from a single peer.
+
+    Returns:
+        Dict: The client scope of the connection that installed the image.
+    """
+    scope = await run_client(server, server_port, configuration, dict(scope), tickets)
+    peer_hints: List[Tuple[str, int, str, str]] = scope.pop("peer_hints", [])
+
+    # Failed peers are reported by their hint tokens
+    failed = []
+    for peer_host, peer_port, peer_cert, token in peer_hints:
+        print(f"[client] Fetching image from peer {peer_host}:{peer_port}")
+        peer_configuration = dataclasses.replace(
+            configuration,
+            cadata=peer_cert.encode("ascii"),
+            cafile=None,
+            capath=None,
+            server_name=PEER_SERVER_NAME,
+            idle_timeout=PEER_IDLE_TIMEOUT,
+        )
+        peer_scope = dict(scope, use_peers=False)
+        try:
+            peer_scope = await asyncio.wait_for(
+                run_client(
+                    peer_host, peer_port, peer_configuration, peer_scope, tickets
+                ),
+                peer_timeout,
+            )
+        except (ConnectionError, OSError, asyncio.TimeoutError) as exc:
+            print(f"[client] Peer {peer_host}:{peer_port} unavailable: {exc!r}")
+            failed.append(token)
+            continue
+        except ImageVerificationFailed as exc:
+            print(f"[client] Peer {peer_host}:{peer_port} rejected: {exc}")
+            failed.append(token)
+            continue
+        if peer_scope.get("installed"):
+            return peer_scope
+
+    if scope.get("installed"):
+        return scope
+
+    # No peer delivered the image, fall back to the origin server
+    scope = dict(scope, use_peers=False, failed_peers=failed)
+    scope.pop("expected_sha256", None)
+    return await run_client(server, server_port, configuration, scope, tickets)
+
+
+async def run_client_daemon(
+    server,
+    server_port,
+    configuration,
+    scope: Dict,
+    interval: float = DEFAULT_CHECK_INTERVAL,
+    tickets: Optional["SessionTicketCache"] = None,
+    use_peers: bool = False,
+):
+    """
+    Check for updates every ``interval`` seconds from one long-running process.
+
+    The process stays warm between checks, and resumes the TLS session of the
+    previous check. On platforms with SIGUSR1, the signal triggers a check
+    right away.
+
+    Args:
+        server (str): The server address.
+        server_port (int): The server port.
+        configuration (QuicConfiguration): The client configuration.
+        scope (Dict): Settings for every client connection.
+        interval (float): Seconds between update checks.
+        tickets (Optional[SessionTicketCache]): Session tickets, kept in memory if None.
+        use_peers (bool): Whether to fetch images from peers the server hints at.
+    """
+    tickets = tickets or SessionTicketCache()
+    wake = asyncio.Event()
+    if hasattr(signal, "SIGUSR1"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, wake.set)
+
+    while True:
+        try:
+            if use_peers:
+                result = await run_peer_assisted_client(
+                    server, server_port, configuration, dict(scope), tickets
+                )
+            else:
+                result = await run_client(
+                    server, server_port, configuration, dict(scope), tickets
+                )
+        except (ConnectionError, OSError, asyncio.TimeoutError) as exc:
+            print(f"[client] Update check failed: {exc!r}")
+        except ImageVerificationFailed as exc:
+            print(f"[client] Update rejected: {exc}")
+        else:
+            # Report the installed version from now on
+            if result.get("installed"):
+                scope["current_ver"] = result["firmware_ver"]
+
+        try:
+            await asyncio.wait_for(wake.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        wake.clear()
+
+
+async def run_peer_server(host, port, configuration, client_scope: Dict):
+    """
+    Serve an installed image to peers.
+
+    Args:
+        host (str): The address to listen on.
+        port (int): The port to listen on.
+        configuration (QuicConfiguration): The server configuration.
+        client_scope (Dict): The scope of the client connection that installed the image.
+    """
+    from client.dfa import DEFAULT_SAVE_PATH
+
+    # Slot sinks know where they installed the image
+    firmware_path = getattr(client_scope.get("sink"), "path", None)
+    scope = {
+        "firmware_path": firmware_path
+        or client_scope.get("save_path", DEFAULT_SAVE_PATH),
+        "firmware_ver": client_scope["firmware_ver"],
+    }
+    await run_server(host, port, configuration, scope)
+
+
+async def run_relay(
+    server: str,
+    server_port: int,
+    server_configuration: QuicConfiguration,
+    origin: str,
+    origin_port: int,
+    client_configuration: QuicConfiguration,
+    cache_dir: str,
+    cache_size: int,
+    refresh: float = 60.0,
+):
+    """
+    Run a caching relay between devices and the origin server.
+
+    Devices connect to the relay as if it were the server. Images are fetched
+    from the origin through the regular client path, cached on disk, and
+    streamed to devices while the upstream transfer is still running.
+
+    Args:
+        server (str): The address to listen on for devices.
+        server_port (int): The port to listen on for devices.
+        server_configuration (QuicConfiguration): The downstream server configuration.
+        origin (str): The origin server address.
+        origin_port (int): The origin server port.
+        client_configuration (QuicConfiguration): The upstream client configuration.
+        cache_dir (str): Directory holding the cached images.
+        cache_size (int): Size limit for the cached images in bytes.
+        refresh (float): Seconds for which the latest image is reused without asking the origin.
+    """
+
+    from relay.cache import ImageCache
+
+    async def fetch(sink):
+        scope = {"sink": sink, "current_ver": RELAY_FIRMWARE_VER}
+        await run_client(origin, origin_port, client_configuration, scope)
+
+    cache = ImageCache(cache_dir, cache_size, fetch, refresh)
+    await run_server(server, server_port, server_configuration, {"image_source": cache})
 
 
 class SessionTicketStore:
     """
     Simple in-memory store for session tickets.
+
+    Holds at most ``max_tickets`` tickets, dropping the oldest ones first.
+
+    Args:
+        max_tickets (int): Number of tickets to keep.
     """
 
-    def __init__(self) -> None:
-        self.tickets: Dict[bytes, SessionTicket] = {}
+    def __init__(self, max_tickets: int = MAX_SESSION_TICKETS) -> None:
+        self.max_tickets = max_tickets
+        self.tickets: "OrderedDict[bytes, SessionTicket]" = OrderedDict()
 
     def add(self, ticket: SessionTicket) -> None:
         """
@@ -123,6 +413,8 @@ class SessionTicketStore:
             ticket (SessionTicket): The session ticket.
         """
         self.tickets[ticket.ticket] = ticket
+        while len(self.tickets) > self.max_tickets:
+            self.tickets.popitem(last=False)
 
     def pop(self, label: bytes) -> Optional[SessionTicket]:
         """
@@ -137,14 +429,130 @@ class SessionTicketStore:
         return self.tickets.pop(label, None)
 
 
+class SessionTicketCache:
+    """
+    Client-side store for the latest session ticket of each server.
+
+    With a ticket, the next connection resumes the TLS session, which skips
+    loading the CA certificates and verifying the server's certificate chain.
+    If ``path`` is given, tickets are also written there so they survive
+    restarts of the client. The file holds the ticket fields as JSON, so
+    reading it never runs code, and only the owner can read it, as it holds
+    the resumption secrets.
+
+    Args:
+        path (Optional[str]): File to keep the tickets in.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.tickets: Dict[str, SessionTicket] = {}
+        if path is not None:
+            self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.path) as f:
+                records = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(records, dict):
+            return
+        for key, record in records.items():
+            try:
+                self.tickets[key] = _ticket_from_record(record)
+            except (KeyError, TypeError, ValueError):
+                continue
+
+    def get(self, server: str, server_port: int) -> Optional[SessionTicket]:
+        """
+        Get a still valid ticket for a server.
+
+        Returns:
+            Optional[SessionTicket]: The session ticket, or None if not found.
+        """
+        ticket = self.tickets.get(f"{server}:{server_port}")
+        if ticket is None or not ticket.is_valid:
+            return None
+        return ticket
+
+    def add(self, server: str, server_port: int, ticket: SessionTicket) -> None:
+        """
+        Store the ticket a server issued.
+        """
+        self.tickets[f"{server}:{server_port}"] = ticket
+        if self.path is None:
+            return
+        records = {key: _ticket_record(ticket) for key, ticket in self.tickets.items()}
+        tmp_path = self.path + ".tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(records, f)
+        os.replace(tmp_path, self.path)
+
+
+def _ticket_record(ticket: SessionTicket) -> Dict:
+    # The fields of a session ticket as JSON values
+    return {
+        "age_add": ticket.age_add,
+        "cipher_suite": int(ticket.cipher_suite),
+        "not_valid_after": ticket.not_valid_after.isoformat(),
+        "not_valid_before": ticket.not_valid_before.isoformat(),
+        "resumption_secret": base64.b64encode(ticket.resumption_secret).decode("ascii"),
+        "server_name": ticket.server_name,
+        "ticket": base64.b64encode(ticket.ticket).decode("ascii"),
+        "max_early_data_size": ticket.max_early_data_size,
+        "other_extensions": [
+            [extension_type, base64.b64encode(data).decode("ascii")]
+            for extension_type, data in ticket.other_extensions
+        ],
+    }
+
+
+def _ticket_from_record(record: Dict) -> SessionTicket:
+    # Rebuild a session ticket, checking each field's type
+    max_early_data_size = record["max_early_data_size"]
+    if max_early_data_size is not None and not isinstance(max_early_data_size, int):
+        raise TypeError("max_early_data_size must be an integer")
+    if not isinstance(record["age_add"], int) or not isinstance(
+        record["server_name"], str
+    ):
+        raise TypeError("Malformed session ticket")
+    return SessionTicket(
+        age_add=record["age_add"],
+        cipher_suite=CipherSuite(record["cipher_suite"]),
+        not_valid_after=datetime.datetime.fromisoformat(record["not_valid_after"]),
+        not_valid_before=datetime.datetime.fromisoformat(record["not_valid_before"]),
+        resumption_secret=base64.b64decode(record["resumption_secret"], validate=True),
+        server_name=record["server_name"],
+        ticket=base64.b64decode(record["ticket"], validate=True),
+        max_early_data_size=max_early_data_size,
+        other_extensions=[
+            (int(extension_type), base64.b64decode(data, validate=True))
+            for extension_type, data in record["other_extensions"]
+        ],
+    )
+
+
 class AsyncQuicServer(QuicConnectionProtocol):
     """
     Asynchronous QUIC server implementation.
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, scope: Optional[Dict] = None, **kwargs):
         super().__init__(*args, **kwargs)
+        self._scope: Dict = scope if scope is not None else {}
+        self._tracer = self._scope.get("tracer")
+        self._trace = self._tracer.start_connection() if self._tracer else None
         self._handlers: Dict[int, ServerRequestHandler] = {}
+        self._budget = ReceiveBudget(
+            self._quic.configuration.max_stream_data,
+            self._scope.get("connection_budget", DEFAULT_CONNECTION_BUDGET),
+        )
+        self._budget.install(self._quic)
+        self._datagrams: asyncio.Queue[bytes] = asyncio.Queue(DATAGRAM_QUEUE_LEN)
+        self._transmitted = asyncio.Event()
+        self._terminated = False
         self._client_handler: Optional[ClientRequestHandler] = None
         self._is_client: bool = self._quic.configuration.is_client
         self._mode: int = SERVER_MODE if not self._is_client else CLIENT_MODE
@@ -160,20 +568,107 @@ class AsyncQuicServer(QuicConnectionProtocol):
                 authority=self._quic.configuration.server_name,
                 connection=self._quic,
                 protocol=self,
-                scope={},
+                scope=self._scope,
                 stream_ended=False,
                 stream_id=None,
                 transmit=self.transmit,
             )
 
-    def remove_handler(self, stream_id):
+    def transmit(self) -> None:
+        """
+        Send pending packets and wake up senders waiting for their datagrams to
+        leave or for their stream data to be acknowledged.
+        """
+        super().transmit()
+        self._transmitted.set()
+
+    def datagram_received(self, data, addr) -> None:
+        """
+        Process a received UDP datagram, attributing the work to the
+        connection's profile if it is profiled.
+        """
+        if self._trace is None:
+            super().datagram_received(data, addr)
+            return
+        with self._tracer.attribute(self._trace):
+            super().datagram_received(data, addr)
+
+    def _handle_timer(self) -> None:
+        # Loss recovery and idle timers are also the connection's work
+        if self._trace is None:
+            super()._handle_timer()
+            return
+        with self._tracer.attribute(self._trace):
+            super()._handle_timer()
+
+    def add_stream(self, stream_id: int, handler: "ServerRequestHandler") -> None:
         """
-        Remove a request handler for a specific stream ID.
+        Route a stream to a request handler, e.g. a stream the handler opened
+        and the peer answers on.
 
         Args:
             stream_id (int): The stream ID.
+            handler (ServerRequestHandler): The handler owning the stream.
+        """
+        if self._mode == SERVER_MODE and stream_id not in self._handlers:
+            self._handlers[stream_id] = handler
+
+    def remove_handler(self, stream_id):
+        """
+        Remove a request handler and every stream routed to it.
+
+        Args:
+            stream_id (int): The stream ID the handler was created for.
+        """
+        handler = self._handlers.get(stream_id)
+        for routed_id, routed in list(self._handlers.items()):
+            if routed is handler:
+                del self._handlers[routed_id]
+                self._budget.forget(routed_id)
+
+    def _launch_handler(self, handler: "ServerRequestHandler") -> None:
+        """
+        Run a request handler, removing it once it finishes.
+
+        Args:
+            handler (ServerRequestHandler): The handler to run.
         """
-        self._handlers.pop(stream_id)
+        coro = handler.launch()
+        if self._trace is not None:
+            coro = self._tracer.attributed(self._trace, coro)
+        handler.task = asyncio.ensure_future(coro)
+        handler.task.add_done_callback(
+            functools.partial(self._handler_finished, handler)
+        )
+
+    def _handler_finished(self, handler: "ServerRequestHandler", task: asyncio.Task):
+        """
+        Remove a finished request handler. If it failed, report why and close
+        the connection, so the peer does not wait for an answer.
+
+        Args:
+            handler (ServerRequestHandler): The finished handler.
+            task (asyncio.Task): The handler's task.
+        """
+        if self._handlers.get(handler.stream_id) is handler:
+            self.remove_handler(handler.stream_id)
+        if not task.cancelled() and task.exception() is not None:
+            exc = task.exception()
+            print(f"[server] Session on stream {handler.stream_id} failed: {exc!r}")
+            self._quic.close(reason_phrase=str(exc))
+            self.transmit()
+
+    def _connection_terminated(self):
+        """
+        Stop every request handler of a terminated connection.
+        """
+        for handler in set(self._handlers.values()):
+            handler.task.cancel()
+        for stream_id in list(self._handlers):
+            self._budget.forget(stream_id)
+        self._handlers.clear()
+        while not self._datagrams.empty():
+            self._datagrams.get_nowait()
 
     def _quic_client_event_dispatch(self, event):
         """
@@ -183,7 +678,13 @@ class AsyncQuicServer(QuicConnectionProtocol):
             event: The QUIC event.
         """
         if isinstance(event, StreamDataReceived):
+            if "first_byte_at" not in self._scope:
+                self._scope["first_byte_at"] = time.perf_counter()
             self._client_handler.quic_event_received(event)
+        elif isinstance(event, DatagramFrameReceived):
+            self._datagram_received(event)
+        elif isinstance(event, ConnectionTerminated):
+            self._client_handler.terminate(event.reason_phrase)
 
     def _quic_server_event_dispatch(self, event):
         """
@@ -200,18 +701,37 @@ class AsyncQuicServer(QuicConnectionProtocol):
                     authority=self._quic.configuration.server_name,
                     connection=self._quic,
                     protocol=self,
-                    scope={},
+                    scope=dict(self._scope, trace=self._trace),
                     stream_ended=False,
                     stream_id=event.stream_id,
                     transmit=self.transmit,
                 )
                 self._handlers[event.stream_id] = handler
                 handler.quic_event_received(event)
-                asyncio.ensure_future(handler.launch())
+                self._launch_handler(handler)
             # existing stream
             else:
                 handler = self._handlers[event.stream_id]
                 handler.quic_event_received(event)
+        elif isinstance(event, DatagramFrameReceived):
+            self._datagram_received(event)
+        elif isinstance(event, StreamReset):
+            handler = self._handlers.get(event.stream_id)
+            if handler is not None:
+                handler.task.cancel()
+                self.remove_handler(handler.stream_id)
+        elif isinstance(event, ConnectionTerminated):
+            self._connection_terminated()
+
+    def _datagram_received(self, event: DatagramFrameReceived):
+        """
+        Queue a received datagram, dropping it if the queue is full.
+
+        Args:
+            event (DatagramFrameReceived): The QUIC event.
+        """
+        if not self._datagrams.full():
+            self._datagrams.put_nowait(event.data)
 
     def quic_event_received(self, event):
         """
@@ -220,10 +740,35 @@ class AsyncQuicServer(QuicConnectionProtocol):
         Args:
             event: The QUIC event.
         """
+        if isinstance(event, ConnectionTerminated):
+            # Wakes senders waiting for the peer, once transmit runs
+            self._terminated = True
+        if self._trace is not None:
+            self._traced_event_dispatch(event)
+        elif self._mode == SERVER_MODE:
+            self._quic_server_event_dispatch(event)
+        else:
+            self._quic_client_event_dispatch(event)
+
+    def _traced_event_dispatch(self, event):
+        """
+        Dispatch a QUIC event and record it in the connection trace.
+
+        Args:
+            event: The QUIC event.
+        """
+        start = time.perf_counter()
         if self._mode == SERVER_MODE:
             self._quic_server_event_dispatch(event)
         else:
             self._quic_client_event_dispatch(event)
+        self._trace.record(type(event).__name__, start, len(getattr(event, "data", b"")))
+
+        if isinstance(event, HandshakeCompleted):
+            self._trace.record("handshake", self._trace.started)
+        elif isinstance(event, ConnectionTerminated):
+            self._tracer.finish_connection(self._trace)
+            self._trace = None
 
     def is_client(self) -> bool:
         """
@@ -255,9 +800,13 @@ class ServerRequestHandler:
         self.connection = connection
         self.protocol = protocol
         self.queue: asyncio.Queue[QuicStreamEvent] = asyncio.Queue()
+        self.framers: Dict[int, DatagramFramer] = {}
         self.scope = scope
         self.stream_id = stream_id
         self.transmit = transmit
+        self.trace = scope.get("trace")
+        self.task: Optional[asyncio.Task] = None
+        self.terminated_reason = ""
 
         if stream_ended:
             self.queue.put_nowait({"type": "quic.stream_end"})
@@ -269,9 +818,23 @@ class ServerRequestHandler:
         Args:
             event (StreamDataReceived): The QUIC event.
         """
-        self.queue.put_nowait(
-            QuicStreamEvent(event.stream_id, event.data, event.end_stream)
-        )
+        framer = self.framers.get(event.stream_id)
+        if framer is None:
+            framer = self.framers[event.stream_id] = DatagramFramer()
+
+        self.protocol._budget.received(event.stream_id, len(event.data))
+        try:
+            frames = framer.feed(event.data)
+        except ValueError as exc:
+            # The peer announced a datagram larger than any the protocol sends
+            print(f"Malformed data on stream {event.stream_id}: {exc}")
+            self.connection.close(reason_phrase=str(exc))
+            return
+        last = len(frames) - 1
+        for i, frame in enumerate(frames):
+            self.queue.put_nowait(
+                QuicStreamEvent(event.stream_id, frame, event.end_stream and i == last)
+            )
         # print("Event received: ", event.data.decode("utf-8"))
 
     async def receive(self) -> QuicStreamEvent:
@@ -281,9 +844,48 @@ class ServerRequestHandler:
         Returns:
             QuicStreamEvent: The QUIC stream event.
         """
-        queue_item = await self.queue.get()
+        start = time.perf_counter() if self.trace is not None else 0.0
+        if not self.queue.empty():
+            queue_item = self.queue.get_nowait()
+        else:
+            queue_item = await self._wait_for_message()
+        if queue_item is None:
+            raise ConnectionError(f"Connection terminated: {self.terminated_reason}")
+
+        # Hand out flow control credit only once the data has been consumed
+        if self.protocol._budget.consume(queue_item.stream_id, len(queue_item.data)):
+            self.transmit()
+
+        if self.trace is not None:
+            self.trace.record("receive", start, len(queue_item.data))
         return queue_item
 
+    async def _wait_for_message(self) -> Optional[QuicStreamEvent]:
+        """
+        Wait for the next message, closing the connection if the peer went idle.
+
+        Returns:
+            Optional[QuicStreamEvent]: The message, or None if the connection terminated.
+        """
+        timeout = self.scope.get("session_timeout", DEFAULT_SESSION_TIMEOUT)
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Session idle for {timeout:g}s, closing the connection")
+            self.connection.close(reason_phrase="Session idle")
+            self.transmit()
+            raise
+
+    def terminate(self, reason: str = "") -> None:
+        """
+        Wake up a pending receive after the connection terminated.
+
+        Args:
+            reason (str): The reason the peer gave for closing the connection.
+        """
+        self.terminated_reason = reason
+        self.queue.put_nowait(None)
+
     async def send(self, message: QuicStreamEvent) -> None:
         """
         Send a QUIC stream event.
@@ -291,6 +893,8 @@ class ServerRequestHandler:
         Args:
             message (QuicStreamEvent): The QUIC stream event to send.
         """
+        start = time.perf_counter() if self.trace is not None else 0.0
+        self.protocol.add_stream(message.stream_id, self)
         self.connection.send_stream_data(
             stream_id=message.stream_id,
             data=message.data,
@@ -298,6 +902,62 @@ class ServerRequestHandler:
         )
 
         self.transmit()
+        # Wait while the peer has not taken the stream's data, so a slow
+        # device does not make the sender buffer the rest of the image
+        limit = self.scope.get("send_buffer", DEFAULT_SEND_BUFFER)
+        while send_buffered(self.connection, message.stream_id) > limit:
+            if self.protocol._terminated:
+                raise ConnectionError("Connection terminated while sending")
+            self.protocol._transmitted.clear()
+            await self.protocol._transmitted.wait()
+        if self.trace is not None:
+            self.trace.record("send", start, len(message.data))
+
+    async def send_datagram(self, data: bytes) -> None:
+        """
+        Send an unreliable QUIC datagram.
+
+        Returns once the datagram was written into a packet, so senders are
+        paced by congestion control and stream data sent afterwards does not
+        overtake it.
+
+        Args:
+            data (bytes): The datagram. It is not copied, so it must not be reused.
+        """
+        self.connection.send_datagram_frame(data)
+        self.transmit()
+        while self.connection._datagrams_pending:
+            if self.protocol._terminated:
+                raise ConnectionError("Connection terminated while sending")
+            self.protocol._transmitted.clear()
+            await self.protocol._transmitted.wait()
+
+    async def receive_datagram(self) -> bytes:
+        """
+        Receive an unreliable QUIC datagram.
+
+        Returns:
+            bytes: The datagram.
+        """
+        return await self.protocol._datagrams.get()
+
+    def _connection(self, new_stream: Optional[Callable[[], int]]) -> QuicConnection:
+        """
+        Build the QuicConnection handed to the rsu state machines.
+
+        Args:
+            new_stream (Optional[Callable[[], int]]): Callable for creating a new stream.
+        """
+        if self.connection.configuration.max_datagram_frame_size is None:
+            return QuicConnection(self.send, self.receive, self.close, new_stream)
+        return QuicConnection(
+            self.send,
+            self.receive,
+            self.close,
+            new_stream,
+            send_datagram=self.send_datagram,
+            receive_datagram=self.receive_datagram,
+        )
 
     def close(self) -> None:
         """
@@ -310,7 +970,9 @@ class ServerRequestHandler:
         """
         Launch the rsu server.
         """
-        quic_conn = QuicConnection(self.send, self.receive, self.close, None)
+        import server.entry as server_entry
+
+        quic_conn = self._connection(None)
         await server_entry.run(self.scope, quic_conn)
 
 
@@ -335,7 +997,7 @@ class ClientRequestHandler(ServerRequestHandler):
         """
         Launch the rsu client.
         """
-        quic_conn = QuicConnection(
-            self.send, self.receive, self.close, self.get_next_stream_id
-        )
+        import client.entry as client_entry
+
+        quic_conn = self._connection(self.get_next_stream_id)
         await client_entry.run(self.scope, quic_conn)
@@ -0,0 +1,172 @@
+import struct
+from typing import Dict, List, Optional, Sequence
+
+# DEFAULT_BLOCK_LEN: Number of source symbols (image segments) per FEC block.
+# DEFAULT_REPAIR_LEN: Number of repair symbols sent up front for each block.
+# MAX_SYMBOLS: Source plus repair symbols a block can have.
+DEFAULT_BLOCK_LEN = 16
+DEFAULT_REPAIR_LEN = 4
+MAX_SYMBOLS = 256
+
+# Header of a symbol sent in a QUIC DATAGRAM frame: block number, symbol index.
+SYMBOL_HEADER = struct.Struct("!IB")
+
+# GF(256) arithmetic with the polynomial x^8 + x^4 + x^3 + x^2 + 1
+_EXP = [0] * 512
+_LOG = [0] * 256
+_value = 1
+for _power in range(255):
+    _EXP[_power] = _value
+    _LOG[_value] = _power
+    _value <<= 1
+    if _value & 0x100:
+        _value ^= 0x11D
+for _power in range(255, 512):
+    _EXP[_power] = _EXP[_power - 255]
+
+_MUL_TABLES: Dict[int, bytes] = {}
+
+
+def _mul(a: int, b: int) -> int:
+    if a == 0 or b == 0:
+        return 0
+    return _EXP[_LOG[a] + _LOG[b]]
+
+
+def _inv(a: int) -> int:
+    return _EXP[255 - _LOG[a]]
+
+
+def _mul_table(c: int) -> bytes:
+    table = _MUL_TABLES.get(c)
+    if table is None:
+        table = _MUL_TABLES[c] = bytes(_mul(c, x) for x in range(256))
+    return table
+
+
+def _combine(coefficients: Sequence[int], symbols: Sequence[bytes], length: int) -> bytes:
+    # Multiply each symbol by its coefficient with a translation table and sum
+    # (xor) the results as big integers, so the byte loops run in C.
+    acc = 0
+    for c, symbol in zip(coefficients, symbols):
+        if c == 1:
+            acc ^= int.from_bytes(symbol, "little")
+        elif c:
+            acc ^= int.from_bytes(symbol.translate(_mul_table(c)), "little")
+    return acc.to_bytes(length, "little")
+
+
+class ReedSolomon:
+    """
+    Systematic Reed-Solomon erasure code over GF(256).
+
+    A block holds ``k`` equally sized source symbols, indices ``0..k-1``.
+    Repair symbols have indices ``k..255`` and are rows of a Cauchy matrix,
+    so the source symbols can be rebuilt from any ``k`` distinct symbols.
+
+    Args:
+        k (int): Number of source symbols per block.
+    """
+
+    def __init__(self, k: int = DEFAULT_BLOCK_LEN):
+        if not 0 < k < MAX_SYMBOLS:
+            raise ValueError(f"Block length must be between 1 and {MAX_SYMBOLS - 1}")
+        self.k = k
+
+    def _row(self, index: int) -> List[int]:
+        if index < self.k:
+            return [int(j == index) for j in range(self.k)]
+        return [_inv(index ^ j) for j in range(self.k)]
+
+    def repair_symbol(self, symbols: Sequence[bytes], index: int) -> bytes:
+        """
+        Compute the repair symbol with the given index.
+
+        Args:
+            symbols (Sequence[bytes]): The ``k`` source symbols of the block.
+            index (int): Symbol index, from ``k`` to ``MAX_SYMBOLS - 1``.
+
+        Returns:
+            bytes: The repair symbol.
+        """
+        if not self.k <= index < MAX_SYMBOLS:
+            raise ValueError(f"Repair symbol index {index} out of range")
+        return _combine(self._row(index), symbols, len(symbols[0]))
+
+    def decode(self, received: Dict[int, bytes]) -> List[bytes]:
+        """
+        Rebuild the source symbols of a block.
+
+        Args:
+            received (Dict[int, bytes]): At least ``k`` symbols keyed by index.
+
+        Returns:
+            List[bytes]: The ``k`` source symbols.
+        """
+        if len(received) < self.k:
+            raise ValueError("Not enough symbols to decode the block")
+        missing = [j for j in range(self.k) if j not in received]
+        if not missing:
+            return [received[j] for j in range(self.k)]
+
+        # Sorting puts the received source symbols first, topped up with repair
+        indices = sorted(received)[: self.k]
+        length = len(received[indices[0]])
+        inverse = _invert([self._row(i) for i in indices])
+        symbols = [received[i] for i in indices]
+
+        decoded = {j: received[j] for j in range(self.k) if j in received}
+        for j in missing:
+            decoded[j] = _combine(inverse[j], symbols, length)
+        return [decoded[j] for j in range(self.k)]
+
+
+def _invert(matrix: List[List[int]]) -> List[List[int]]:
+    # Gauss-Jordan elimination over GF(256)
+    n = len(matrix)
+    rows = [row[:] + [int(i == j) for j in range(n)] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = next(r for r in range(col, n) if rows[r][col])
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        scale = _inv(rows[col][col])
+        rows[col] = [_mul(scale, x) for x in rows[col]]
+        for r in range(n):
+            factor = rows[r][col]
+            if r != col and factor:
+                rows[r] = [x ^ _mul(factor, y) for x, y in zip(rows[r], rows[col])]
+    return [row[n:] for row in rows]
+
+
+class BlockDecoder:
+    """
+    Collects the symbols of one block until it can be decoded.
+
+    Args:
+        code (ReedSolomon): The erasure code of the transfer.
+    """
+
+    def __init__(self, code: ReedSolomon):
+        self.code = code
+        self.received: Dict[int, bytes] = {}
+        self.data: Optional[List[bytes]] = None
+
+    @property
+    def needed(self) -> int:
+        """Number of further symbols needed to decode the block."""
+        return 0 if self.data is not None else self.code.k - len(self.received)
+
+    def add(self, index: int, symbol: bytes) -> bool:
+        """
+        Add a received symbol.
+
+        Returns:
+            bool: True if the block was decoded by this symbol.
+        """
+        if self.data is not None or index in self.received:
+            return False
+        self.received[index] = symbol
+        if len(self.received) < self.code.k:
+            return False
+        self.data = self.code.decode(self.received)
+        self.received = {}
+        return True
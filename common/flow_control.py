@@ -0,0 +1,174 @@
+import functools
+from typing import Dict
+
+import aioquic
+from aioquic.quic.connection import MAX_STREAM_DATA_FRAME_CAPACITY, QuicConnection
+from aioquic.quic.packet import QuicFrameType
+from aioquic.quic.stream import QuicStream, QuicStreamSender
+
+# DEFAULT_STREAM_WINDOW: Bytes a peer may send on a stream beyond what the application consumed.
+# DEFAULT_CONNECTION_BUDGET: Bytes a connection may hold in receive queues before credit is withheld.
+# DEFAULT_SEND_BUFFER: Bytes a stream may hold unacknowledged before the sender waits.
+DEFAULT_STREAM_WINDOW = 64 * 1024
+DEFAULT_CONNECTION_BUDGET = 1024 * 1024
+DEFAULT_SEND_BUFFER = 256 * 1024
+
+# AIOQUIC_VERSION: The aioquic release pinned in requirements.txt, whose internals are used here.
+AIOQUIC_VERSION = "1.0.0"
+
+# aioquic has no public API for either direction of backpressure, so these
+# internals are used, and checked for on startup:
+# - QuicConnection._write_stream_limits is replaced by a copy of aioquic 1.0's,
+#   called with the builder, packet space and stream.
+# - QuicConnection._on_max_stream_data_delivery is the delivery handler of its frames.
+# - QuicConnection._streams and QuicStreamSender._buffer_start/_buffer_stop
+#   give a stream's unacknowledged send buffer.
+# - QuicConnection._datagrams_pending holds datagrams not yet written to a packet.
+_CONNECTION_METHODS = ("_write_stream_limits", "_on_max_stream_data_delivery")
+_CONNECTION_ATTRIBUTES = ("_streams", "_datagrams_pending")
+_SENDER_ATTRIBUTES = ("_buffer_start", "_buffer_stop")
+
+
+class ReceiveBudget:
+    """
+    Grants QUIC flow control credit as the application consumes received data.
+
+    aioquic raises a stream's MAX_STREAM_DATA as soon as data arrives, so a fast
+    peer can fill the receive queues faster than they are drained. Once
+    installed on a connection, a stream's limit is instead raised to the bytes
+    consumed plus ``stream_window``, and only while the bytes buffered on the
+    whole connection stay below ``connection_budget``.
+
+    Args:
+        stream_window (int): Credit granted beyond the consumed bytes of a stream.
+        connection_budget (int): Buffered bytes above which no credit is granted.
+    """
+
+    def __init__(self, stream_window: int, connection_budget: int):
+        self.stream_window = stream_window
+        self.connection_budget = connection_budget
+        self.buffered = 0
+        self.queued: Dict[int, int] = {}
+        self.consumed: Dict[int, int] = {}
+        self.granted: Dict[int, int] = {}
+
+    def install(self, quic: QuicConnection) -> None:
+        """
+        Replace aioquic's stream credit policy on a connection.
+        """
+        quic._write_stream_limits = functools.partial(_write_stream_limits, quic, self)
+
+    def received(self, stream_id: int, nbytes: int) -> None:
+        """
+        Account for bytes put into a receive queue.
+        """
+        self.buffered += nbytes
+        self.queued[stream_id] = self.queued.get(stream_id, 0) + nbytes
+
+    def consume(self, stream_id: int, nbytes: int) -> bool:
+        """
+        Account for bytes taken out of a receive queue.
+
+        Returns:
+            bool: True if enough credit opened up that it should be announced now.
+        """
+        if stream_id not in self.queued:
+            # Forgotten with the rest of its queue
+            return False
+        self.buffered -= nbytes
+        self.queued[stream_id] -= nbytes
+        consumed = self.consumed[stream_id] = self.consumed.get(stream_id, 0) + nbytes
+        granted = self.granted.get(stream_id, self.stream_window)
+        return (
+            self.buffered < self.connection_budget
+            and consumed + self.stream_window - granted >= self.stream_window // 2
+        )
+
+    def stream_limit(self, stream_id: int, current: int) -> int:
+        """
+        Get the MAX_STREAM_DATA to announce for a stream. Streams nothing was
+        received on yet, or that were forgotten, keep their limit.
+        """
+        if stream_id not in self.queued or self.buffered >= self.connection_budget:
+            return current
+        limit = max(current, self.consumed.get(stream_id, 0) + self.stream_window)
+        self.granted[stream_id] = limit
+        return limit
+
+    def forget(self, stream_id: int) -> None:
+        """
+        Drop the accounting for a finished stream, including bytes still
+        queued that its handler will never consume.
+        """
+        self.buffered -= self.queued.pop(stream_id, 0)
+        self.consumed.pop(stream_id, None)
+        self.granted.pop(stream_id, None)
+
+
+def send_buffered(quic: QuicConnection, stream_id: int) -> int:
+    """
+    Get the bytes written to a stream that the peer has not acknowledged yet.
+
+    aioquic keeps them in the stream's send buffer, which grows without limit
+    if the peer withholds flow control credit.
+    """
+    stream = quic._streams.get(stream_id)
+    if stream is None:
+        return 0
+    return stream.sender._buffer_stop - stream.sender._buffer_start
+
+
+def check_aioquic() -> None:
+    """
+    Check that the installed aioquic has the internals the backpressure
+    relies on, so another release fails on startup rather than under load.
+
+    Raises:
+        RuntimeError: If one of them is missing or has changed.
+    """
+    missing = [
+        name for name in _CONNECTION_METHODS if not hasattr(QuicConnection, name)
+    ]
+    # Attributes set in the constructors
+    missing += [
+        name
+        for name in _CONNECTION_ATTRIBUTES
+        if name not in QuicConnection.__init__.__code__.co_names
+    ]
+    missing += [
+        name
+        for name in _SENDER_ATTRIBUTES
+        if name not in QuicStreamSender.__init__.__code__.co_names
+    ]
+    write_stream_limits = getattr(QuicConnection, "_write_stream_limits", None)
+    if write_stream_limits is not None:
+        parameters = write_stream_limits.__code__.co_varnames[:4]
+        if parameters != ("self", "builder", "space", "stream"):
+            missing.append("_write_stream_limits(builder, space, stream)")
+    if missing:
+        raise RuntimeError(
+            f"aioquic {aioquic.__version__} lacks {', '.join(missing)}; "
+            f"install aioquic=={AIOQUIC_VERSION} as pinned in requirements.txt"
+        )
+
+
+def _write_stream_limits(
+    quic: QuicConnection, budget: ReceiveBudget, builder, space, stream: QuicStream
+) -> None:
+    # Mirrors QuicConnection._write_stream_limits of aioquic 1.0, with the
+    # credit raise driven by the budget instead of the received offset.
+    if not stream.max_stream_data_local:
+        return
+    stream.max_stream_data_local = budget.stream_limit(
+        stream.stream_id, stream.max_stream_data_local
+    )
+    if stream.max_stream_data_local_sent != stream.max_stream_data_local:
+        buf = builder.start_frame(
+            QuicFrameType.MAX_STREAM_DATA,
+            capacity=MAX_STREAM_DATA_FRAME_CAPACITY,
+            handler=quic._on_max_stream_data_delivery,
+            handler_args=(stream,),
+        )
+        buf.push_uint_var(stream.stream_id)
+        buf.push_uint_var(stream.max_stream_data_local)
+        stream.max_stream_data_local_sent = stream.max_stream_data_local
@@ -0,0 +1,462 @@
+import asyncio
+import base64
+import collections
+import json
+import random
+import time
+from typing import Deque, Dict, List, Optional, Tuple
+
+import client.entry as client_entry
+import server.entry as server_entry
+from common.pdu import DatagramFramer
+from common.quic import QuicConnection, QuicStreamEvent
+
+# RETRANSMIT_DELAY: Time on top of a round trip before lost stream data is sent again (the kGranularity of RFC 9002).
+# DATAGRAM_QUEUE_LEN: Received datagrams buffered per connection; further datagrams are dropped.
+RETRANSMIT_DELAY = 0.001
+DATAGRAM_QUEUE_LEN = 1024
+
+
+class LinkProfile:
+    """
+    Network conditions of one direction of an in-memory link.
+
+    Stream data stays reliable and in order within a stream, as with QUIC: a
+    lost chunk is retransmitted after a round trip and holds up the chunks
+    behind it. Lost datagrams are dropped, and reordered datagrams can be
+    overtaken by later ones.
+
+    Args:
+        latency (float): One-way delay in seconds.
+        bandwidth (Optional[float]): Bytes per second, unlimited if None.
+        loss (float): Probability that a chunk or datagram is lost, below 1
+            so that retransmitted stream data eventually arrives.
+        reorder (float): Probability that a chunk or datagram is delayed by
+            ``reorder_delay`` on top of the latency.
+        reorder_delay (float): Extra delay of reordered chunks and datagrams.
+        chunk_len (Optional[int]): Split stream writes into chunks of random
+            length up to this many bytes, as the receiver may see them.
+    """
+
+    __slots__ = ("latency", "bandwidth", "loss", "reorder", "reorder_delay", "chunk_len")
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        bandwidth: Optional[float] = None,
+        loss: float = 0.0,
+        reorder: float = 0.0,
+        reorder_delay: float = 0.01,
+        chunk_len: Optional[int] = None,
+    ):
+        if not 0.0 <= loss < 1.0:
+            raise ValueError(f"Loss must be at least 0 and below 1, got {loss}")
+        if not 0.0 <= reorder <= 1.0:
+            raise ValueError(f"Reorder must be between 0 and 1, got {reorder}")
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.chunk_len = chunk_len
+
+
+class _Pipe:
+    """
+    One direction of an in-memory link, delivering into the peer's queues.
+    """
+
+    def __init__(self, link: LinkProfile, rng: random.Random, peer: "MemoryConnection"):
+        self.link = link
+        self.rng = rng
+        self.peer = peer
+        self.busy_until = 0.0
+        self.bytes_sent = 0
+        self.datagrams_lost = 0
+        self._streams: Dict[int, Deque[Tuple[bytes, bool]]] = {}
+        self._stream_ready: Dict[int, float] = {}
+
+    def _departure(self, nbytes: int) -> float:
+        now = asyncio.get_running_loop().time()
+        self.bytes_sent += nbytes
+        if self.link.bandwidth is None:
+            return now
+        self.busy_until = max(now, self.busy_until) + nbytes / self.link.bandwidth
+        return self.busy_until
+
+    def _arrival(self, departure: float) -> float:
+        arrival = departure + self.link.latency
+        if self.link.reorder and self.rng.random() < self.link.reorder:
+            arrival += self.link.reorder_delay
+        return arrival
+
+    def _lost(self) -> bool:
+        return bool(self.link.loss) and self.rng.random() < self.link.loss
+
+    def _schedule(self, when: float, callback, *args) -> None:
+        loop = asyncio.get_running_loop()
+        if when <= loop.time():
+            loop.call_soon(callback, *args)
+        else:
+            loop.call_at(when, callback, *args)
+
+    def _split(self, data: bytes) -> List[bytes]:
+        chunk_len = self.link.chunk_len
+        if not chunk_len or len(data) <= 1:
+            return [data]
+        chunks = []
+        offset = 0
+        while offset < len(data):
+            end = offset + self.rng.randint(1, chunk_len)
+            chunks.append(data[offset:end])
+            offset = end
+        return chunks
+
+    def send_stream(self, stream_id: int, data: bytes, end_stream: bool) -> None:
+        queue = self._streams.get(stream_id)
+        if queue is None:
+            queue = self._streams[stream_id] = collections.deque()
+
+        chunks = self._split(bytes(data))
+        last = len(chunks) - 1
+        for i, chunk in enumerate(chunks):
+            when = self._arrival(self._departure(len(chunk)))
+            while self._lost():
+                when += 2 * self.link.latency + RETRANSMIT_DELAY
+            # Chunks of a stream are handed over in order, whatever their arrival
+            when = max(when, self._stream_ready.get(stream_id, 0.0))
+            self._stream_ready[stream_id] = when
+            queue.append((chunk, end_stream and i == last))
+            self._schedule(when, self._deliver_stream, stream_id)
+
+    def _deliver_stream(self, stream_id: int) -> None:
+        chunk, end_stream = self._streams[stream_id].popleft()
+        self.peer._stream_data_received(stream_id, chunk, end_stream)
+
+    def send_datagram(self, data: bytes) -> float:
+        departure = self._departure(len(data))
+        if self._lost():
+            self.datagrams_lost += 1
+        else:
+            self._schedule(self._arrival(departure), self.peer._datagram_received, data)
+        return departure
+
+
+class MemoryConnection(QuicConnection):
+    """
+    One end of an in-memory connection for driving the rsu state machines
+    without sockets, TLS or aioquic.
+
+    Use ``connection_pair`` to create both ends. Received stream data goes
+    through a ``DatagramFramer``, as in the engine's request handlers, so
+    split writes reach the state machines as whole PDUs.
+
+    Args:
+        client (bool): Whether this is the client end, which opens streams.
+        datagrams (bool): Whether the transfer may use unreliable datagrams.
+    """
+
+    def __init__(self, client: bool, datagrams: bool = True):
+        super().__init__(
+            self._send,
+            self._receive,
+            self._close,
+            self._new_stream if client else None,
+            send_datagram=self._send_datagram if datagrams else None,
+            receive_datagram=self._receive_datagram if datagrams else None,
+        )
+        self.pipe: Optional[_Pipe] = None
+        self.closed = False
+        self.datagrams_dropped = 0
+        self._next_stream_id = 0
+        self._queue: asyncio.Queue[QuicStreamEvent] = asyncio.Queue()
+        self._datagrams: asyncio.Queue[bytes] = asyncio.Queue(DATAGRAM_QUEUE_LEN)
+        self._framers: Dict[int, DatagramFramer] = {}
+
+    def _new_stream(self) -> int:
+        # Client-initiated bidirectional stream IDs, as aioquic assigns them
+        stream_id = self._next_stream_id
+        self._next_stream_id += 4
+        return stream_id
+
+    async def _send(self, message: QuicStreamEvent) -> None:
+        self.pipe.send_stream(message.stream_id, message.data, message.end_stream)
+
+    async def _receive(self) -> QuicStreamEvent:
+        return await self._queue.get()
+
+    async def _send_datagram(self, data: bytes) -> None:
+        # Like the engine, return once the datagram left at the link's pace
+        delay = self.pipe.send_datagram(data) - asyncio.get_running_loop().time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _receive_datagram(self) -> bytes:
+        return await self._datagrams.get()
+
+    def _close(self) -> None:
+        self.closed = True
+
+    def _stream_data_received(self, stream_id: int, data: bytes, end_stream: bool) -> None:
+        framer = self._framers.get(stream_id)
+        if framer is None:
+            framer = self._framers[stream_id] = DatagramFramer()
+
+        frames = framer.feed(data)
+        last = len(frames) - 1
+        for i, frame in enumerate(frames):
+            self._queue.put_nowait(
+                QuicStreamEvent(stream_id, frame, end_stream and i == last)
+            )
+
+    def _datagram_received(self, data: bytes) -> None:
+        if self._datagrams.full():
+            self.datagrams_dropped += 1
+        else:
+            self._datagrams.put_nowait(data)
+
+
+def connection_pair(
+    uplink: Optional[LinkProfile] = None,
+    downlink: Optional[LinkProfile] = None,
+    seed: Optional[int] = None,
+    datagrams: bool = True,
+) -> Tuple[MemoryConnection, MemoryConnection]:
+    """
+    Create the two ends of an in-memory connection.
+
+    Loss, reordering and chunk splitting are drawn from a random generator
+    seeded with ``seed``, so a session can be repeated exactly.
+
+    Args:
+        uplink (Optional[LinkProfile]): Conditions from the client to the server.
+        downlink (Optional[LinkProfile]): Conditions from the server to the client.
+        seed (Optional[int]): Seed for the link's random decisions.
+        datagrams (bool): Whether the transfer may use unreliable datagrams.
+
+    Returns:
+        Tuple[MemoryConnection, MemoryConnection]: The server and client ends.
+    """
+    rng = random.Random(seed)
+    server = MemoryConnection(client=False, datagrams=datagrams)
+    client = MemoryConnection(client=True, datagrams=datagrams)
+    client.pipe = _Pipe(uplink or LinkProfile(), rng, server)
+    server.pipe = _Pipe(downlink or LinkProfile(), rng, client)
+    return server, client
+
+
+async def run_session(
+    server_scope: Dict,
+    client_scope: Dict,
+    uplink: Optional[LinkProfile] = None,
+    downlink: Optional[LinkProfile] = None,
+    seed: Optional[int] = None,
+) -> Dict:
+    """
+    Run one update session between the server and client state machines over
+    an in-memory connection.
+
+    Args:
+        server_scope (Dict): Scope of the server connection, e.g. with an
+            ``image_source``.
+        client_scope (Dict): Scope of the client connection, e.g. with a ``sink``.
+        uplink (Optional[LinkProfile]): Conditions from the client to the server.
+        downlink (Optional[LinkProfile]): Conditions from the server to the client.
+        seed (Optional[int]): Seed for the link's random decisions.
+
+    Returns:
+        Dict: The client scope, holding the results of the session.
+    """
+    server, client = connection_pair(uplink, downlink, seed)
+    await asyncio.gather(
+        server_entry.run(server_scope, server), client_entry.run(client_scope, client)
+    )
+    return client_scope
+
+
+class RecordingConnection(QuicConnection):
+    """
+    Wraps a connection and records every event going through it, so the
+    session can be replayed later with ``ReplayConnection``.
+
+    Args:
+        conn (QuicConnection): The connection to record.
+    """
+
+    def __init__(self, conn: QuicConnection):
+        super().__init__(
+            self._send,
+            self._receive,
+            conn.close,
+            conn.new_stream,
+            send_datagram=self._send_datagram if conn.send_datagram else None,
+            receive_datagram=self._receive_datagram if conn.receive_datagram else None,
+        )
+        self.conn = conn
+        self.started = time.perf_counter()
+        self.events: List[Dict] = []
+
+    def _record(self, direction: str, kind: str, data: bytes, **fields) -> None:
+        self.events.append(
+            dict(
+                t=time.perf_counter() - self.started,
+                dir=direction,
+                kind=kind,
+                data=base64.b64encode(data).decode("ascii"),
+                **fields,
+            )
+        )
+
+    async def _send(self, message: QuicStreamEvent) -> None:
+        self._record(
+            "out",
+            "stream",
+            message.data,
+            stream_id=message.stream_id,
+            end_stream=message.end_stream,
+        )
+        await self.conn.send(message)
+
+    async def _receive(self) -> QuicStreamEvent:
+        event = await self.conn.receive()
+        self._record(
+            "in", "stream", event.data, stream_id=event.stream_id, end_stream=event.end_stream
+        )
+        return event
+
+    async def _send_datagram(self, data: bytes) -> None:
+        self._record("out", "datagram", data)
+        await self.conn.send_datagram(data)
+
+    async def _receive_datagram(self) -> bytes:
+        data = await self.conn.receive_datagram()
+        self._record("in", "datagram", data)
+        return data
+
+    def save(self, path: str) -> None:
+        """
+        Write the recorded events to ``path`` as JSON lines.
+        """
+        with open(path, "w") as f:
+            for event in self.events:
+                f.write(json.dumps(event) + "\n")
+
+
+def load_trace(path: str) -> List[Dict]:
+    """
+    Read events written by ``RecordingConnection.save``.
+    """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class ReplayConnection(QuicConnection):
+    """
+    Plays recorded incoming events back to a state machine.
+
+    An incoming event is released once the state machine has sent as many
+    events as had been sent before it was recorded and has received every
+    event recorded before it, after the recorded gap since the last send,
+    scaled by ``time_scale``. Receives beyond the recording wait, as on a
+    connection the peer sends nothing more on. What the state machine sends
+    is collected in ``sent`` for comparison with the recording.
+
+    Args:
+        events (List[Dict]): Events from ``RecordingConnection`` or ``load_trace``.
+        time_scale (float): Factor for the recorded gaps; 0 replays at full speed.
+        client (bool): Whether the replayed end is a client, which opens streams.
+    """
+
+    def __init__(self, events: List[Dict], time_scale: float = 1.0, client: bool = False):
+        has_datagrams = any(event["kind"] == "datagram" for event in events)
+        super().__init__(
+            self._send,
+            self._receive,
+            self._close,
+            self._new_stream if client else None,
+            send_datagram=self._send_datagram if has_datagrams else None,
+            receive_datagram=self._receive_datagram if has_datagrams else None,
+        )
+        self.time_scale = time_scale
+        self.sent: List[Dict] = []
+        self.closed = False
+        self._sent_at: List[float] = []
+        self._progress = asyncio.Event()
+        self._received = 0
+        self._next_stream_id = 0
+
+        # Remember for each incoming event its place among the incoming events
+        # and how many outgoing events preceded it
+        self._incoming: Dict[str, Deque[Tuple[int, int, float, Dict]]] = {
+            "stream": collections.deque(),
+            "datagram": collections.deque(),
+        }
+        in_count = 0
+        out_count = 0
+        out_time = 0.0
+        for event in events:
+            if event["dir"] == "out":
+                out_count += 1
+                out_time = event["t"]
+            else:
+                self._incoming[event["kind"]].append(
+                    (in_count, out_count, event["t"] - out_time, event)
+                )
+                in_count += 1
+
+    def _new_stream(self) -> int:
+        # Client-initiated bidirectional stream IDs, as aioquic assigns them
+        stream_id = self._next_stream_id
+        self._next_stream_id += 4
+        return stream_id
+
+    def _sent(self, event: Dict) -> None:
+        self.sent.append(event)
+        self._sent_at.append(time.perf_counter())
+        self._progress.set()
+
+    async def _send(self, message: QuicStreamEvent) -> None:
+        self._sent(
+            dict(
+                kind="stream",
+                stream_id=message.stream_id,
+                data=bytes(message.data),
+                end_stream=message.end_stream,
+            )
+        )
+
+    async def _send_datagram(self, data: bytes) -> None:
+        self._sent(dict(kind="datagram", data=bytes(data)))
+
+    async def _next(self, kind: str) -> Dict:
+        # The event is only taken once released, so a cancelled receive
+        # leaves it for the next one
+        while True:
+            if self._incoming[kind]:
+                position, after, gap, event = self._incoming[kind][0]
+                if len(self.sent) >= after and self._received == position:
+                    break
+            self._progress.clear()
+            await self._progress.wait()
+
+        if self.time_scale and after:
+            delay = self._sent_at[after - 1] + gap * self.time_scale - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        self._incoming[kind].popleft()
+        self._received += 1
+        self._progress.set()
+        return event
+
+    async def _receive(self) -> QuicStreamEvent:
+        event = await self._next("stream")
+        return QuicStreamEvent(
+            event["stream_id"], base64.b64decode(event["data"]), event["end_stream"]
+        )
+
+    async def _receive_datagram(self) -> bytes:
+        event = await self._next("datagram")
+        return base64.b64decode(event["data"])
+
+    def _close(self) -> None:
+        self.closed = True
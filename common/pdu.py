@@ -1,5 +1,7 @@
 import base64
 import json
+import struct
+from typing import Dict, List, Optional, Tuple, Union
 
 # Message types
 MSG_TYPE_VERSION_EXCHANGE = 0x00
@@ -12,6 +14,28 @@ MSG_TYPE_START_SND_DATA = 0x06
 MSG_TYPE_FINISH_SND_DATA = 0x07
 MSG_TYPE_RECEIVE_ACK = 0x08
 MSG_TYPE_ERROR = 0x09
+MSG_TYPE_REPAIR_REQUEST = 0x0A
+
+# Transfer modes negotiated at version exchange
+TRANSFER_STREAM = "stream"
+TRANSFER_DATAGRAM_FEC = "datagram-fec"
+
+# Wire header: message type, protocol version length, firmware version length
+# and payload length. The version strings and the payload follow the header.
+HEADER = struct.Struct("!BBBI")
+HEADER_LEN = HEADER.size
+
+# Largest payload accepted from a peer. A datagram split across stream events
+# is allocated from its header, and must fit a stream's receive window (64 KiB
+# by default) to arrive at all.
+MAX_PAYLOAD_LEN = 64 * 1024
+
+# Size of the pooled encode buffers. Large enough for a default 512 byte
+# segment plus the header and both version strings.
+DEFAULT_BUFFER_SIZE = 2048
+DEFAULT_POOL_SIZE = 64
+
+BytesLike = Union[bytes, bytearray, memoryview]
 
 
 class Datagram:
@@ -19,32 +43,231 @@ class Datagram:
     Represents a datagram object used in network communication.
     """
 
+    __slots__ = ("mtype", "payload", "protocol_ver", "firmware_ver", "size")
+
     def __init__(
         self,
         mtype: int,
-        payload: bytes = b"",
+        payload: BytesLike = b"",
         protocol_ver: str = "",
         firmware_ver: str = "",
         size: int = 0,
     ):
         self.mtype = mtype
-        self.payload = base64.b64encode(payload).decode("utf-8")
+        self.payload = payload
         self.protocol_ver = protocol_ver
         self.firmware_ver = firmware_ver
-        self.size = len(self.payload)
+        self.size = len(payload)
+
+    def encoded_len(self) -> int:
+        """
+        Number of bytes needed to encode the datagram.
+        """
+        return HEADER_LEN + len(self.protocol_ver) + len(self.firmware_ver) + self.size
+
+    def encode_into(self, buffer: bytearray, offset: int = 0) -> int:
+        """
+        Encode the datagram into a preallocated buffer.
+
+        Args:
+            buffer (bytearray): The destination buffer.
+            offset (int): Where to start writing in the buffer.
+
+        Returns:
+            int: The number of bytes written.
+        """
+        protocol_ver = self.protocol_ver.encode("ascii")
+        firmware_ver = self.firmware_ver.encode("ascii")
+        HEADER.pack_into(
+            buffer, offset, self.mtype, len(protocol_ver), len(firmware_ver), self.size
+        )
+        pos = offset + HEADER_LEN
+        # Writing through a memoryview keeps bytearray from copying the field
+        target = memoryview(buffer)
+        for field in (protocol_ver, firmware_ver, self.payload):
+            end = pos + len(field)
+            target[pos:end] = field
+            pos = end
+        return pos - offset
 
     def to_json(self):
-        return json.dumps(self.__dict__)
+        return json.dumps(self._to_dict())
 
     @staticmethod
     def from_json(json_str):
-        return Datagram(**json.loads(json_str))
+        input_dict = json.loads(json_str)
+        input_dict["payload"] = base64.b64decode(input_dict["payload"])
+        return Datagram(**input_dict)
 
-    def to_bytes(self):
-        return json.dumps(self.__dict__).encode("utf-8")
+    def to_bytes(self) -> bytes:
+        buffer = bytearray(self.encoded_len())
+        self.encode_into(buffer)
+        return bytes(buffer)
 
     @staticmethod
-    def from_bytes(json_bytes: bytes) -> "Datagram":
-        input_dict = json.loads(json_bytes.decode("utf-8"))
-        input_dict["payload"] = base64.b64decode(input_dict["payload"])
-        return Datagram(**input_dict)
+    def from_bytes(data: BytesLike) -> "Datagram":
+        """
+        Decode a datagram without copying its payload.
+
+        The returned payload is a memoryview into ``data``.
+        """
+        view = memoryview(data)
+        mtype, protocol_len, firmware_len, size = HEADER.unpack_from(view)
+        pos = HEADER_LEN
+        protocol_ver = str(view[pos : pos + protocol_len], "ascii")
+        pos += protocol_len
+        firmware_ver = str(view[pos : pos + firmware_len], "ascii")
+        pos += firmware_len
+        payload = view[pos : pos + size]
+        if len(payload) != size:
+            raise ValueError("Truncated datagram")
+        return Datagram(mtype, payload, protocol_ver, firmware_ver)
+
+    def _to_dict(self):
+        return {
+            "mtype": self.mtype,
+            "payload": base64.b64encode(self.payload).decode("utf-8"),
+            "protocol_ver": self.protocol_ver,
+            "firmware_ver": self.firmware_ver,
+            "size": self.size,
+        }
+
+
+def encode_options(options: Dict) -> bytes:
+    """
+    Encode negotiation options carried in a version exchange payload.
+    """
+    return json.dumps(options).encode("utf-8") if options else b""
+
+
+def decode_options(payload: BytesLike) -> Dict:
+    """
+    Decode negotiation options. An empty payload means no options.
+    """
+    if not len(payload):
+        return {}
+    return json.loads(str(payload, "utf-8"))
+
+
+class DatagramFramer:
+    """
+    Splits the bytes received on a stream into encoded datagrams.
+
+    A single stream event may carry several datagrams or only part of one.
+    Complete datagrams are returned as memoryviews into the received data. A
+    datagram split across events is copied aside, and only its own bytes are
+    copied when the rest arrives. ``feed`` raises ValueError for a header
+    announcing a payload over ``MAX_PAYLOAD_LEN``.
+    """
+
+    __slots__ = ("_pending", "_filled")
+
+    def __init__(self) -> None:
+        self._pending: Optional[bytearray] = None
+        self._filled = 0
+
+    def feed(self, data: BytesLike) -> List[memoryview]:
+        """
+        Add received bytes and return the datagrams they complete.
+        """
+        view = memoryview(data)
+        frames: List[memoryview] = []
+        pos = 0
+        if self._pending is not None:
+            pos, frame = self._complete_pending(view)
+            if frame is None:
+                return frames
+            frames.append(frame)
+
+        while len(view) - pos >= HEADER_LEN:
+            end = pos + _frame_len(view, pos)
+            if end > len(view):
+                break
+            frames.append(view[pos:end])
+            pos = end
+        if pos < len(view):
+            self._keep_partial(view[pos:])
+        return frames
+
+    def _keep_partial(self, rest: memoryview) -> None:
+        # Allocate the whole datagram once its header is known, so the rest
+        # is copied in place as it arrives
+        length = _frame_len(rest, 0) if len(rest) >= HEADER_LEN else HEADER_LEN
+        self._pending = bytearray(length)
+        memoryview(self._pending)[: len(rest)] = rest
+        self._filled = len(rest)
+
+    def _complete_pending(self, view: memoryview) -> Tuple[int, Optional[memoryview]]:
+        # Move the rest of the pending datagram over from the new data.
+        # Returns how much of the data was used and the datagram, if complete.
+        pending = self._pending
+        filled = self._filled
+        pos = 0
+        if filled < HEADER_LEN:
+            pos = min(HEADER_LEN - filled, len(view))
+            memoryview(pending)[filled : filled + pos] = view[:pos]
+            filled += pos
+            if filled < HEADER_LEN:
+                self._filled = filled
+                return pos, None
+            length = _frame_len(pending, 0)
+            if length > HEADER_LEN:
+                pending = self._pending = pending + bytearray(length - HEADER_LEN)
+
+        end = min(pos + len(pending) - filled, len(view))
+        memoryview(pending)[filled : filled + end - pos] = view[pos:end]
+        self._filled = filled + end - pos
+        if self._filled < len(pending):
+            return end, None
+        self._pending = None
+        return end, memoryview(pending)
+
+
+def _frame_len(data: BytesLike, pos: int) -> int:
+    _, protocol_len, firmware_len, size = HEADER.unpack_from(data, pos)
+    if size > MAX_PAYLOAD_LEN:
+        raise ValueError(f"Datagram payload of {size} bytes exceeds {MAX_PAYLOAD_LEN}")
+    return HEADER_LEN + protocol_len + firmware_len + size
+
+
+class BufferPool:
+    """
+    Pool of reusable bytearrays used to encode outgoing datagrams.
+
+    Args:
+        buffer_size (int): Size of each pooled buffer.
+        max_buffers (int): Maximum number of idle buffers kept in the pool.
+    """
+
+    __slots__ = ("buffer_size", "max_buffers", "_free")
+
+    def __init__(
+        self, buffer_size: int = DEFAULT_BUFFER_SIZE, max_buffers: int = DEFAULT_POOL_SIZE
+    ):
+        self.buffer_size = buffer_size
+        self.max_buffers = max_buffers
+        self._free: List[bytearray] = []
+
+    def acquire(self, size: int = 0) -> bytearray:
+        """
+        Get a buffer of at least ``size`` bytes.
+
+        Requests larger than the pooled buffer size get a one-off buffer that
+        is dropped on release.
+        """
+        if size > self.buffer_size:
+            return bytearray(size)
+        if self._free:
+            return self._free.pop()
+        return bytearray(self.buffer_size)
+
+    def release(self, buffer: bytearray) -> None:
+        """
+        Return a buffer to the pool.
+        """
+        if len(buffer) == self.buffer_size and len(self._free) < self.max_buffers:
+            self._free.append(buffer)
+
+
+# Shared pool used by the state machines on the send path.
+buffer_pool = BufferPool()
@@ -0,0 +1,80 @@
+import datetime
+import os
+from typing import Tuple
+
+# PEER_SERVER_NAME: Name every device certificate is issued to. Peers are
+#   verified against the certificate the origin handed out, under this name
+#   rather than their address, so peers on any LAN address verify.
+# CERT_LIFETIME_DAYS: Validity of a generated device certificate.
+# MAX_CERT_LEN: Largest device certificate the origin accepts, in PEM bytes.
+PEER_SERVER_NAME = "rsu-peer"
+CERT_LIFETIME_DAYS = 3650
+MAX_CERT_LEN = 4096
+
+CERT_FILENAME = "peer_certificate.pem"
+KEY_FILENAME = "peer_private_key.pem"
+
+
+def load_or_create(directory: str) -> Tuple[str, str, str]:
+    """
+    Get the device's own credentials for serving peers, generating a
+    self-signed certificate and key on first use.
+
+    Devices never hold the origin's key. The origin hands each device's
+    certificate out with its peer hint, and clients trust only that
+    certificate when fetching from the peer.
+
+    Args:
+        directory (str): Directory to keep the certificate and key in.
+
+    Returns:
+        Tuple[str, str, str]: The certificate file, the key file and the
+            certificate in PEM form.
+    """
+    cert_file = os.path.join(directory, CERT_FILENAME)
+    key_file = os.path.join(directory, KEY_FILENAME)
+    if not (os.path.exists(cert_file) and os.path.exists(key_file)):
+        _generate(directory, cert_file, key_file)
+    with open(cert_file) as f:
+        return cert_file, key_file, f.read()
+
+
+def _generate(directory: str, cert_file: str, key_file: str) -> None:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, PEER_SERVER_NAME)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=CERT_LIFETIME_DAYS))
+        .add_extension(
+            x509.SubjectAlternativeName([x509.DNSName(PEER_SERVER_NAME)]),
+            critical=False,
+        )
+        .add_extension(x509.BasicConstraints(ca=True, path_length=0), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+
+    os.makedirs(directory, exist_ok=True)
+    # The key is written first and only readable by the owner
+    fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+        )
+    with open(cert_file, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    print(f"[client] Generated peer certificate in {directory}")
@@ -0,0 +1,265 @@
+import collections
+import contextlib
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+from typing import Any, Coroutine, Counter, Dict, Iterator, List, Optional, Set
+
+
+class Span:
+    """
+    A timed section of work on a connection.
+
+    Args:
+        name (str): What was measured, e.g. a QUIC event or state name.
+        start (float): Seconds since the connection started.
+        duration (float): Wall time in seconds.
+        nbytes (int): Bytes handled during the span.
+    """
+
+    __slots__ = ("name", "start", "duration", "nbytes")
+
+    def __init__(self, name: str, start: float, duration: float, nbytes: int):
+        self.name = name
+        self.start = start
+        self.duration = duration
+        self.nbytes = nbytes
+
+
+class ConnectionTrace:
+    """
+    Spans recorded for a single connection.
+
+    Args:
+        connection_id (int): Identifier of the connection within the tracer.
+        profiled (bool): Whether stack samples are collected for the connection.
+    """
+
+    def __init__(self, connection_id: int, profiled: bool = False):
+        self.connection_id = connection_id
+        self.profiled = profiled
+        self.started = time.perf_counter()
+        self.spans: List[Span] = []
+        self.samples: Counter[str] = collections.Counter()
+
+    def record(self, name: str, start: float, nbytes: int = 0) -> None:
+        """
+        Record a span that started at ``start`` (a ``time.perf_counter`` value)
+        and ends now.
+        """
+        now = time.perf_counter()
+        self.spans.append(Span(name, start - self.started, now - start, nbytes))
+
+    def to_dict(self) -> Dict:
+        return {
+            "connection_id": self.connection_id,
+            "spans": [
+                {
+                    "name": span.name,
+                    "start": span.start,
+                    "duration": span.duration,
+                    "bytes": span.nbytes,
+                }
+                for span in self.spans
+            ],
+        }
+
+
+class SamplingProfiler:
+    """
+    Samples the event loop thread's stack from a background thread.
+
+    All connections share the event loop thread, so the loop marks which
+    profiled connection it is running code for in ``running``: around each
+    step of the connection's handler tasks (see ``attributed``) and around
+    its packet and timer processing (see ``attribute``). A sample is added to
+    that connection only, and dropped while the loop runs anything else.
+
+    Args:
+        interval (float): Seconds between samples.
+    """
+
+    def __init__(self, interval: float = 0.001):
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.active: Set[ConnectionTrace] = set()
+        self.lock = threading.Lock()
+        self.running: Optional[ConnectionTrace] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, trace: ConnectionTrace) -> None:
+        with self.lock:
+            self.active.add(trace)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def remove(self, trace: ConnectionTrace) -> None:
+        with self.lock:
+            self.active.discard(trace)
+
+    @contextlib.contextmanager
+    def attribute(self, trace: ConnectionTrace) -> Iterator[None]:
+        """
+        Attribute the samples taken inside the block to ``trace``.
+        """
+        previous = self.running
+        self.running = trace
+        try:
+            yield
+        finally:
+            self.running = previous
+
+    async def attributed(self, trace: ConnectionTrace, coro: Coroutine) -> Any:
+        """
+        Run a coroutine, attributing the samples taken during each of its
+        steps to ``trace``.
+        """
+        return await _AttributedSteps(self, trace, coro)
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.thread_id)
+            trace = self.running
+            with self.lock:
+                if not self.active:
+                    self._thread = None
+                    return
+                if frame is None or trace not in self.active:
+                    continue
+                trace.samples[_fold(frame)] += 1
+
+
+class _AttributedSteps:
+    # Drives a coroutine like ``await`` does, marking each step as running
+    # for the connection
+
+    __slots__ = ("profiler", "trace", "coro")
+
+    def __init__(self, profiler: SamplingProfiler, trace: ConnectionTrace, coro):
+        self.profiler = profiler
+        self.trace = trace
+        self.coro = coro
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    def send(self, value):
+        with self.profiler.attribute(self.trace):
+            return self.coro.send(value)
+
+    def throw(self, *args):
+        with self.profiler.attribute(self.trace):
+            return self.coro.throw(*args)
+
+    def close(self) -> None:
+        self.coro.close()
+
+
+def _fold(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Tracer:
+    """
+    Collects per-connection trace spans.
+
+    The tracer is installed through the ``tracer`` scope key. Each connection
+    gets a ``ConnectionTrace`` that the engine and the server state machine
+    record spans into. Finished traces are appended as JSON lines to
+    ``path``, if given, and kept in ``traces`` otherwise. Subclasses can
+    override ``start_connection`` and ``finish_connection`` to send traces
+    elsewhere.
+
+    A fraction ``profile_rate`` of the connections is also sampled by a
+    ``SamplingProfiler``, which attributes each sample to the connection the
+    event loop was running code for. Their stacks are written in the folded
+    format used by flame graph tools to ``<profile_dir>/connection-<id>.folded``.
+
+    Args:
+        path (Optional[str]): File to append finished traces to.
+        profile_rate (float): Fraction of connections to profile.
+        profile_dir (str): Directory for the folded stack files.
+        profile_interval (float): Seconds between stack samples.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        profile_rate: float = 0.0,
+        profile_dir: str = ".",
+        profile_interval: float = 0.001,
+    ):
+        self.path = path
+        self.profile_rate = profile_rate
+        self.profile_dir = profile_dir
+        self.profile_interval = profile_interval
+        self.traces: List[ConnectionTrace] = []
+        self._ids = itertools.count()
+        self._profiler: Optional[SamplingProfiler] = None
+
+    def start_connection(self) -> ConnectionTrace:
+        profiled = self.profile_rate > 0 and random.random() < self.profile_rate
+        trace = ConnectionTrace(next(self._ids), profiled)
+        if profiled:
+            if self._profiler is None:
+                self._profiler = SamplingProfiler(self.profile_interval)
+            self._profiler.add(trace)
+        return trace
+
+    def attribute(self, trace: ConnectionTrace):
+        """
+        Context manager attributing the profiler samples taken inside it to
+        ``trace``, if the connection is profiled.
+        """
+        if not trace.profiled:
+            return contextlib.nullcontext()
+        return self._profiler.attribute(trace)
+
+    def attributed(self, trace: ConnectionTrace, coro: Coroutine) -> Coroutine:
+        """
+        Wrap a coroutine of the connection, so the profiler samples taken
+        while it runs are attributed to ``trace``, if the connection is
+        profiled.
+        """
+        if not trace.profiled:
+            return coro
+        return self._profiler.attributed(trace, coro)
+
+    def finish_connection(self, trace: ConnectionTrace) -> None:
+        if trace.profiled:
+            self._profiler.remove(trace)
+            self._write_profile(trace)
+
+        if self.path is None:
+            self.traces.append(trace)
+            return
+        with open(self.path, "a") as f:
+            f.write(json.dumps(trace.to_dict()) + "\n")
+
+    def _write_profile(self, trace: ConnectionTrace) -> None:
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(
+            self.profile_dir, f"connection-{trace.connection_id}.folded"
+        )
+        with self._profiler.lock:
+            samples = list(trace.samples.items())
+        with open(path, "w") as f:
+            for stack, count in samples:
+                f.write(f"{stack} {count}\n")
@@ -11,6 +11,8 @@ class QuicStreamEvent:
         end_stream (bool): Indicates whether the stream has ended.
     """
 
+    __slots__ = ("stream_id", "data", "end_stream")
+
     def __init__(self, stream_id: int, data: bytes, end_stream: bool):
         self.stream_id = stream_id
         self.data = data
@@ -26,6 +28,8 @@ class QuicConnection:
         receive (Coroutine[None, None, QuicStreamEvent]): A coroutine function used for receiving messages.
         close (Optional[Callable[[], None]]): An optional callable function used for closing the connection.
         new_stream (Optional[Callable[[], int]]): An optional callable function used for creating a new stream.
+        send_datagram (Optional[Coroutine[bytes, None, None]]): An optional coroutine function used for sending unreliable datagrams.
+        receive_datagram (Optional[Coroutine[None, None, bytes]]): An optional coroutine function used for receiving unreliable datagrams.
     """
 
     def __init__(
@@ -34,8 +38,12 @@ class QuicConnection:
         receive: Coroutine[None, None, QuicStreamEvent],
         close: Optional[Callable[[], None]],
         new_stream: Optional[Callable[[], int]],
+        send_datagram: Optional[Coroutine[bytes, None, None]] = None,
+        receive_datagram: Optional[Coroutine[None, None, bytes]] = None,
     ):
         self.send = send
         self.receive = receive
         self.close = close
         self.new_stream = new_stream
+        self.send_datagram = send_datagram
+        self.receive_datagram = receive_datagram
@@ -0,0 +1,300 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+# RETRY_INTERVAL: Seconds before an origin that could not be reached is asked
+# again, when the relay has no image to fall back on.
+RETRY_INTERVAL = 5.0
+
+
+class CacheEntry:
+    """
+    A firmware image in the relay cache, possibly still being fetched.
+
+    Readers can stream the image while it is being written: ``segments`` yields
+    data as soon as it lands on disk and waits for more until the upstream
+    transfer completes.
+    """
+
+    def __init__(self, path: str, sha256: str, firmware_ver: str, size: int):
+        self.path = path
+        self.sha256 = sha256
+        self.firmware_ver = firmware_ver
+        self.size = size
+        self.written = 0
+        self.complete = False
+        self.error: Optional[BaseException] = None
+        self.readers = 0
+        self._file = None
+        self._progress = asyncio.Event()
+
+    def _notify(self) -> None:
+        self._progress.set()
+        self._progress = asyncio.Event()
+
+    def write(self, data: bytes) -> None:
+        self._file.write(data)
+        self.written += len(data)
+        self._notify()
+
+    def finish(self, path: str) -> None:
+        self._file.close()
+        self._file = None
+        os.replace(self.path, path)
+        self.path = path
+        self.size = self.written
+        self.complete = True
+        self._notify()
+
+    def fail(self, error: BaseException) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self.path)
+        self.error = error
+        self._notify()
+
+    async def segments(
+        self, segment_len: int = 512, offset: int = 0
+    ) -> AsyncIterator[memoryview]:
+        """
+        Iterate over the image in segments of ``segment_len`` bytes, starting
+        at ``offset``.
+        """
+        self.readers += 1
+        try:
+            # The file stays readable even if it is renamed or evicted meanwhile
+            with open(self.path, "rb", buffering=0) as f:
+                f.seek(offset)
+                pos = offset
+                while True:
+                    if self.error is not None:
+                        raise self.error
+                    available = self.written - pos
+                    if available >= segment_len or (self.complete and available):
+                        data = f.read(min(segment_len, available))
+                        pos += len(data)
+                        yield memoryview(data)
+                    elif self.complete:
+                        return
+                    else:
+                        await self._progress.wait()
+        finally:
+            self.readers -= 1
+
+
+class CacheSink:
+    """
+    Client sink that writes an upstream transfer into the relay cache.
+
+    See ``client.sinks.FileSink`` for the sink interface.
+    """
+
+    def __init__(self, cache: "ImageCache", future: "asyncio.Future[CacheEntry]"):
+        self.cache = cache
+        self.future = future
+        self.entry: Optional[CacheEntry] = None
+
+    def open(self, firmware_ver: str, image_hash: Optional[str], size: int) -> bool:
+        entry = self.cache.lookup(image_hash)
+        if entry is not None:
+            # Already cached or being fetched: join it instead of downloading
+            entry.firmware_ver = firmware_ver
+            self.future.set_result(entry)
+            return False
+
+        self.entry = self.cache.begin(image_hash, firmware_ver, size)
+        self.future.set_result(self.entry)
+        return True
+
+    def write(self, data: bytes) -> None:
+        self.entry.write(data)
+
+    def commit(self) -> None:
+        self.cache.finish(self.entry)
+
+    def abort(self, error: Optional[BaseException] = None) -> None:
+        if self.entry is not None:
+            self.cache.fail(self.entry, error or ConnectionError("Upstream aborted"))
+
+
+class ImageCache:
+    """
+    On-disk LRU cache of firmware images for relay nodes.
+
+    Images are stored as ``<sha256>.bin`` in ``cache_dir``. The least recently
+    used complete images are evicted once the cache grows beyond ``max_bytes``.
+    Concurrent requests for the latest image share a single upstream fetch, and
+    the origin is asked again at most every ``refresh`` seconds.
+
+    The cache is also the relay's image source: ``open`` returns the latest
+    image, which may still be streaming in from the origin. If the origin
+    cannot be reached, the last image it announced keeps being served; it is
+    recorded in ``latest.json``, so this also holds after a restart.
+
+    Args:
+        cache_dir (str): Directory holding the cached images.
+        max_bytes (int): Size limit for the cached images.
+        fetch (Callable[[CacheSink], Awaitable[None]]): Runs an upstream
+            transfer into the given sink.
+        refresh (float): Seconds for which the latest image is reused without
+            asking the origin.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        max_bytes: int,
+        fetch: Callable[[CacheSink], Awaitable[None]],
+        refresh: float = 60.0,
+    ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.fetch = fetch
+        self.refresh = refresh
+        self.entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._latest: Optional[asyncio.Future] = None
+        self._latest_at = 0.0
+        self._good: Optional[CacheEntry] = None
+        self._load()
+
+    def _load(self) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(".part"):
+                os.remove(path)
+            elif name.endswith(".bin"):
+                files.append((os.path.getmtime(path), name, path))
+        for _, name, path in sorted(files):
+            entry = CacheEntry(path, name[: -len(".bin")], "", os.path.getsize(path))
+            entry.written = entry.size
+            entry.complete = True
+            self.entries[entry.sha256] = entry
+
+        try:
+            with open(self._good_path()) as f:
+                good = json.load(f)
+        except (OSError, ValueError):
+            good = {}
+        entry = self.entries.get(good.get("sha256"))
+        if entry is not None:
+            entry.firmware_ver = good["firmware_ver"]
+            self._good = entry
+        self._evict()
+
+    def _good_path(self) -> str:
+        return os.path.join(self.cache_dir, "latest.json")
+
+    def _remember(self, entry: CacheEntry) -> None:
+        # Keep the last image the origin announced to fall back on
+        if entry is self._good:
+            return
+        self._good = entry
+        tmp_path = self._good_path() + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"sha256": entry.sha256, "firmware_ver": entry.firmware_ver}, f)
+        os.replace(tmp_path, self._good_path())
+
+    def _path(self, sha256: str, suffix: str) -> str:
+        return os.path.join(self.cache_dir, sha256 + suffix)
+
+    def lookup(self, sha256: Optional[str]) -> Optional[CacheEntry]:
+        entry = self.entries.get(sha256)
+        if entry is not None:
+            self.entries.move_to_end(sha256)
+        return entry
+
+    def begin(self, sha256: str, firmware_ver: str, size: int) -> CacheEntry:
+        entry = CacheEntry(self._path(sha256, ".part"), sha256, firmware_ver, size)
+        entry._file = open(entry.path, "wb", buffering=0)
+        self.entries[sha256] = entry
+        return entry
+
+    def finish(self, entry: CacheEntry) -> None:
+        entry.finish(self._path(entry.sha256, ".bin"))
+        print(f"[relay] Cached image {entry.sha256[:12]} ({entry.size} bytes)")
+        self._evict()
+
+    def fail(self, entry: CacheEntry, error: BaseException) -> None:
+        entry.fail(error)
+        if self.entries.get(entry.sha256) is entry:
+            del self.entries[entry.sha256]
+
+    def _evict(self) -> None:
+        latest = self._current_latest()
+        total = sum(entry.size for entry in self.entries.values())
+        for sha256, entry in list(self.entries.items()):
+            if total <= self.max_bytes:
+                break
+            if not entry.complete or entry.readers or entry in (latest, self._good):
+                continue
+            os.remove(entry.path)
+            del self.entries[sha256]
+            total -= entry.size
+            print(f"[relay] Evicted image {sha256[:12]}")
+
+    def _current_latest(self) -> Optional[CacheEntry]:
+        if self._latest is None or not self._latest.done():
+            return None
+        if self._latest.cancelled() or self._latest.exception() is not None:
+            return None
+        return self._latest.result()
+
+    def _needs_refresh(self) -> bool:
+        elapsed = time.monotonic() - self._latest_at
+        current = self._current_latest()
+        if current is None or current.error is not None:
+            return elapsed > min(self.refresh, RETRY_INTERVAL)
+        return elapsed > self.refresh
+
+    async def open(self) -> CacheEntry:
+        """
+        Get the latest image, fetching it from the origin if needed.
+        """
+        latest = self._latest
+        if latest is None or (latest.done() and self._needs_refresh()):
+            latest = self._latest = asyncio.get_running_loop().create_future()
+            self._latest_at = time.monotonic()
+            asyncio.ensure_future(self._refresh(latest))
+
+        entry = await asyncio.shield(latest)
+        if entry.error is not None:
+            raise entry.error
+        self.entries.move_to_end(entry.sha256)
+        return entry
+
+    async def _refresh(self, future: asyncio.Future) -> None:
+        sink = CacheSink(self, future)
+        try:
+            await self.fetch(sink)
+        except Exception as exc:
+            sink.abort(exc)
+            self._fall_back(future, exc)
+            return
+        if not future.done():
+            self._fall_back(future, ConnectionError("Origin did not announce an image"))
+        elif sink.entry is not None and not sink.entry.complete:
+            sink.abort()
+            self._fall_back(future, sink.entry.error)
+        elif future.result().complete:
+            self._remember(future.result())
+
+    def _fall_back(self, future: asyncio.Future, error: BaseException) -> None:
+        good = self._good
+        if good is None or self.entries.get(good.sha256) is not good:
+            if not future.done():
+                future.set_exception(error)
+            return
+
+        print(f"[relay] Origin unavailable ({error!r}), serving cached image")
+        if not future.done():
+            future.set_result(good)
+        elif self._latest is future:
+            # The new image failed midway; sessions from now on get the old one
+            self._latest = asyncio.get_running_loop().create_future()
+            self._latest.set_result(good)
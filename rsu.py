@@ -1,7 +1,43 @@
+import time
+
+# Taken before the other imports, for the client's --timing report
+STARTED = time.perf_counter()
+
 import argparse
 import asyncio
 
-import common.engine as engine
+import common.pdu as pdu
+
+# The engine and aioquic are imported by the mode functions, so --help and
+# argument errors do not wait for them
+
+
+def parse_address(address):
+    """
+    Parse a HOST:PORT address.
+
+    Args:
+        address (str): The address to parse.
+
+    Returns:
+        Tuple[str, int]: The host and port.
+    """
+    host, _, port = address.rpartition(":")
+    return host, int(port)
+
+
+def with_defaults(args, **defaults):
+    """
+    Fill in the options left unset with their defaults, which live in modules
+    only the mode functions import.
+
+    Args:
+        args (argparse.Namespace): The command-line arguments.
+        **defaults: The default of each option.
+    """
+    for name, value in defaults.items():
+        if getattr(args, name) is None:
+            setattr(args, name, value)
 
 
 def client_mode(args):
@@ -13,12 +49,102 @@ def client_mode(args):
 
     Returns: None
     """
+    import common.engine as engine
+
+    imported_at = time.perf_counter()
+    with_defaults(
+        args,
+        stream_window=engine.DEFAULT_STREAM_WINDOW,
+        interval=engine.DEFAULT_CHECK_INTERVAL,
+    )
     server_address = args.server
     server_port = args.port
     cert_file = args.cert_file
 
-    config = engine.build_client_quic_config(cert_file)
-    asyncio.run(engine.run_client(server_address, server_port, config))
+    config = engine.build_client_quic_config(
+        cert_file, args.stream_window, args.transfer == pdu.TRANSFER_DATAGRAM_FEC
+    )
+    scope = {
+        "use_peers": args.use_peers,
+        "save_path": args.save_path,
+        "transfer": args.transfer,
+        "imported_at": imported_at,
+    }
+    if args.serve_peers:
+        from common import peer_credentials
+
+        # Peers are served with the device's own certificate, never the origin's
+        peer_cert_file, peer_key_file, scope["peer_cert"] = (
+            peer_credentials.load_or_create(args.peer_credentials)
+        )
+        scope["serve_peers"] = parse_address(args.serve_peers)
+    if args.device_id:
+        scope["device_id"] = args.device_id
+    if args.slots:
+        from client.sinks import SlotSink
+
+        sink = scope["sink"] = SlotSink(args.slots)
+        if sink.firmware_ver:
+            scope["current_ver"] = sink.firmware_ver
+    tickets = engine.SessionTicketCache(args.ticket_cache) if args.ticket_cache else None
+
+    if args.daemon:
+        if args.serve_peers:
+            raise SystemExit("--serve-peers cannot be combined with --daemon")
+        asyncio.run(
+            engine.run_client_daemon(
+                server_address,
+                server_port,
+                config,
+                scope,
+                args.interval,
+                tickets,
+                args.use_peers,
+            )
+        )
+        return
+
+    if not (args.use_peers or args.serve_peers):
+        scope = asyncio.run(
+            engine.run_client(server_address, server_port, config, scope, tickets)
+        )
+        report_timing(args, scope)
+        return
+
+    scope = asyncio.run(
+        engine.run_peer_assisted_client(
+            server_address, server_port, config, scope, tickets
+        )
+    )
+    report_timing(args, scope)
+
+    # Serve the freshly installed image to nearby devices
+    if args.serve_peers and scope.get("installed"):
+        peer_host, peer_port = scope["serve_peers"]
+        server_config = engine.build_server_quic_config(peer_cert_file, peer_key_file)
+        asyncio.run(
+            engine.run_peer_server(peer_host, peer_port, server_config, scope)
+        )
+
+
+def report_timing(args, scope):
+    """
+    Print how long the client took to start up, if asked to.
+
+    Args:
+        args (argparse.Namespace): The command-line arguments.
+        scope (Dict): The scope of the finished client connection.
+    """
+    if not args.timing:
+        return
+    done = time.perf_counter()
+    imported = scope["imported_at"]
+    first_byte = scope.get("first_byte_at", done)
+    print(
+        f"[client] Imports {(imported - STARTED) * 1000:.1f} ms, "
+        f"first byte {(first_byte - STARTED) * 1000:.1f} ms, "
+        f"done {(done - STARTED) * 1000:.1f} ms"
+    )
 
 
 def server_mode(args):
@@ -30,13 +156,68 @@ def server_mode(args):
 
     Returns: None
     """
+    import common.engine as engine
+
+    # Server-only modules are left out of the client's startup
+    from common.profiling import Tracer
+    from server.peers import PeerRegistry
+    from server.sessions import SessionRegistry
+
+    with_defaults(
+        args,
+        stream_window=engine.DEFAULT_STREAM_WINDOW,
+        connection_budget=engine.DEFAULT_CONNECTION_BUDGET,
+        session_timeout=engine.DEFAULT_SESSION_TIMEOUT,
+    )
     listen_address = args.listen
     listen_port = args.port
     cert_file = args.cert_file
     key_file = args.key_file
 
-    server_config = engine.build_server_quic_config(cert_file, key_file)
-    asyncio.run(engine.run_server(listen_address, listen_port, server_config))
+    server_config = engine.build_server_quic_config(
+        cert_file, key_file, args.stream_window
+    )
+    scope = {
+        "peer_registry": PeerRegistry(),
+        "connection_budget": args.connection_budget,
+        "session_timeout": args.session_timeout,
+    }
+    session_options = {"path": args.session_snapshot}
+    if args.session_ttl is not None:
+        session_options["ttl"] = args.session_ttl
+    scope["session_registry"] = SessionRegistry(**session_options)
+    if args.trace or args.profile_rate:
+        scope["tracer"] = Tracer(args.trace, args.profile_rate, args.profile_dir)
+    asyncio.run(engine.run_server(listen_address, listen_port, server_config, scope))
+
+
+def relay_mode(args):
+    """
+    Run the caching relay between devices and the origin server.
+
+    Args:
+        args (argparse.Namespace): The command-line arguments.
+
+    Returns: None
+    """
+    import common.engine as engine
+
+    origin, origin_port = parse_address(args.origin)
+    server_config = engine.build_server_quic_config(args.cert_file, args.key_file)
+    client_config = engine.build_client_quic_config(args.cert_file)
+    asyncio.run(
+        engine.run_relay(
+            args.listen,
+            args.port,
+            server_config,
+            origin,
+            origin_port,
+            client_config,
+            args.cache_dir,
+            args.cache_size,
+            args.refresh,
+        )
+    )
 
 
 def parse_args():
@@ -64,6 +245,70 @@ def parse_args():
         default="./certs/quic_certificate.pem",
         help="Certificate file (for self signed certs)",
     )
+    client_parser.add_argument(
+        "-o",
+        "--save-path",
+        default="./client/firmware/firmware.bin",
+        help="Where to install the received firmware",
+    )
+    client_parser.add_argument(
+        "--peer-credentials",
+        metavar="DIR",
+        default="./client/peer",
+        help="Directory with the device's own certificate and key for serving "
+        "peers, generated on first use",
+    )
+    client_parser.add_argument(
+        "--slots",
+        metavar="DIR",
+        help="Install A/B style into slot files in DIR instead of --save-path",
+    )
+    client_parser.add_argument(
+        "--use-peers",
+        action="store_true",
+        help="Fetch the image from peers hinted by the server",
+    )
+    client_parser.add_argument(
+        "--serve-peers",
+        metavar="HOST:PORT",
+        help="After updating, serve the image to peers on this address",
+    )
+    client_parser.add_argument(
+        "--transfer",
+        choices=[pdu.TRANSFER_STREAM, pdu.TRANSFER_DATAGRAM_FEC],
+        default=pdu.TRANSFER_STREAM,
+        help="Transfer mode to request; datagram-fec suits lossy links",
+    )
+    client_parser.add_argument(
+        "--stream-window",
+        type=int,
+        help="Flow control window of each receive stream in bytes",
+    )
+    client_parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running and check for updates every --interval seconds",
+    )
+    client_parser.add_argument(
+        "--interval",
+        type=float,
+        help="Seconds between update checks in daemon mode",
+    )
+    client_parser.add_argument(
+        "--ticket-cache",
+        metavar="FILE",
+        help="Keep TLS session tickets in FILE to resume sessions on the next run",
+    )
+    client_parser.add_argument(
+        "--timing",
+        action="store_true",
+        help="Print import time and time to first byte",
+    )
+    client_parser.add_argument(
+        "--device-id",
+        help="Identify the device to the server, so an interrupted transfer "
+        "into --slots can be resumed",
+    )
 
     server_parser = subparsers.add_parser("server")
     server_parser.add_argument(
@@ -84,6 +329,87 @@ def parse_args():
     server_parser.add_argument(
         "-p", "--port", type=int, default=4433, help="Port to listen on"
     )
+    server_parser.add_argument(
+        "--stream-window",
+        type=int,
+        help="Flow control window of each receive stream in bytes",
+    )
+    server_parser.add_argument(
+        "--connection-budget",
+        type=int,
+        help="Bytes a connection may buffer before flow control credit is withheld",
+    )
+    server_parser.add_argument(
+        "--session-timeout",
+        type=float,
+        help="Seconds to wait for a device's next message before closing the connection",
+    )
+    server_parser.add_argument(
+        "--session-ttl",
+        type=float,
+        help="Seconds an interrupted transfer stays resumable (default: one day)",
+    )
+    server_parser.add_argument(
+        "--session-snapshot",
+        metavar="FILE",
+        help="Keep resumable device sessions in FILE across restarts",
+    )
+    server_parser.add_argument(
+        "--trace", metavar="FILE", help="Append per-connection trace spans to FILE"
+    )
+    server_parser.add_argument(
+        "--profile-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of connections to run the sampling profiler on",
+    )
+    server_parser.add_argument(
+        "--profile-dir",
+        default="./profiles",
+        help="Directory for folded stack files of profiled connections",
+    )
+
+    relay_parser = subparsers.add_parser("relay")
+    relay_parser.add_argument(
+        "-c",
+        "--cert-file",
+        default="./certs/quic_certificate.pem",
+        help="Certificate file (for self signed certs)",
+    )
+    relay_parser.add_argument(
+        "-k",
+        "--key-file",
+        default="./certs/quic_private_key.pem",
+        help="Key file (for self signed certs)",
+    )
+    relay_parser.add_argument(
+        "-l", "--listen", default="localhost", help="Address to listen on"
+    )
+    relay_parser.add_argument(
+        "-p", "--port", type=int, default=4434, help="Port to listen on"
+    )
+    relay_parser.add_argument(
+        "-o",
+        "--origin",
+        default="localhost:4433",
+        metavar="HOST:PORT",
+        help="Origin server to fetch images from",
+    )
+    relay_parser.add_argument(
+        "--cache-dir", default="./relay/cache", help="Directory for cached images"
+    )
+    relay_parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=256 * 1024 * 1024,
+        help="Size limit for cached images in bytes",
+    )
+    relay_parser.add_argument(
+        "--refresh",
+        type=float,
+        default=60.0,
+        help="Seconds before asking the origin for a newer image",
+    )
 
     return parser.parse_args()
 
@@ -94,5 +420,7 @@ if __name__ == "__main__":
         client_mode(args)
     elif args.mode == "server":
         server_mode(args)
+    elif args.mode == "relay":
+        relay_mode(args)
     else:
         print("Invalid mode")
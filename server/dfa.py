@@ -1,16 +1,28 @@
 import asyncio
-from typing import Tuple
+import secrets
+import time
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
+import common.fec as fec
 import common.pdu as pdu
 from common.custom_exceptions import (
     IncompatibleFirmwareVersion,
     IncompatibleProtocolVersion,
+    RepairLimitExceeded,
 )
-from common.data_processor import DataSegmenter
+from common.fec import ReedSolomon
 from common.pdu import Datagram
+from common.peer_credentials import MAX_CERT_LEN
 from common.quic import QuicConnection, QuicStreamEvent
+from server.images import FileImageSource
+from server.sessions import DeviceSession
 from server.version import ServerVer
 
+DEFAULT_FIRMWARE_PATH = "./server/firmware/firmware.bin"
+SEGMENT_LEN = 512
+# MAX_REPAIR_ROUNDS: Repair requests answered per FEC transfer before the session is closed.
+MAX_REPAIR_ROUNDS = 16
+
 
 class ServerState:
     """Base class for server state."""
@@ -37,16 +49,73 @@ class AwaitingVerExchangeState(ServerState):
             else:
                 raise IncompatibleProtocolVersion()
 
-            if dgram_in.firmware_ver < ServerVer.firmware:
+            options = pdu.decode_options(dgram_in.payload)
+            device_id = options.get("device_id")
+            # Only devices that identify themselves are handed resume tokens
+            if isinstance(device_id, str):
+                self.server.device_id = device_id
+            self._accept_peer_options(options)
+            session = await self._resumable_session(options)
+            if session is not None:
+                await self._resume(event, session, options["resume"]["offset"])
+                return
+
+            image = self.server.image = await self.server.image_source.open()
+            if dgram_in.firmware_ver < image.firmware_ver:
                 print("\tFirmware version match")
             else:
                 raise IncompatibleFirmwareVersion()
 
-            # Send version ack
+            # Send version ack with the image hash and, if asked, peer hints
+            ack_options = {"sha256": image.sha256, "size": image.size}
+            registry = self.server.scope.get("peer_registry")
+            if registry is not None:
+                # The device reports the hints it could not fetch from by
+                # their tokens, so it cannot report peers it was not handed
+                failed = _hint_tokens(options.get("failed_peers"), registry.max_hints)
+                for token in failed:
+                    registry.report_failed(token)
+                if options.get("use_peers"):
+                    ack_options["peers"] = registry.hints(
+                        image.sha256, exclude=self.server.peer_address
+                    )
+
+            # Use the datagram transfer mode if both sides support it
+            if (
+                pdu.TRANSFER_DATAGRAM_FEC in options.get("transfer", ())
+                and self.server.conn.send_datagram is not None
+                and self.server.scope.get("datagram_fec", True)
+            ):
+                self.server.transfer = pdu.TRANSFER_DATAGRAM_FEC
+                ack_options["transfer"] = pdu.TRANSFER_DATAGRAM_FEC
+                ack_options["fec"] = {
+                    "block_len": self.server.fec_block_len,
+                    "symbol_len": SEGMENT_LEN,
+                }
+
+            # Remember the session under a fresh token, so the device can
+            # resume it if the connection drops. Only the device that was
+            # handed the token can resume or end the session.
+            sessions = self.server.scope.get("session_registry")
+            if sessions is not None and self.server.device_id:
+                token = self.server.resume_token = secrets.token_urlsafe(16)
+                sessions.put(
+                    token,
+                    DeviceSession(
+                        image.sha256,
+                        image.firmware_ver,
+                        image.size,
+                        self.server.transfer,
+                        image=image,
+                    ),
+                )
+                ack_options["resume_token"] = token
+
             dgram_out = Datagram(
                 mtype=pdu.MSG_TYPE_VERSION_ACK,
+                payload=pdu.encode_options(ack_options),
                 protocol_ver=ServerVer.protocol,
-                firmware_ver=ServerVer.firmware,
+                firmware_ver=image.firmware_ver,
             )
             response_event = QuicStreamEvent(
                 event.stream_id, dgram_out.to_bytes(), True
@@ -54,6 +123,73 @@ class AwaitingVerExchangeState(ServerState):
             self.server.set_state(SendingState(self.server))
             await self.server.conn.send(response_event)
 
+    def _accept_peer_options(self, options: Dict) -> None:
+        # A device that offers to serve peers sends its own certificate, which
+        # is handed out with its address
+        addresses = _peer_addresses([options.get("serve_peers")])
+        cert = options.get("peer_cert")
+        if addresses and isinstance(cert, str) and len(cert) <= MAX_CERT_LEN:
+            self.server.peer_address = addresses[0]
+            self.server.peer_cert = cert
+
+    async def _resumable_session(self, options: Dict) -> Optional[DeviceSession]:
+        sessions = self.server.scope.get("session_registry")
+        resume = options.get("resume")
+        if (
+            sessions is None
+            or not self.server.device_id
+            or not isinstance(resume, dict)
+        ):
+            return None
+        # A malformed offer, or one without the token the session was
+        # handed out with, gets a full transfer
+        offset = resume.get("offset")
+        token = resume.get("token")
+        if not isinstance(offset, int) or offset < 0 or not isinstance(token, str):
+            return None
+        session = sessions.get(token)
+        if session is None or session.sha256 != resume.get("sha256"):
+            return None
+
+        # Sessions restored from a snapshot only know the image by its hash
+        if session.image is None:
+            image = await self.server.image_source.open()
+            if image.sha256 != session.sha256:
+                return None
+            session.image = image
+        self.server.resume_token = token
+        return session
+
+    async def _resume(
+        self, event: QuicStreamEvent, session: DeviceSession, offset: int
+    ) -> None:
+        # Continue in stream mode from the last whole segment the device holds,
+        # without waiting for another request. The ack opens the data stream,
+        # so no segment can overtake it.
+        image = self.server.image = session.image
+        session.acked_segment = min(offset, image.size) // SEGMENT_LEN
+        print(f"\tResuming transfer at segment {session.acked_segment}")
+
+        ack_options = {
+            "sha256": image.sha256,
+            "size": image.size,
+            "resume": session.acked_segment * SEGMENT_LEN,
+        }
+        dgram_out = Datagram(
+            mtype=pdu.MSG_TYPE_VERSION_ACK,
+            payload=pdu.encode_options(ack_options),
+            protocol_ver=ServerVer.protocol,
+            firmware_ver=image.firmware_ver,
+        )
+        stream_id = event.stream_id + 1
+        await self.server.conn.send(
+            QuicStreamEvent(stream_id, dgram_out.to_bytes(), False)
+        )
+
+        state = SendingState(self.server)
+        self.server.set_state(state)
+        await state.resume(stream_id, session.acked_segment)
+
 
 class SendingState(ServerState):
     """
@@ -66,32 +202,169 @@ class SendingState(ServerState):
         stream_id = event.stream_id + 1
 
         if dgram_in.mtype == pdu.MSG_TYPE_REQUEST_UPDATE:
-            await self._send_firmware(stream_id)
+            if self.server.transfer == pdu.TRANSFER_DATAGRAM_FEC:
+                # The client's ACK arrives on the control stream that carried
+                # the repair requests
+                ack_event = await self._send_firmware_fec(stream_id)
+                self._finish_transfer()
+                await self.server.handle_incoming_event(ack_event)
+            else:
+                await self._send_firmware(stream_id)
+                self._finish_transfer()
 
-    async def _send_firmware(
-        self, stream_id: int, firmware_path: str = "./server/firmware/firmware.bin"
-    ) -> None:
+    async def resume(self, stream_id: int, start_segment: int) -> None:
+        """
+        Send the image from ``start_segment`` on, for a resumed session.
+        """
+        await self._send_firmware(stream_id, start_segment)
+        self._finish_transfer()
+
+    async def _send_firmware(self, stream_id: int, start_segment: int = 0) -> None:
         print("Request for firmware update received")
-        data_segmenter = DataSegmenter(firmware_path)
-        segments: Tuple[int, bytes] = data_segmenter.get_segments()
-
-        # Send the first n-1 segments
-        total_segments = len(segments) - 1
-        for segment_num, segment_data in segments[:-1]:
-            dgram_out = Datagram(pdu.MSG_TYPE_START_SND_DATA, segment_data)
-            response_event = QuicStreamEvent(stream_id, dgram_out.to_bytes(), False)
-            await self.server.conn.send(response_event)
-            print(f"Segment {segment_num:2d}/{total_segments} sent")
-            await asyncio.sleep(0)  # awaitable that doesn't block
+        image = self.server.image
+        total_segments = -(-image.size // SEGMENT_LEN) - 1
+
+        # Send each segment once the next one is known, so the last segment can
+        # be flagged even when the image is still arriving (e.g. on a relay)
+        trace = self.server.scope.get("trace")
+        start = time.perf_counter()
+        segment_num = start_segment - 1
+        previous = None
+        offset = start_segment * SEGMENT_LEN
+        async for segment_data in image.segments(SEGMENT_LEN, offset):
+            if previous is None and trace is not None:
+                trace.record("segmentation", start, image.size)
+            if previous is not None:
+                await self._send_segment(
+                    stream_id, pdu.MSG_TYPE_START_SND_DATA, previous, False
+                )
+                print(f"Segment {segment_num:2d}/{total_segments} sent")
+                await asyncio.sleep(0)  # awaitable that doesn't block
+            segment_num += 1
+            previous = segment_data
 
         # send last segment
-        dgram_out = Datagram(pdu.MSG_TYPE_FINISH_SND_DATA, segments[-1][1])
-        response_event = QuicStreamEvent(stream_id, dgram_out.to_bytes(), True)
-        await self.server.conn.send(response_event)
-        print(f"Segment {segments[-1][0]:2d}/{total_segments} sent")
+        await self._send_segment(
+            stream_id, pdu.MSG_TYPE_FINISH_SND_DATA, previous or b"", True
+        )
+        print(f"Segment {segment_num:2d}/{total_segments} sent")
+
+    async def _send_firmware_fec(self, stream_id: int) -> QuicStreamEvent:
+        print("Request for firmware update received (datagram FEC)")
+        code = ReedSolomon(self.server.fec_block_len)
+        repair_len = self.server.fec_repair_len
+
+        # Send each block's source symbols followed by its repair symbols as
+        # unreliable datagrams. The zero padding of the last block is implied.
+        block_count = 0
+        async for block_num, block, source_len in self._read_blocks(code):
+            for index in range(source_len):
+                await self._send_symbol(code, block_num, block, index)
+            for index in range(code.k, code.k + repair_len):
+                await self._send_symbol(code, block_num, block, index)
+            block_count += 1
+        print(f"{block_count} FEC blocks sent")
+
+        # Answer repair requests until the client has rebuilt every block.
+        # Each repair symbol of a block is sent at most once, which with the
+        # round limit bounds what a device can make the server send.
+        next_repair = [code.k + repair_len] * block_count
+        rounds = 0
+        while True:
+            await self._send_segment(
+                stream_id, pdu.MSG_TYPE_FINISH_SND_DATA, b"", False
+            )
+            event = await self.server.conn.receive()
+            dgram_in = Datagram.from_bytes(event.data)
+            if dgram_in.mtype != pdu.MSG_TYPE_REPAIR_REQUEST:
+                return event
+
+            rounds += 1
+            requested = _repair_request(
+                pdu.decode_options(dgram_in.payload), block_count, code.k
+            )
+            print(f"Repair requested for {len(requested)} block(s)")
+            # Repair symbols get lost too, so add the same share of repair as
+            # the block itself had, rather than another round
+            counts = {
+                block_num: -(-needed * (code.k + repair_len) // code.k)
+                for block_num, needed in requested.items()
+            }
+            if rounds > MAX_REPAIR_ROUNDS or any(
+                next_repair[block_num] + count > fec.MAX_SYMBOLS
+                for block_num, count in counts.items()
+            ):
+                raise RepairLimitExceeded()
+            if not requested:
+                continue
+            # Blocks are read again rather than kept for the whole transfer
+            async for block_num, block, _ in self._read_blocks(code, requested):
+                for _ in range(counts[block_num]):
+                    await self._send_symbol(
+                        code, block_num, block, next_repair[block_num]
+                    )
+                    next_repair[block_num] += 1
+
+    async def _read_blocks(
+        self, code: ReedSolomon, wanted: Optional[Dict[int, int]] = None
+    ) -> AsyncIterator[Tuple[int, List[bytes], int]]:
+        """
+        Read the image one FEC block at a time, padding the last block with
+        zeros. If ``wanted`` is given, only the blocks it holds are read.
+
+        Yields:
+            Tuple[int, List[bytes], int]: The block number, its ``k`` symbols
+                and how many of them hold image data.
+        """
+        block_num = min(wanted) if wanted else 0
+        last = max(wanted) if wanted else None
+        block: List[memoryview] = []
+        offset = block_num * code.k * SEGMENT_LEN
+        async for segment_data in self.server.image.segments(SEGMENT_LEN, offset):
+            block.append(segment_data)
+            if len(block) < code.k:
+                continue
+            if wanted is None or block_num in wanted:
+                yield block_num, _symbols(block, code.k), code.k
+            if block_num == last:
+                return
+            block_num += 1
+            block = []
+        if block and (wanted is None or block_num in wanted):
+            yield block_num, _symbols(block, code.k), len(block)
+
+    async def _send_symbol(
+        self, code: ReedSolomon, block_num: int, block: List[bytes], index: int
+    ) -> None:
+        # Datagrams are queued by reference, so each one gets its own bytes
+        symbol = block[index] if index < code.k else code.repair_symbol(block, index)
+        await self.server.conn.send_datagram(
+            fec.SYMBOL_HEADER.pack(block_num, index) + symbol
+        )
+        await asyncio.sleep(0)  # awaitable that doesn't block
+
+    def _finish_transfer(self) -> None:
         # Set the state to AwaitingAckState
         self.server.set_state(AwaitingAckState(self.server))
 
+    async def _send_segment(
+        self, stream_id: int, mtype: int, segment_data: memoryview, end_stream: bool
+    ) -> None:
+        # Encode into a pooled buffer; the transport copies the bytes into its
+        # own send buffer, so the buffer can be reused once send returns.
+        trace = self.server.scope.get("trace")
+        start = time.perf_counter() if trace is not None else 0.0
+        dgram_out = Datagram(mtype, segment_data)
+        buffer = pdu.buffer_pool.acquire(dgram_out.encoded_len())
+        length = dgram_out.encode_into(buffer)
+        if trace is not None:
+            trace.record("encode", start, length)
+        response_event = QuicStreamEvent(
+            stream_id, memoryview(buffer)[:length], end_stream
+        )
+        await self.server.conn.send(response_event)
+        pdu.buffer_pool.release(buffer)
+
 
 class AwaitingAckState(ServerState):
     """
@@ -101,20 +374,109 @@ class AwaitingAckState(ServerState):
     async def handle_incoming_event(self, event: QuicStreamEvent):
         dgram_in = Datagram.from_bytes(event.data)
 
-        if dgram_in.mtype == pdu.MSG_TYPE_RECEIVE_ACK:
+        if dgram_in.mtype in (pdu.MSG_TYPE_SEND_ACK, pdu.MSG_TYPE_RECEIVE_ACK):
             print("Received ACK from client")
+            # Nothing left to resume
+            sessions = self.server.scope.get("session_registry")
+            if sessions is not None and self.server.resume_token:
+                sessions.remove(self.server.resume_token)
+
+            # The device verified and installed the image, so it can serve it
+            # if it opted in
+            registry = self.server.scope.get("peer_registry")
+            if registry is not None and self.server.peer_address:
+                registry.add(
+                    self.server.image.sha256,
+                    self.server.peer_address,
+                    self.server.peer_cert,
+                )
+            self.server.set_state(AwaitingVerExchangeState(self.server))
+        elif dgram_in.mtype == pdu.MSG_TYPE_ERROR:
+            reason = bytes(dgram_in.payload).decode("utf-8", "replace")
+            print(f"Client rejected the image: {reason}")
+            # What the device holds is corrupt, so it starts over next time
+            # and is not handed out as a peer
+            sessions = self.server.scope.get("session_registry")
+            if sessions is not None and self.server.resume_token:
+                sessions.remove(self.server.resume_token)
             self.server.set_state(AwaitingVerExchangeState(self.server))
 
 
 class ServerContext:
     """Context class for the server state machine."""
 
-    def __init__(self, conn: QuicConnection):
+    def __init__(self, conn: QuicConnection, scope: Optional[Dict] = None):
         self.conn = conn
+        self.scope = scope if scope is not None else {}
+        self.image_source = self.scope.get("image_source") or FileImageSource(
+            self.scope.get("firmware_path", DEFAULT_FIRMWARE_PATH),
+            self.scope.get("firmware_ver", ServerVer.firmware),
+        )
+        self.image = None
+        self.transfer: str = pdu.TRANSFER_STREAM
+        self.fec_block_len: int = self.scope.get("fec_block_len", fec.DEFAULT_BLOCK_LEN)
+        self.fec_repair_len: int = self.scope.get(
+            "fec_repair_len", fec.DEFAULT_REPAIR_LEN
+        )
+        self.peer_address: Optional[tuple] = None
+        self.peer_cert: Optional[str] = None
+        self.device_id: Optional[str] = None
+        self.resume_token: Optional[str] = None
         self.state = AwaitingVerExchangeState(self)
 
     def set_state(self, state: ServerState):
         self.state = state
 
     async def handle_incoming_event(self, event: QuicStreamEvent):
+        trace = self.scope.get("trace")
+        if trace is None:
+            await self.state.handle_incoming_event(event)
+            return
+
+        start = time.perf_counter()
+        state_name = type(self.state).__name__
         await self.state.handle_incoming_event(event)
+        trace.record(state_name, start, len(event.data))
+
+
+def _symbols(segments: List[memoryview], block_len: int) -> List[bytes]:
+    # A block's source symbols, zero padded to full length and block size
+    symbols = [bytes(segment).ljust(SEGMENT_LEN, b"\0") for segment in segments]
+    return symbols + [bytes(SEGMENT_LEN)] * (block_len - len(symbols))
+
+
+def _repair_request(options, block_count: int, block_len: int) -> Dict[int, int]:
+    # Symbols a device still needs per block, skipping malformed entries and
+    # capping each at the block length, the most a block can need
+    blocks = options.get("blocks") if isinstance(options, dict) else None
+    requested = {}
+    for block_num, needed in (blocks if isinstance(blocks, dict) else {}).items():
+        try:
+            block_num = int(block_num)
+        except ValueError:
+            continue
+        if 0 <= block_num < block_count and isinstance(needed, int) and needed > 0:
+            requested[block_num] = min(needed, block_len)
+    return requested
+
+
+def _hint_tokens(value, max_tokens: int) -> List[str]:
+    # Device-supplied hint tokens, skipping malformed ones. A device is handed
+    # at most ``max_tokens`` hints at a time, so it reports no more.
+    if not isinstance(value, list):
+        return []
+    return [token for token in value[:max_tokens] if isinstance(token, str)]
+
+
+def _peer_addresses(value) -> List[tuple]:
+    # Device-supplied (host, port) pairs, skipping malformed ones
+    addresses = []
+    for address in value or ():
+        if (
+            isinstance(address, list)
+            and len(address) == 2
+            and isinstance(address[0], str)
+            and isinstance(address[1], int)
+        ):
+            addresses.append((address[0], address[1]))
+    return addresses
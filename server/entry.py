@@ -4,7 +4,7 @@ from typing import Coroutine, Dict
 
 import common.pdu as pdu
 from common.quic import QuicConnection, QuicStreamEvent
-from server.dfa import ServerContext
+from server.dfa import AwaitingAckState, SendingState, ServerContext
 
 
 async def run(scope: Dict, conn: QuicConnection):
@@ -21,12 +21,19 @@ async def run(scope: Dict, conn: QuicConnection):
     Returns: None
     """
 
-    server: ServerContext = ServerContext(conn=conn)
+    server: ServerContext = ServerContext(conn=conn, scope=scope)
 
     # Start the server and wait for the version exchange
     event_ver_ex: QuicStreamEvent = await conn.receive()
     await server.handle_incoming_event(event=event_ver_ex)
 
-    # Wait for the request for the firmware update and send data
-    event_fw_update: QuicStreamEvent = await conn.receive()
-    await server.handle_incoming_event(event=event_fw_update)
+    # Wait for the request for the firmware update and send data, unless a
+    # resumed session already sent it
+    if isinstance(server.state, SendingState):
+        event_fw_update: QuicStreamEvent = await conn.receive()
+        await server.handle_incoming_event(event=event_fw_update)
+
+    # Wait for the client's ACK, so it does not arrive after the session ended
+    if isinstance(server.state, AwaitingAckState):
+        event_ack: QuicStreamEvent = await conn.receive()
+        await server.handle_incoming_event(event=event_ack)
@@ -0,0 +1,94 @@
+import hashlib
+import os
+from typing import AsyncIterator
+
+from common.data_processor import image_digest
+
+
+class FileImage:
+    """
+    Firmware image stored in a local file.
+
+    Args:
+        path (str): The path to the image file.
+        firmware_ver (str): The firmware version of the image.
+    """
+
+    def __init__(self, path: str, firmware_ver: str):
+        self.path = path
+        self.firmware_ver = firmware_ver
+        self.sha256 = image_digest(path)
+        self.size = os.path.getsize(path)
+
+    async def segments(
+        self, segment_len: int = 512, offset: int = 0
+    ) -> AsyncIterator[memoryview]:
+        """
+        Iterate over the image in segments of ``segment_len`` bytes, starting
+        at ``offset``. Segments are read from the file as they are asked for,
+        so a caller that stops early reads no further.
+        """
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            while True:
+                segment_data = f.read(segment_len)
+                if not segment_data:
+                    return
+                yield memoryview(segment_data)
+
+
+class FileImageSource:
+    """
+    Image source serving a single local firmware file.
+
+    An image source hands each server connection the image to send. Any object
+    with an ``open`` coroutine returning something with ``firmware_ver``,
+    ``sha256``, ``size`` and a ``segments(segment_len, offset)`` async
+    iterator will do.
+    """
+
+    def __init__(self, path: str, firmware_ver: str):
+        self.path = path
+        self.firmware_ver = firmware_ver
+
+    async def open(self) -> FileImage:
+        return FileImage(self.path, self.firmware_ver)
+
+
+class MemoryImage:
+    """
+    Firmware image held in memory.
+
+    Args:
+        data (bytes): The image.
+        firmware_ver (str): The firmware version of the image.
+    """
+
+    def __init__(self, data: bytes, firmware_ver: str):
+        self.data = data
+        self.firmware_ver = firmware_ver
+        self.sha256 = hashlib.sha256(data).hexdigest()
+        self.size = len(data)
+
+    async def segments(
+        self, segment_len: int = 512, offset: int = 0
+    ) -> AsyncIterator[memoryview]:
+        """
+        Iterate over the image in segments of ``segment_len`` bytes, starting
+        at ``offset``.
+        """
+        view = memoryview(self.data)
+        for start in range(offset, len(view), segment_len):
+            yield view[start : start + segment_len]
+
+
+class MemoryImageSource:
+    """
+    Image source serving a single in-memory image, e.g. for simulated sessions.
+    """
+
+    def __init__(self, data: bytes, firmware_ver: str):
+        self.image = MemoryImage(data, firmware_ver)
+
+    async def open(self) -> MemoryImage:
+        return self.image
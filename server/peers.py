@@ -0,0 +1,139 @@
+import secrets
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+PeerAddress = Tuple[str, int]
+
+# A peer hint: host, port, the PEM certificate the peer serves with and the
+# token a device quotes to report that it could not fetch from the peer.
+PeerHint = Tuple[str, int, str, str]
+
+# DEFAULT_PEER_TTL: Seconds a device is handed out as a peer after it reported
+# holding an image. Devices that keep serving register again on their next check.
+DEFAULT_PEER_TTL = 15 * 60.0
+
+# DEFAULT_FAILURE_REPORTS: Failure reports, each quoting a different hint, after
+#   which a peer is no longer handed out.
+# MAX_HINT_TOKENS: Tokens of handed out hints kept for failure reports; the
+#   oldest are forgotten first.
+DEFAULT_FAILURE_REPORTS = 2
+MAX_HINT_TOKENS = 65536
+
+
+class PeerRegistry:
+    """
+    Tracks devices that hold a given firmware image and can serve it to peers.
+
+    Peers are keyed by image hash. Each image keeps at most ``max_peers``
+    addresses, with the most recently updated devices handed out first.
+    Entries expire after ``ttl`` seconds.
+
+    Every hint carries a single-use token. A device that could not fetch from
+    a peer reports the hint's token with ``report_failed``, so devices can
+    only report peers they were handed, and a peer is dropped once
+    ``failure_reports`` hints of it were reported.
+    """
+
+    def __init__(
+        self,
+        max_peers: int = 32,
+        max_hints: int = 3,
+        ttl: float = DEFAULT_PEER_TTL,
+        failure_reports: int = DEFAULT_FAILURE_REPORTS,
+    ):
+        self.max_peers = max_peers
+        self.max_hints = max_hints
+        self.ttl = ttl
+        self.failure_reports = failure_reports
+        self.peers: Dict[str, "OrderedDict[PeerAddress, Tuple[str, float]]"] = {}
+        self.tokens: "OrderedDict[str, Tuple[str, PeerAddress, float]]" = OrderedDict()
+        self.failures: Dict[Tuple[str, PeerAddress], int] = {}
+
+    def add(self, image_hash: str, address: PeerAddress, cert: str) -> None:
+        """
+        Register a device as a source for an image.
+
+        Args:
+            image_hash (str): The SHA-256 hex digest of the image.
+            address (PeerAddress): The (host, port) the device serves on.
+            cert (str): The PEM certificate the device serves with.
+        """
+        peers = self.peers.setdefault(image_hash, OrderedDict())
+        peers[address] = (cert, time.time() + self.ttl)
+        peers.move_to_end(address, last=False)
+        # Failures reported before the device installed the image again are moot
+        self.failures.pop((image_hash, address), None)
+        while len(peers) > self.max_peers:
+            dropped, _ = peers.popitem()
+            self.failures.pop((image_hash, dropped), None)
+
+    def remove(self, image_hash: str, address: PeerAddress) -> None:
+        """
+        Forget a device, e.g. after clients failed to fetch from it.
+        """
+        self.failures.pop((image_hash, address), None)
+        peers = self.peers.get(image_hash)
+        if peers is None:
+            return
+        peers.pop(address, None)
+        if not peers:
+            del self.peers[image_hash]
+
+    def report_failed(self, token: str) -> bool:
+        """
+        Count a device's report that it could not fetch from a hinted peer.
+
+        Args:
+            token (str): The token of the hint the device was handed.
+
+        Returns:
+            bool: Whether the report counted, i.e. the token was handed out,
+                has not expired and was not reported before.
+        """
+        entry = self.tokens.pop(token, None)
+        if entry is None:
+            return False
+        image_hash, address, expires = entry
+        if expires < time.time():
+            return False
+
+        key = (image_hash, address)
+        self.failures[key] = self.failures.get(key, 0) + 1
+        if self.failures[key] >= self.failure_reports:
+            self.remove(image_hash, address)
+        return True
+
+    def hints(
+        self, image_hash: str, exclude: Optional[PeerAddress] = None
+    ) -> List[PeerHint]:
+        """
+        Get peer hints for an image.
+
+        Args:
+            image_hash (str): The SHA-256 hex digest of the image.
+            exclude (Optional[PeerAddress]): The requesting device's own address.
+
+        Returns:
+            List[PeerHint]: Up to ``max_hints`` peers with their certificates
+                and hint tokens.
+        """
+        peers = self.peers.get(image_hash)
+        if not peers:
+            return []
+
+        now = time.time()
+        hints = []
+        expired = []
+        for address, (cert, expires) in peers.items():
+            if expires < now:
+                expired.append(address)
+            elif address != exclude and len(hints) < self.max_hints:
+                token = secrets.token_urlsafe(12)
+                self.tokens[token] = (image_hash, address, expires)
+                hints.append((address[0], address[1], cert, token))
+        for address in expired:
+            self.remove(image_hash, address)
+        while len(self.tokens) > MAX_HINT_TOKENS:
+            self.tokens.popitem(last=False)
+        return hints
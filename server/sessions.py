@@ -0,0 +1,249 @@
+import asyncio
+import csv
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# DEFAULT_MAX_SESSIONS: Device sessions kept before the least recently used ones are dropped.
+# DEFAULT_SESSION_TTL: Seconds a device session stays resumable.
+# DEFAULT_SNAPSHOT_INTERVAL: Seconds between snapshots of the registry to disk.
+DEFAULT_MAX_SESSIONS = 1_000_000
+DEFAULT_SESSION_TTL = 24 * 3600.0
+DEFAULT_SNAPSHOT_INTERVAL = 60.0
+
+# SNAPSHOT_VERSION: Format of the snapshot file, given in its header line.
+SNAPSHOT_VERSION = 3
+
+
+class DeviceSession:
+    """
+    What the server remembers about a device's transfer.
+
+    Args:
+        sha256 (str): Hash of the image being sent.
+        firmware_ver (str): Firmware version of the image.
+        size (int): Size of the image in bytes.
+        transfer (str): The negotiated transfer mode.
+        acked_segment (int): Segments the device confirmed to hold.
+        image: The image object, None if the session was restored from disk.
+    """
+
+    __slots__ = (
+        "sha256",
+        "firmware_ver",
+        "size",
+        "transfer",
+        "acked_segment",
+        "expires",
+        "image",
+    )
+
+    def __init__(
+        self,
+        sha256: str,
+        firmware_ver: str,
+        size: int,
+        transfer: str,
+        acked_segment: int = 0,
+        image=None,
+    ):
+        self.sha256 = sha256
+        self.firmware_ver = firmware_ver
+        self.size = size
+        self.transfer = transfer
+        self.acked_segment = acked_segment
+        self.expires = 0.0
+        self.image = image
+
+
+class SessionRegistry:
+    """
+    Registry of transfer sessions, so a device that reconnects mid-transfer
+    can resume without negotiating again.
+
+    Sessions are keyed by a resume token the server hands to the device with
+    the version ack. Device IDs are self-reported, so only the token proves
+    that a device may resume a session.
+
+    Sessions live in an LRU map with O(1) lookups. Expired sessions are
+    dropped when looked up, and the least recently used ones once there are
+    more than ``max_sessions``. If ``path`` is given, the registry is restored
+    from it and written back every ``snapshot_interval`` seconds, in a worker
+    thread. Snapshots hold everything but the image objects, which are looked
+    up again on resume. The images are listed once in a JSON header line,
+    followed by a CSV row per session with the resume token, the image's index,
+    the acked segments and the expiry time.
+
+    Args:
+        max_sessions (int): Number of sessions to keep.
+        ttl (float): Seconds a session stays resumable.
+        path (Optional[str]): File to snapshot the registry to.
+        snapshot_interval (float): Seconds between snapshots.
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = DEFAULT_MAX_SESSIONS,
+        ttl: float = DEFAULT_SESSION_TTL,
+        path: Optional[str] = None,
+        snapshot_interval: float = DEFAULT_SNAPSHOT_INTERVAL,
+    ):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.sessions: "OrderedDict[str, DeviceSession]" = OrderedDict()
+        self._snapshots: Optional[asyncio.Task] = None
+        if path is not None:
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def get(self, token: str) -> Optional[DeviceSession]:
+        """
+        Look up the unexpired session handed out with ``token``.
+        """
+        session = self.sessions.get(token)
+        if session is None:
+            return None
+        if session.expires < time.time():
+            del self.sessions[token]
+            return None
+        self.sessions.move_to_end(token)
+        return session
+
+    def put(self, token: str, session: DeviceSession) -> None:
+        """
+        Store or refresh the session handed out with ``token``.
+        """
+        session.expires = time.time() + self.ttl
+        self.sessions[token] = session
+        self.sessions.move_to_end(token)
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+
+        if self.path is not None and self._snapshots is None:
+            self._snapshots = asyncio.ensure_future(self._snapshot_periodically())
+
+    def remove(self, token: str) -> None:
+        """
+        Forget the session handed out with ``token``, e.g. once its transfer
+        completed.
+        """
+        self.sessions.pop(token, None)
+
+    def snapshot(self) -> None:
+        """
+        Write the unexpired sessions to ``path``, replacing the previous snapshot.
+        """
+        self._write(list(self.sessions.items()))
+
+    def _write(self, entries: List[Tuple[str, DeviceSession]]) -> None:
+        now = time.time()
+        images: Dict[tuple, int] = {}
+        for _, session in entries:
+            if session.expires >= now:
+                images.setdefault(_image_key(session), len(images))
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+            header = {"version": SNAPSHOT_VERSION, "images": list(images)}
+            f.write(json.dumps(header) + "\n")
+            csv.writer(f).writerows(_rows(entries, images, now))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        if hasattr(os, "O_DIRECTORY"):
+            # Make the replacement itself durable
+            dir_fd = os.open(
+                os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY | os.O_DIRECTORY
+            )
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def _load(self) -> None:
+        try:
+            f = open(self.path, encoding="utf-8", newline="")
+        except FileNotFoundError:
+            return
+        now = time.time()
+        skipped = 0
+        with f:
+            try:
+                header = json.loads(f.readline() or "null")
+            except ValueError:
+                header = None
+            if (
+                not isinstance(header, dict)
+                or header.get("version") != SNAPSHOT_VERSION
+                or not isinstance(header.get("images"), list)
+            ):
+                print("[server] Ignoring device sessions in an unknown format")
+                return
+            images = header["images"]
+            sessions = self.sessions
+            try:
+                for row in csv.reader(f):
+                    try:
+                        token, session = _session_from_row(row, images)
+                    except (ValueError, TypeError, IndexError):
+                        skipped += 1
+                        continue
+                    if session.expires >= now:
+                        sessions[token] = session
+            except (csv.Error, UnicodeDecodeError):
+                # A damaged file keeps the sessions read up to the damage
+                skipped += 1
+        if skipped:
+            print(f"[server] Skipped {skipped} malformed device sessions")
+        print(f"[server] Restored {len(self.sessions)} device sessions")
+
+    async def _snapshot_periodically(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            # Only copying the entries holds up the event loop; the sessions
+            # are encoded and written in a worker thread
+            await loop.run_in_executor(None, self._write, list(self.sessions.items()))
+
+
+def _image_key(session: DeviceSession) -> tuple:
+    return session.sha256, session.firmware_ver, session.size, session.transfer
+
+
+def _session_from_row(row: List[str], images: list) -> Tuple[str, DeviceSession]:
+    # Raises ValueError, TypeError or IndexError if the row or its image is malformed
+    token, index, acked_segment, expires = row
+    index, acked_segment, expires = int(index), int(acked_segment), int(expires)
+    if index < 0 or acked_segment < 0:
+        raise ValueError("Negative image index or segment")
+    sha256, firmware_ver, size, transfer = images[index]
+    if not (
+        isinstance(sha256, str)
+        and isinstance(firmware_ver, str)
+        and isinstance(size, int)
+        and isinstance(transfer, str)
+    ):
+        raise TypeError("Malformed image")
+    session = DeviceSession(sha256, firmware_ver, size, transfer, acked_segment)
+    session.expires = expires
+    return token, session
+
+
+def _rows(
+    entries: List[Tuple[str, DeviceSession]], images: Dict[tuple, int], now: float
+) -> Iterator[tuple]:
+    # Expiry times are rounded up to whole seconds
+    for token, session in entries:
+        if session.expires >= now:
+            yield (
+                token,
+                images[_image_key(session)],
+                session.acked_segment,
+                int(session.expires) + 1,
+            )
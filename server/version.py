@@ -1,3 +1,3 @@
 class ServerVer:
     firmware = "2.1.0"
-    protocol = "2.0.0"
+    protocol = "3.0.0"
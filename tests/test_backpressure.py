@@ -0,0 +1,250 @@
+import asyncio
+import functools
+import hashlib
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+import pytest
+from aioquic.asyncio import QuicConnectionProtocol, connect, serve
+from aioquic.quic.connection import QuicConnection
+
+import common.pdu as pdu
+from client.version import ClientVer
+from common import engine, flow_control, peer_credentials
+from server.images import MemoryImageSource
+
+# IMAGE_LEN: Size of the image sent to the slow device.
+# SINK_RATE: Bytes per second the device's storage writes.
+# CONNECTION_BUDGET: Bytes the device may buffer before withholding credit.
+# MAX_PEAK: Memory allowed for the transfer on both sides together.
+IMAGE_LEN = 8 * 1024 * 1024
+SINK_RATE = 4 * 1024 * 1024
+CONNECTION_BUDGET = 256 * 1024
+MAX_PEAK = 2 * 1024 * 1024
+
+# FLOOD_STREAMS: Update sessions the flooding device opens on one connection.
+# FLOOD_SECONDS: How long the device keeps flooding them.
+# FLOOD_PDU_LEN: Payload of each PDU the device floods with.
+# CLIENT_BUFFER: Unacknowledged bytes the device keeps queued per stream.
+# MAX_FLOOD_GROWTH: Peak RSS the server may gain while flooded.
+FLOOD_STREAMS = 8
+FLOOD_SECONDS = 3.0
+FLOOD_PDU_LEN = 16 * 1024
+CLIENT_BUFFER = 1024 * 1024
+MAX_FLOOD_GROWTH = 16 * 1024 * 1024
+
+
+class SlowSink:
+    """Sink that keeps nothing and blocks like slow flash storage."""
+
+    def __init__(self):
+        self.digest = hashlib.sha256()
+        self.written = 0
+
+    def open(self, firmware_ver, image_hash, size) -> bool:
+        return True
+
+    def write(self, data) -> None:
+        self.digest.update(data)
+        self.written += len(data)
+        time.sleep(len(data) / SINK_RATE)
+
+    def commit(self) -> None:
+        pass
+
+    def abort(self, error=None) -> None:
+        pass
+
+
+class ServerThread(threading.Thread):
+    """Runs the server on its own event loop, as a separate host would."""
+
+    def __init__(self, configuration, scope):
+        super().__init__(daemon=True)
+        self.configuration = configuration
+        self.scope = scope
+        self.loop = asyncio.new_event_loop()
+        self.started = threading.Event()
+        self.port = None
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        server = self.loop.run_until_complete(
+            serve(
+                "127.0.0.1",
+                0,
+                configuration=self.configuration,
+                create_protocol=functools.partial(
+                    engine.AsyncQuicServer, scope=self.scope
+                ),
+            )
+        )
+        self.port = server._transport.get_extra_info("sockname")[1]
+        self.started.set()
+        self.loop.run_forever()
+        server.close()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join()
+
+
+def test_slow_sink_keeps_memory_bounded(tmp_path):
+    cert_file, key_file, _ = peer_credentials.load_or_create(str(tmp_path))
+    image = os.urandom(IMAGE_LEN)
+    server = ServerThread(
+        engine.build_server_quic_config(cert_file, key_file),
+        {"image_source": MemoryImageSource(image, "9.0.0")},
+    )
+    server.start()
+    server.started.wait()
+
+    configuration = engine.build_client_quic_config(cert_file)
+    configuration.server_name = peer_credentials.PEER_SERVER_NAME
+    sink = SlowSink()
+    scope = {"sink": sink, "connection_budget": CONNECTION_BUDGET}
+
+    tracemalloc.start()
+    try:
+        scope = asyncio.run(
+            engine.run_client("127.0.0.1", server.port, configuration, scope)
+        )
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        server.stop()
+
+    assert scope["installed"]
+    assert sink.digest.digest() == hashlib.sha256(image).digest()
+    assert peak < MAX_PEAK
+
+
+class FloodingDevice(QuicConnectionProtocol):
+    """Device that reads nothing the server sends.
+
+    The default protocol wraps every received stream in a writer, which ends
+    the stream when it is garbage collected.
+    """
+
+    def quic_event_received(self, event) -> None:
+        pass
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Peak RSS needs the resource module")
+def test_flooding_device_keeps_server_memory_bounded(tmp_path):
+    cert_file, key_file, _ = peer_credentials.load_or_create(str(tmp_path))
+    # The server runs in its own process, so its peak RSS is its own
+    context = multiprocessing.get_context("spawn")
+    pipe, child_pipe = context.Pipe()
+    server = context.Process(
+        target=_flooded_server, args=(child_pipe, cert_file, key_file), daemon=True
+    )
+    server.start()
+    try:
+        port, baseline = pipe.recv()
+        written, accepted = asyncio.run(_flood(port, cert_file))
+        pipe.send(None)
+        peak, buffered = pipe.recv()
+    finally:
+        server.join(10.0)
+        server.kill()
+
+    # The device could have sent far more than the server took in, and the
+    # server held on to no more than the stream windows
+    window = flow_control.DEFAULT_STREAM_WINDOW
+    assert written > 10 * FLOOD_STREAMS * window
+    assert accepted <= FLOOD_STREAMS * 2 * window
+    assert buffered <= FLOOD_STREAMS * 2 * window
+    assert peak - baseline < MAX_FLOOD_GROWTH
+
+
+def _flooded_server(pipe, cert_file: str, key_file: str) -> None:
+    image = os.urandom(IMAGE_LEN)
+    protocols = []
+
+    def create_protocol(*args, **kwargs):
+        protocol = engine.AsyncQuicServer(
+            *args, scope={"image_source": MemoryImageSource(image, "9.0.0")}, **kwargs
+        )
+        protocols.append(protocol)
+        return protocol
+
+    async def main():
+        server = await serve(
+            "127.0.0.1",
+            0,
+            configuration=engine.build_server_quic_config(cert_file, key_file),
+            create_protocol=create_protocol,
+        )
+        pipe.send((server._transport.get_extra_info("sockname")[1], _peak_rss()))
+        # Serve until the device is done flooding
+        await asyncio.get_running_loop().run_in_executor(None, pipe.recv)
+        buffered = sum(protocol._budget.buffered for protocol in protocols)
+        pipe.send((_peak_rss(), buffered))
+        server.close()
+
+    # The state machines report every segment
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        asyncio.run(main())
+
+
+async def _flood(port: int, cert_file: str):
+    # A device that starts update sessions, reads none of the image and keeps
+    # sending PDUs on the request streams while the server is busy sending
+    configuration = engine.build_client_quic_config(cert_file)
+    configuration.server_name = peer_credentials.PEER_SERVER_NAME
+    loop = asyncio.get_running_loop()
+    async with connect(
+        "127.0.0.1", port, configuration=configuration, create_protocol=FloodingDevice
+    ) as client:
+        quic = client._quic
+        # Grant no credit beyond the first window, so the server's senders stall
+        flow_control.ReceiveBudget(flow_control.DEFAULT_STREAM_WINDOW, 0).install(quic)
+
+        request = (
+            pdu.Datagram(
+                pdu.MSG_TYPE_VERSION_EXCHANGE, b"", ClientVer.protocol, "0.0.0"
+            ).to_bytes()
+            + pdu.Datagram(pdu.MSG_TYPE_REQUEST_UPDATE, b"").to_bytes()
+        )
+        stream_ids = []
+        for _ in range(FLOOD_STREAMS):
+            stream_id = quic.get_next_available_stream_id()
+            quic.send_stream_data(stream_id, request)
+            stream_ids.append(stream_id)
+
+        junk = pdu.Datagram(pdu.MSG_TYPE_START_RCV_DATA, bytes(FLOOD_PDU_LEN)).to_bytes()
+        written = 0
+        deadline = loop.time() + FLOOD_SECONDS
+        while loop.time() < deadline:
+            for stream_id in stream_ids:
+                if flow_control.send_buffered(quic, stream_id) < CLIENT_BUFFER:
+                    quic.send_stream_data(stream_id, junk)
+                    written += len(junk)
+            client.transmit()
+            await asyncio.sleep(0.001)
+
+        unacknowledged = sum(
+            flow_control.send_buffered(quic, stream_id) for stream_id in stream_ids
+        )
+    return written, written - unacknowledged
+
+
+def _peak_rss() -> int:
+    import resource
+
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def test_aioquic_without_the_used_internals_is_refused(monkeypatch):
+    flow_control.check_aioquic()
+    monkeypatch.delattr(QuicConnection, "_write_stream_limits")
+    with pytest.raises(RuntimeError, match="_write_stream_limits"):
+        flow_control.check_aioquic()
@@ -0,0 +1,176 @@
+import asyncio
+import os
+import random
+
+import pytest
+
+import common.pdu as pdu
+import server.dfa as server_dfa
+import server.entry as server_entry
+from client.sinks import MemorySink
+from client.version import ClientVer
+from common import fec
+from common.custom_exceptions import RepairLimitExceeded
+from common.memory_transport import LinkProfile, connection_pair, run_session
+from common.quic import QuicStreamEvent
+from server.images import FileImage, MemoryImageSource
+
+# IMAGE_LEN: 79 segments, four full blocks and one of 15 symbols.
+IMAGE_LEN = 40_000
+
+
+def test_any_k_symbols_decode_the_block():
+    code = fec.ReedSolomon(8)
+    symbols = [os.urandom(64) for _ in range(code.k)]
+    all_symbols = {i: symbols[i] for i in range(code.k)}
+    all_symbols.update({i: code.repair_symbol(symbols, i) for i in range(8, 20)})
+
+    rng = random.Random(1)
+    for _ in range(10):
+        indices = rng.sample(sorted(all_symbols), code.k)
+        assert code.decode({i: all_symbols[i] for i in indices}) == symbols
+
+
+def test_lossy_datagram_transfer_installs_the_image():
+    image = os.urandom(IMAGE_LEN)
+    sink = MemorySink()
+    scope = {"sink": sink, "transfer": pdu.TRANSFER_DATAGRAM_FEC}
+    downlink = LinkProfile(latency=0.001, loss=0.3, reorder=0.2)
+    asyncio.run(
+        run_session(
+            {"image_source": MemoryImageSource(image, "9.0.0")},
+            scope,
+            downlink=downlink,
+            seed=7,
+        )
+    )
+    assert scope["installed"]
+    assert sink.data == image
+
+
+def test_repair_requests_are_bounded():
+    image = os.urandom(IMAGE_LEN)
+
+    async def session():
+        server, client = connection_pair()
+        serving = asyncio.ensure_future(
+            server_entry.run({"image_source": MemoryImageSource(image, "9.0.0")}, server)
+        )
+
+        stream_id = client.new_stream()
+        options = {"transfer": [pdu.TRANSFER_DATAGRAM_FEC]}
+        await client.send(
+            QuicStreamEvent(stream_id, _pdu(pdu.MSG_TYPE_VERSION_EXCHANGE, options), False)
+        )
+        await client.receive()
+        await client.send(
+            QuicStreamEvent(stream_id, _pdu(pdu.MSG_TYPE_REQUEST_UPDATE), False)
+        )
+        await client.receive()
+        assert len(await _drain(client)) == 79 + 5 * fec.DEFAULT_REPAIR_LEN
+
+        # Block 0 asks for far more than a block can need; the other entries
+        # are out of range or malformed
+        blocks = {"0": 10**9, "-1": 3, "5": 1, "x": 1, "1": "many", "2": 2}
+        await client.send(
+            QuicStreamEvent(
+                stream_id, _pdu(pdu.MSG_TYPE_REPAIR_REQUEST, {"blocks": blocks}), False
+            )
+        )
+        await client.receive()
+        repaired = [fec.SYMBOL_HEADER.unpack_from(data)[0] for data in await _drain(client)]
+
+        await client.send(QuicStreamEvent(stream_id, _pdu(pdu.MSG_TYPE_SEND_ACK), True))
+        await serving
+        return repaired
+
+    repaired = asyncio.run(session())
+    # The asked for symbols plus the block's share of repair (16 + 4, 2 + 1)
+    assert repaired.count(0) == 20
+    assert repaired.count(2) == 3
+    assert len(repaired) == 23
+
+
+@pytest.mark.parametrize(
+    "blocks, max_rounds",
+    [
+        # Every repair symbol of block 0 is sent by the twelfth round
+        ({"0": fec.DEFAULT_BLOCK_LEN}, 12),
+        # Asking for nothing still counts as a round
+        ({}, server_dfa.MAX_REPAIR_ROUNDS + 1),
+    ],
+)
+def test_endless_repair_requests_close_the_session(blocks, max_rounds):
+    image = os.urandom(IMAGE_LEN)
+
+    async def session():
+        server, client = connection_pair()
+        serving = asyncio.ensure_future(
+            server_entry.run({"image_source": MemoryImageSource(image, "9.0.0")}, server)
+        )
+
+        stream_id = client.new_stream()
+        options = {"transfer": [pdu.TRANSFER_DATAGRAM_FEC]}
+        await client.send(
+            QuicStreamEvent(stream_id, _pdu(pdu.MSG_TYPE_VERSION_EXCHANGE, options), False)
+        )
+        await client.receive()
+        await client.send(
+            QuicStreamEvent(stream_id, _pdu(pdu.MSG_TYPE_REQUEST_UPDATE), False)
+        )
+        await client.receive()
+        sent = [fec.SYMBOL_HEADER.unpack_from(data) for data in await _drain(client)]
+
+        rounds = 0
+        while not serving.done():
+            rounds += 1
+            await client.send(
+                QuicStreamEvent(
+                    stream_id, _pdu(pdu.MSG_TYPE_REPAIR_REQUEST, {"blocks": blocks}), False
+                )
+            )
+            await asyncio.wait(
+                [serving, asyncio.ensure_future(client.receive())],
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            sent += [fec.SYMBOL_HEADER.unpack_from(data) for data in await _drain(client)]
+        with pytest.raises(RepairLimitExceeded):
+            serving.result()
+        return rounds, sent
+
+    rounds, sent = asyncio.run(session())
+    assert rounds == max_rounds
+    # No symbol was sent twice
+    assert len(set(sent)) == len(sent)
+
+
+def test_file_image_reads_from_the_offset(tmp_path):
+    data = os.urandom(IMAGE_LEN)
+    path = tmp_path / "firmware.bin"
+    path.write_bytes(data)
+    image = FileImage(str(path), "9.0.0")
+
+    async def segments(offset):
+        return [bytes(segment) async for segment in image.segments(512, offset)]
+
+    for offset in (0, 512, 20_480, IMAGE_LEN - IMAGE_LEN % 512, IMAGE_LEN):
+        expected = [data[i : i + 512] for i in range(offset, IMAGE_LEN, 512)]
+        assert asyncio.run(segments(offset)) == expected
+
+
+def _pdu(mtype: int, options=None) -> bytes:
+    return pdu.Datagram(
+        mtype=mtype,
+        payload=pdu.encode_options(options or {}),
+        protocol_ver=ClientVer.protocol,
+        firmware_ver="0.0.0",
+    ).to_bytes()
+
+
+async def _drain(conn) -> list:
+    # Every datagram sent before the end-of-transfer marker has been queued
+    datagrams = []
+    while not conn._datagrams.empty():
+        datagrams.append(await conn.receive_datagram())
+    return datagrams
+
@@ -0,0 +1,388 @@
+import asyncio
+import contextlib
+import gc
+import itertools
+import os
+import tracemalloc
+
+import pytest
+from aioquic.asyncio import QuicConnectionProtocol, serve
+from aioquic.asyncio.server import QuicServer
+from aioquic.quic.connection import QuicConnection
+from aioquic.quic.events import StreamDataReceived
+
+import common.pdu as pdu
+from client.sinks import MemorySink
+from client.version import ClientVer
+from common import engine, peer_credentials
+from common.memory_transport import LinkProfile, run_session
+from server.images import MemoryImageSource
+
+# SOAK_SESSIONS: Simulated sessions run back to back against one server scope.
+# WARMUP_SESSIONS: Sessions run before measuring, filling caches and pools.
+# TRACED_SESSIONS: Final sessions run with tracemalloc, which slows them down.
+# MAX_OBJECT_GROWTH: Objects the soak may leave alive, far below one per session.
+# MAX_GROWTH: Memory the traced sessions may gain, far below one object per session.
+SOAK_SESSIONS = 100_000
+WARMUP_SESSIONS = 1_000
+TRACED_SESSIONS = 10_000
+MAX_OBJECT_GROWTH = 1_000
+MAX_GROWTH = 64 * 1024
+IMAGE_LEN = 2_000
+# Seconds the server may take to notice a closed connection
+CLOSE_TIMEOUT = 5.0
+
+# QUIC_SOAK_SESSIONS: Connections of the short QUIC soak run with every test run.
+# LONG_QUIC_SOAK_SESSIONS: Connections of the long QUIC soak, run with ``-m soak``.
+# QUIC_SOAK_CONCURRENCY: Connections open at once.
+# QUIC_SOAK_WARMUP: Connections run before counting objects.
+# QUIC_IDLE_TIMEOUT: Seconds without packets before the server drops a connection.
+# SESSION_TIMEOUT: Seconds the server waits for a device's next PDU.
+# PING_INTERVAL: Seconds between the pings of a device that keeps its
+#   connection alive but never sends its next PDU.
+# SERVER_ADDRESS: Where the server listens on the in-memory network.
+QUIC_SOAK_SESSIONS = 200
+LONG_QUIC_SOAK_SESSIONS = 5_000
+QUIC_SOAK_CONCURRENCY = 10
+QUIC_SOAK_WARMUP = 50
+QUIC_IDLE_TIMEOUT = 0.3
+SESSION_TIMEOUT = 0.6
+PING_INTERVAL = 0.05
+SERVER_ADDRESS = ("10.0.0.1", 4433)
+
+
+class HeldSink(MemorySink):
+    """Sink that already holds the offered image, so the transfer is skipped."""
+
+    def open(self, firmware_ver, image_hash, size) -> bool:
+        return False
+
+
+@pytest.mark.soak
+def test_simulated_sessions_keep_memory_flat():
+    image = os.urandom(IMAGE_LEN)
+    server_scope = {"image_source": MemoryImageSource(image, "9.0.0")}
+    chunked = LinkProfile(chunk_len=300)
+
+    async def soak():
+        for i in range(SOAK_SESSIONS):
+            if i == WARMUP_SESSIONS:
+                gc.collect()
+                objects = len(gc.get_objects())
+            if i == SOAK_SESSIONS - TRACED_SESSIONS:
+                gc.collect()
+                tracemalloc.start()
+                traced = tracemalloc.get_traced_memory()[0]
+            # Alternate the transfer modes, and split the stream writes of
+            # half the sessions of each mode so PDUs arrive in pieces
+            scope = {"sink": MemorySink()}
+            if i % 2:
+                scope["transfer"] = pdu.TRANSFER_DATAGRAM_FEC
+            link = chunked if i % 4 < 2 else None
+            await run_session(server_scope, scope, link, link, seed=i)
+            assert scope["installed"]
+        gc.collect()
+        growth = tracemalloc.get_traced_memory()[0] - traced
+        return len(gc.get_objects()) - objects, growth
+
+    # The state machines report every segment
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            object_growth, growth = asyncio.run(soak())
+    finally:
+        tracemalloc.stop()
+    assert object_growth < MAX_OBJECT_GROWTH
+    assert growth < MAX_GROWTH
+
+
+def test_loopback_sessions_release_handlers_and_budget(tmp_path):
+    cert_file, key_file, _ = peer_credentials.load_or_create(str(tmp_path))
+    image = os.urandom(200_000)
+    server_scope = {"image_source": MemoryImageSource(image, "9.0.0")}
+    sessions = [
+        {"sink": MemorySink()},
+        {"sink": MemorySink(), "transfer": pdu.TRANSFER_DATAGRAM_FEC},
+        {"sink": HeldSink()},
+    ]
+
+    async def main():
+        protocols = []
+
+        def create_protocol(*args, **kwargs):
+            protocol = engine.AsyncQuicServer(*args, scope=server_scope, **kwargs)
+            protocols.append(protocol)
+            return protocol
+
+        server = await serve(
+            "127.0.0.1",
+            0,
+            configuration=engine.build_server_quic_config(cert_file, key_file),
+            create_protocol=create_protocol,
+        )
+        port = server._transport.get_extra_info("sockname")[1]
+        configuration = engine.build_client_quic_config(cert_file, datagrams=True)
+        configuration.server_name = peer_credentials.PEER_SERVER_NAME
+        try:
+            for scope in sessions:
+                await engine.run_client("127.0.0.1", port, configuration, scope)
+                await _wait_closed(protocols[-1])
+        finally:
+            server.close()
+        return protocols
+
+    protocols = asyncio.run(main())
+    assert sessions[0]["sink"].data == image
+    assert sessions[1]["sink"].data == image
+    assert "installed" not in sessions[2]
+    assert len(protocols) == len(sessions)
+    for protocol in protocols:
+        assert protocol._handlers == {}
+        assert protocol._budget.buffered == 0
+        assert protocol._budget.queued == {}
+        assert protocol._budget.consumed == {}
+        assert protocol._budget.granted == {}
+        assert protocol._datagrams.empty()
+
+
+async def _wait_closed(protocol: engine.AsyncQuicServer) -> None:
+    await asyncio.wait_for(protocol._closed.wait(), CLOSE_TIMEOUT)
+    # Let cancelled handlers run their done callbacks
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+
+
+class MemoryNetwork:
+    """
+    Delivers UDP datagrams between QUIC endpoints in this process, so real
+    aioquic connections run without sockets.
+    """
+
+    def __init__(self):
+        self.endpoints = {}
+
+    def attach(self, address, protocol: asyncio.DatagramProtocol) -> "MemoryWire":
+        wire = MemoryWire(self, address)
+        self.endpoints[address] = protocol
+        protocol.connection_made(wire)
+        return wire
+
+    def deliver(self, data: bytes, source, destination) -> None:
+        endpoint = self.endpoints.get(destination)
+        if endpoint is not None:
+            endpoint.datagram_received(data, source)
+
+
+class MemoryWire(asyncio.DatagramTransport):
+    """Transport of one ``MemoryNetwork`` endpoint. Once closed, nothing gets through."""
+
+    def __init__(self, network: MemoryNetwork, address):
+        super().__init__()
+        self.network = network
+        self.address = address
+        self.closed = False
+
+    def sendto(self, data, addr=None) -> None:
+        if not self.closed:
+            asyncio.get_running_loop().call_soon(
+                self.network.deliver, bytes(data), self.address, addr
+            )
+
+    def get_extra_info(self, name, default=None):
+        return self.address if name == "sockname" else default
+
+    def close(self) -> None:
+        self.closed = True
+        self.network.endpoints.pop(self.address, None)
+
+
+class Device(QuicConnectionProtocol):
+    """Device driving the protocol by hand, noting when the server sent data."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.data_received = asyncio.Event()
+
+    def quic_event_received(self, event) -> None:
+        if isinstance(event, StreamDataReceived):
+            self.data_received.set()
+
+
+@pytest.mark.parametrize(
+    "sessions",
+    [
+        QUIC_SOAK_SESSIONS,
+        pytest.param(LONG_QUIC_SOAK_SESSIONS, marks=pytest.mark.soak),
+    ],
+)
+def test_quic_sessions_release_the_server(tmp_path, sessions):
+    cert_file, key_file, _ = peer_credentials.load_or_create(str(tmp_path))
+    image = os.urandom(IMAGE_LEN * 10)
+    server_scope = {
+        "image_source": MemoryImageSource(image, "9.0.0"),
+        "session_timeout": SESSION_TIMEOUT,
+    }
+    server_configuration = engine.build_server_quic_config(cert_file, key_file)
+    server_configuration.idle_timeout = QUIC_IDLE_TIMEOUT
+    client_configuration = engine.build_client_quic_config(cert_file, datagrams=True)
+    client_configuration.server_name = peer_credentials.PEER_SERVER_NAME
+
+    async def soak():
+        network = MemoryNetwork()
+        protocols = []
+
+        def create_protocol(*args, **kwargs):
+            protocol = engine.AsyncQuicServer(*args, scope=server_scope, **kwargs)
+            protocols.append(protocol)
+            return protocol
+
+        server = QuicServer(
+            configuration=server_configuration, create_protocol=create_protocol
+        )
+        network.attach(SERVER_ADDRESS, server)
+        # Devices that finish either transfer, reset their stream, stall or
+        # drop off the network, each on a connection of its own
+        kinds = itertools.cycle([_complete, _complete_fec, _reset, _stall, _vanish])
+
+        async def session(i, kind):
+            address = ("10.0.1.1", 1024 + i)
+            await kind(network, address, client_configuration, protocols, image)
+            protocol = _server_end(protocols, address)
+            protocols.remove(protocol)
+            await _wait_closed(protocol)
+            _assert_released(protocol)
+
+        async def run(numbers):
+            # A few devices at a time, each taking the next session number
+            async def device():
+                for i in numbers:
+                    await session(i, next(kinds))
+
+            await asyncio.gather(*(device() for _ in range(QUIC_SOAK_CONCURRENCY)))
+
+        await run(iter(range(QUIC_SOAK_WARMUP)))
+        gc.collect()
+        objects = len(gc.get_objects())
+        await run(iter(range(QUIC_SOAK_WARMUP, sessions)))
+        # Wait for the closed connections to be forgotten
+        while server._protocols:
+            await asyncio.sleep(0.01)
+        server.close()
+        gc.collect()
+        return len(gc.get_objects()) - objects
+
+    # The state machines report every segment
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        # Well over the seconds a connection takes, so a hang fails the test
+        object_growth = asyncio.run(asyncio.wait_for(soak(), sessions))
+    assert object_growth < MAX_OBJECT_GROWTH
+
+
+async def _connect(network, address, configuration, protocol_class, **kwargs):
+    protocol = protocol_class(QuicConnection(configuration=configuration), **kwargs)
+    wire = network.attach(address, protocol)
+    protocol.connect(SERVER_ADDRESS)
+    await protocol.wait_connected()
+    return protocol, wire
+
+
+async def _complete(network, address, configuration, protocols, image):
+    await _transfer(network, address, configuration, image, {})
+
+
+async def _complete_fec(network, address, configuration, protocols, image):
+    await _transfer(
+        network, address, configuration, image, {"transfer": pdu.TRANSFER_DATAGRAM_FEC}
+    )
+
+
+async def _transfer(network, address, configuration, image, scope):
+    scope["sink"] = MemorySink()
+    client, wire = await _connect(
+        network, address, configuration, engine.AsyncQuicServer, scope=scope
+    )
+    await client._client_handler.launch()
+    client.close()
+    await client.wait_closed()
+    wire.close()
+    assert scope["sink"].data == image
+
+
+async def _request(network, address, configuration):
+    # A device that asks for the image and reads nothing of it
+    device, wire = await _connect(network, address, configuration, Device)
+    stream_id = device._quic.get_next_available_stream_id()
+    request = (
+        pdu.Datagram(pdu.MSG_TYPE_VERSION_EXCHANGE, b"", ClientVer.protocol, "0.0.0").to_bytes()
+        + pdu.Datagram(pdu.MSG_TYPE_REQUEST_UPDATE, b"").to_bytes()
+    )
+    device._quic.send_stream_data(stream_id, request)
+    device.transmit()
+    await asyncio.wait_for(device.data_received.wait(), CLOSE_TIMEOUT)
+    return device, wire, stream_id
+
+
+async def _reset(network, address, configuration, protocols, image):
+    # The device gives up on the transfer but keeps the connection
+    device, wire, stream_id = await _request(network, address, configuration)
+    device._quic.reset_stream(stream_id, 0)
+    device.transmit()
+    protocol = _server_end(protocols, address)
+    # Well before the server would give up on the session by itself
+    deadline = asyncio.get_running_loop().time() + SESSION_TIMEOUT / 4
+    while protocol._handlers and asyncio.get_running_loop().time() < deadline:
+        await asyncio.sleep(0.01)
+    assert protocol._handlers == {}
+    assert protocol._budget.buffered == 0
+    device.close()
+    await device.wait_closed()
+    wire.close()
+
+
+async def _stall(network, address, configuration, protocols, image):
+    # The device keeps the connection alive but never asks for the image, so
+    # the server gives up waiting and closes the connection
+    device, wire = await _connect(network, address, configuration, Device)
+    stream_id = device._quic.get_next_available_stream_id()
+    device._quic.send_stream_data(
+        stream_id,
+        pdu.Datagram(pdu.MSG_TYPE_VERSION_EXCHANGE, b"", ClientVer.protocol, "0.0.0").to_bytes(),
+    )
+    device.transmit()
+    while not device._closed.is_set():
+        device._quic.send_ping(0)
+        device.transmit()
+        await asyncio.sleep(PING_INTERVAL)
+    wire.close()
+
+
+async def _vanish(network, address, configuration, protocols, image):
+    # The device drops off the network mid-transfer, so the server's
+    # connection times out
+    device, wire, _ = await _request(network, address, configuration)
+    wire.close()
+    device.close()
+    await device.wait_closed()
+
+
+def _server_end(protocols, address) -> engine.AsyncQuicServer:
+    return next(p for p in protocols if p._quic._network_paths[0].addr == address)
+
+
+def _assert_released(protocol: engine.AsyncQuicServer) -> None:
+    assert protocol._handlers == {}
+    assert protocol._budget.buffered == 0
+    assert protocol._budget.queued == {}
+    assert protocol._budget.consumed == {}
+    assert protocol._budget.granted == {}
+    assert protocol._datagrams.empty()
+
+
+def test_forgotten_streams_release_their_budget():
+    budget = engine.ReceiveBudget(1024, 4096)
+    budget.received(0, 3000)
+    budget.received(4, 500)
+    budget.consume(0, 1000)
+    budget.forget(0)
+    assert budget.buffered == 500
+    assert not budget.consume(0, 1000)
+    assert budget.buffered == 500
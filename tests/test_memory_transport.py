@@ -0,0 +1,146 @@
+import asyncio
+import base64
+import os
+
+import pytest
+
+import client.entry as client_entry
+import common.pdu as pdu
+import server.entry as server_entry
+from client.sinks import MemorySink
+from common.memory_transport import (
+    LinkProfile,
+    RecordingConnection,
+    ReplayConnection,
+    connection_pair,
+    load_trace,
+    run_session,
+)
+from common.quic import QuicStreamEvent
+from server.images import MemoryImageSource
+
+# LATENCY: One-way delay of the timed links, in seconds.
+# BANDWIDTH: Bytes per second of the rate limited link.
+LATENCY = 0.05
+BANDWIDTH = 100_000
+
+
+@pytest.mark.parametrize("loss", [1.0, -0.1])
+def test_link_must_deliver_something(loss):
+    with pytest.raises(ValueError):
+        LinkProfile(loss=loss)
+
+
+def test_heavy_loss_still_completes():
+    image = os.urandom(20_000)
+    sink = MemorySink()
+    scope = {"sink": sink}
+    link = LinkProfile(loss=0.9, chunk_len=300)
+    asyncio.run(
+        run_session(
+            {"image_source": MemoryImageSource(image, "9.0.0")},
+            scope,
+            uplink=link,
+            downlink=link,
+            seed=5,
+        )
+    )
+    assert scope["installed"]
+    assert sink.data == image
+
+
+@pytest.mark.parametrize("transfer", [pdu.TRANSFER_STREAM, pdu.TRANSFER_DATAGRAM_FEC])
+def test_recorded_session_replays_against_both_ends(tmp_path, transfer):
+    image = os.urandom(20_000)
+
+    async def record():
+        server, client = connection_pair(seed=1)
+        server, client = RecordingConnection(server), RecordingConnection(client)
+        await asyncio.gather(
+            server_entry.run({"image_source": MemoryImageSource(image, "9.0.0")}, server),
+            client_entry.run({"sink": MemorySink(), "transfer": transfer}, client),
+        )
+        server.save(str(tmp_path / "server.jsonl"))
+        client.save(str(tmp_path / "client.jsonl"))
+
+    asyncio.run(record())
+
+    # Each end, fed what it received in the recording, sends the same PDUs
+    server_trace = load_trace(str(tmp_path / "server.jsonl"))
+    server = ReplayConnection(server_trace, time_scale=0)
+    asyncio.run(
+        server_entry.run({"image_source": MemoryImageSource(image, "9.0.0")}, server)
+    )
+    assert server.sent == _outgoing(server_trace)
+
+    client_trace = load_trace(str(tmp_path / "client.jsonl"))
+    client = ReplayConnection(client_trace, time_scale=0, client=True)
+    scope = {"sink": MemorySink(), "transfer": transfer}
+    asyncio.run(client_entry.run(scope, client))
+    assert client.sent == _outgoing(client_trace)
+    assert scope["sink"].data == image
+
+
+def test_latency_delays_delivery():
+    async def deliveries():
+        server, client = connection_pair(downlink=LinkProfile(latency=LATENCY))
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await server.send(QuicStreamEvent(0, _frame(b"x"), False))
+        await server.send_datagram(b"y")
+        await client.receive()
+        stream_delay = loop.time() - start
+        await client.receive_datagram()
+        return stream_delay, loop.time() - start
+
+    for delay in asyncio.run(deliveries()):
+        assert LATENCY <= delay < 2 * LATENCY
+
+
+def test_bandwidth_paces_the_link():
+    async def transfer_time():
+        server, client = connection_pair(downlink=LinkProfile(bandwidth=BANDWIDTH))
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for _ in range(10):
+            await server.send(QuicStreamEvent(0, _frame(bytes(5_000)), False))
+        for _ in range(10):
+            await client.receive()
+        return loop.time() - start
+
+    # 50 kB at 100 kB/s
+    assert 0.45 <= asyncio.run(transfer_time()) < 0.75
+
+
+def test_reordering_overtakes_datagrams_but_not_stream_data():
+    async def arrivals():
+        server, client = connection_pair(
+            downlink=LinkProfile(reorder=0.5, reorder_delay=0.01), seed=2
+        )
+        for i in range(50):
+            await server.send(QuicStreamEvent(0, _frame(bytes([i])), False))
+            await server.send_datagram(bytes([i]))
+        stream = [(await client.receive()).data for _ in range(50)]
+        datagrams = [(await client.receive_datagram())[0] for _ in range(50)]
+        return stream, datagrams
+
+    stream, datagrams = asyncio.run(arrivals())
+    assert stream == [_frame(bytes([i])) for i in range(50)]
+    assert sorted(datagrams) == list(range(50))
+    assert datagrams != list(range(50))
+
+
+def _frame(payload: bytes) -> bytes:
+    return pdu.Datagram(pdu.MSG_TYPE_START_SND_DATA, payload).to_bytes()
+
+
+def _outgoing(trace) -> list:
+    # Recorded outgoing events in the form ReplayConnection collects them
+    sent = []
+    for event in trace:
+        if event["dir"] != "out":
+            continue
+        fields = {k: v for k, v in event.items() if k not in ("t", "dir")}
+        fields["data"] = base64.b64decode(event["data"])
+        sent.append(fields)
+    return sent
@@ -0,0 +1,125 @@
+import os
+import tracemalloc
+
+import pytest
+
+import common.pdu as pdu
+from server.version import ServerVer
+
+# SEGMENT_LEN: Image bytes per segment, as sent by the server.
+# EVENT_LEN: Bytes per received stream event, about one QUIC packet.
+# BATCH_LEN: Bytes of a stream event after a lost packet was recovered, when
+#   aioquic hands over everything that became contiguous at once.
+# MAX_ENCODE_BYTES: Transient allocation allowed to encode one segment.
+# MAX_RECEIVE_BYTES: Transient allocation allowed per received segment.
+SEGMENT_LEN = 512
+EVENT_LEN = 1200
+BATCH_LEN = 64 * 1024
+MAX_ENCODE_BYTES = 768
+MAX_RECEIVE_BYTES = 384
+
+
+def _datagram(payload: bytes) -> pdu.Datagram:
+    return pdu.Datagram(
+        mtype=pdu.MSG_TYPE_START_SND_DATA,
+        payload=payload,
+        protocol_ver=ServerVer.protocol,
+        firmware_ver=ServerVer.firmware,
+    )
+
+
+def _segments(image: bytes):
+    view = memoryview(image)
+    return [view[pos : pos + SEGMENT_LEN] for pos in range(0, len(view), SEGMENT_LEN)]
+
+
+def _encode_all(segments) -> bytes:
+    return b"".join(_datagram(segment).to_bytes() for segment in segments)
+
+
+def _peak_per_step(steps) -> float:
+    # Largest transient allocation of a single step, divided by the segments
+    # the step handled. A step that copies a segment or the received data
+    # shows up here even if the copy is freed again.
+    worst = 0.0
+    tracemalloc.start()
+    try:
+        for step in steps:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            segments = step() or 1
+            peak = tracemalloc.get_traced_memory()[1] - before
+            worst = max(worst, peak / segments)
+    finally:
+        tracemalloc.stop()
+    return worst
+
+
+def test_round_trip():
+    datagram = _datagram(b"\x00\x01payload")
+    decoded = pdu.Datagram.from_bytes(datagram.to_bytes())
+    assert decoded.mtype == datagram.mtype
+    assert bytes(decoded.payload) == b"\x00\x01payload"
+    assert decoded.protocol_ver == ServerVer.protocol
+    assert decoded.firmware_ver == ServerVer.firmware
+
+
+def test_framer_splits_and_joins_events():
+    payloads = [os.urandom(n) for n in (0, 1, 511, 512, 700, 3000)] * 5
+    stream = _encode_all(payloads)
+    for event_len in (1, 2, 7, 100, EVENT_LEN, len(stream)):
+        framer = pdu.DatagramFramer()
+        received = []
+        for pos in range(0, len(stream), event_len):
+            for frame in framer.feed(stream[pos : pos + event_len]):
+                received.append(bytes(pdu.Datagram.from_bytes(frame).payload))
+        assert received == payloads
+
+
+def test_framer_rejects_oversized_datagrams():
+    header = pdu.HEADER.pack(pdu.MSG_TYPE_VERSION_EXCHANGE, 0, 0, 2**32 - 1)
+    for event_len in (1, 3, len(header)):
+        framer = pdu.DatagramFramer()
+        with pytest.raises(ValueError):
+            for pos in range(0, len(header), event_len):
+                framer.feed(header[pos : pos + event_len])
+
+    # The largest allowed payload still arrives in pieces
+    stream = _encode_all([os.urandom(pdu.MAX_PAYLOAD_LEN)])
+    framer = pdu.DatagramFramer()
+    frames = []
+    for pos in range(0, len(stream), EVENT_LEN):
+        frames += framer.feed(stream[pos : pos + EVENT_LEN])
+    assert len(frames) == 1
+
+
+def test_encode_allocations_per_segment():
+    segments = _segments(os.urandom(SEGMENT_LEN * 200))
+
+    def encode(segment):
+        datagram = _datagram(segment)
+        buffer = pdu.buffer_pool.acquire(datagram.encoded_len())
+        datagram.encode_into(buffer)
+        pdu.buffer_pool.release(buffer)
+
+    # Warm up the pool, so the measured steps only reuse its buffers
+    encode(segments[0])
+    worst = _peak_per_step([lambda s=segment: encode(s) for segment in segments])
+    assert worst < MAX_ENCODE_BYTES
+
+
+def test_receive_allocations_per_segment():
+    stream = _encode_all(_segments(os.urandom(SEGMENT_LEN * 1000)))
+    events = [stream[pos : pos + BATCH_LEN] for pos in range(0, len(stream), BATCH_LEN)]
+    framer = pdu.DatagramFramer()
+    received = []
+
+    def receive(event):
+        frames = framer.feed(event)
+        for frame in frames:
+            received.append(len(pdu.Datagram.from_bytes(frame).payload))
+        return len(frames)
+
+    worst = _peak_per_step([lambda e=event: receive(e) for event in events])
+    assert sum(received) == SEGMENT_LEN * 1000
+    assert worst < MAX_RECEIVE_BYTES
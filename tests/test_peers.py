@@ -0,0 +1,138 @@
+import asyncio
+import hashlib
+import os
+
+import pytest
+
+import client.entry as client_entry
+import common.pdu as pdu
+import server.entry as server_entry
+from client.sinks import MemorySink
+from common.custom_exceptions import ImageVerificationFailed
+from common.memory_transport import connection_pair, run_session
+from server.images import MemoryImageSource
+from server.peers import PeerRegistry
+from server.sessions import SessionRegistry
+
+CERT = "-----BEGIN CERTIFICATE-----\n...\n-----END CERTIFICATE-----\n"
+
+
+def test_hints_expire_and_skip_the_requesting_device():
+    registry = PeerRegistry(ttl=60.0)
+    registry.add("a" * 64, ("10.0.0.1", 4434), CERT)
+    registry.add("a" * 64, ("10.0.0.2", 4434), CERT)
+    hints = registry.hints("a" * 64, exclude=("10.0.0.1", 4434))
+    assert [hint[:3] for hint in hints] == [("10.0.0.2", 4434, CERT)]
+
+    registry.ttl = -1.0
+    registry.add("a" * 64, ("10.0.0.3", 4434), CERT)
+    hints = registry.hints("a" * 64)
+    assert ("10.0.0.3", 4434, CERT) not in [hint[:3] for hint in hints]
+
+
+def test_failed_peers_are_dropped():
+    registry = PeerRegistry()
+    registry.remove("a" * 64, ("10.0.0.1", 4434))
+    registry.add("a" * 64, ("10.0.0.1", 4434), CERT)
+    registry.remove("a" * 64, ("10.0.0.1", 4434))
+    assert registry.hints("a" * 64) == []
+    assert registry.peers == {}
+
+
+def test_only_reports_of_handed_out_hints_count():
+    registry = PeerRegistry(failure_reports=2)
+    registry.add("a" * 64, ("10.0.0.1", 4434), CERT)
+    assert not registry.report_failed("forged")
+
+    first = registry.hints("a" * 64)[0][3]
+    assert registry.report_failed(first)
+    # Each hint counts once
+    assert not registry.report_failed(first)
+    assert registry.hints("a" * 64)
+
+    # Installing the image again clears the reports
+    registry.add("a" * 64, ("10.0.0.1", 4434), CERT)
+    assert registry.report_failed(registry.hints("a" * 64)[0][3])
+    assert registry.hints("a" * 64)
+    assert registry.report_failed(registry.hints("a" * 64)[0][3])
+    assert registry.hints("a" * 64) == []
+    assert registry.failures == {}
+
+
+def test_device_becomes_a_peer_after_acknowledging_the_image():
+    image = os.urandom(20_000)
+    source = MemoryImageSource(image, "1.0.1")
+    registry = PeerRegistry()
+    server_scope = {"image_source": source, "peer_registry": registry}
+
+    serving = {
+        "sink": MemorySink(),
+        "serve_peers": ("10.0.0.1", 4434),
+        "peer_cert": CERT,
+    }
+    asyncio.run(run_session(server_scope, serving))
+    assert serving["installed"]
+
+    sha256 = hashlib.sha256(image).hexdigest()
+    assert [hint[:3] for hint in registry.hints(sha256)] == [("10.0.0.1", 4434, CERT)]
+
+    # Devices that could not fetch from the peer report the hints they were
+    # handed. Reports naming the peer's address are ignored.
+    for _ in range(registry.failure_reports):
+        assert registry.hints(sha256)
+        (host, port, cert, token), = asyncio.run(_peer_hints(server_scope))
+        assert (host, port, cert) == ("10.0.0.1", 4434, CERT)
+
+        fetching = {
+            "sink": MemorySink(),
+            "failed_peers": [["10.0.0.1", 4434], "forged", token],
+        }
+        asyncio.run(run_session(server_scope, fetching))
+        assert fetching["installed"]
+    assert registry.hints(sha256) == []
+
+
+@pytest.mark.parametrize("transfer", [pdu.TRANSFER_STREAM, pdu.TRANSFER_DATAGRAM_FEC])
+def test_corrupt_image_does_not_make_a_peer(transfer):
+    image = os.urandom(20_000)
+    source = MemoryImageSource(image, "1.0.1")
+    # The image changed on disk after it was hashed
+    source.image.data = image[:-1] + bytes([image[-1] ^ 1])
+    registry = PeerRegistry()
+    sessions = SessionRegistry()
+    server_scope = {
+        "image_source": source,
+        "peer_registry": registry,
+        "session_registry": sessions,
+    }
+    serving = {
+        "sink": MemorySink(),
+        "serve_peers": ("10.0.0.1", 4434),
+        "peer_cert": CERT,
+        "device_id": "rsu-1",
+        "transfer": transfer,
+    }
+
+    async def session():
+        server, client = connection_pair()
+        server_task = asyncio.ensure_future(server_entry.run(server_scope, server))
+        with pytest.raises(ImageVerificationFailed):
+            await client_entry.run(serving, client)
+        await asyncio.wait_for(server_task, 5.0)
+
+    asyncio.run(session())
+    assert "installed" not in serving
+    assert serving["sink"].data is None
+    assert registry.peers == {}
+    assert len(sessions) == 0
+
+
+async def _peer_hints(server_scope) -> list:
+    # The device leaves once it got hints, and the in-memory connection does
+    # not tell the server, so the server is stopped here
+    server, client = connection_pair()
+    serving = asyncio.ensure_future(server_entry.run(server_scope, server))
+    scope = {"sink": MemorySink(), "use_peers": True}
+    await client_entry.run(scope, client)
+    serving.cancel()
+    return scope["peer_hints"]
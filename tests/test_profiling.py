@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+from common.profiling import Tracer
+
+
+def _spin_a(seconds: float) -> None:
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def _spin_b(seconds: float) -> None:
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+async def _connection(spin) -> None:
+    # Each step outlasts the interpreter's switch interval, so the sampling
+    # thread gets to run during the steps
+    for _ in range(10):
+        spin(0.02)
+        await asyncio.sleep(0)
+
+
+def _functions(trace):
+    return {frame.split(":")[1] for stack in trace.samples for frame in stack.split(";")}
+
+
+def test_samples_go_to_the_running_connection(tmp_path):
+    tracer = Tracer(profile_rate=1.0, profile_dir=str(tmp_path))
+
+    async def run():
+        trace_a = tracer.start_connection()
+        trace_b = tracer.start_connection()
+        await asyncio.gather(
+            tracer.attributed(trace_a, _connection(_spin_a)),
+            tracer.attributed(trace_b, _connection(_spin_b)),
+        )
+        # Work outside both connections is not attributed to either
+        _spin_b(0.05)
+        tracer.finish_connection(trace_a)
+        tracer.finish_connection(trace_b)
+        return trace_a, trace_b
+
+    trace_a, trace_b = asyncio.run(run())
+    assert "_spin_a" in _functions(trace_a)
+    assert "_spin_b" not in _functions(trace_a)
+    assert "_spin_b" in _functions(trace_b)
+    assert "_spin_a" not in _functions(trace_b)
+    assert (tmp_path / f"connection-{trace_a.connection_id}.folded").exists()
+
+
+def test_attribution_is_a_no_op_without_profiling():
+    tracer = Tracer()
+    trace = tracer.start_connection()
+    coro = _connection(_spin_a)
+    assert tracer.attributed(trace, coro) is coro
+    coro.close()
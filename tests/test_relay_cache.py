@@ -0,0 +1,96 @@
+import asyncio
+import hashlib
+import os
+
+import pytest
+
+from relay.cache import ImageCache
+
+
+class Origin:
+    """Fake upstream that announces one image, or fails while ``down``."""
+
+    def __init__(self, image: bytes, firmware_ver: str):
+        self.image = image
+        self.firmware_ver = firmware_ver
+        self.down = False
+        self.fetches = 0
+
+    async def fetch(self, sink) -> None:
+        self.fetches += 1
+        if self.down:
+            raise ConnectionError("Origin unreachable")
+        sha256 = hashlib.sha256(self.image).hexdigest()
+        if sink.open(self.firmware_ver, sha256, len(self.image)):
+            sink.write(self.image)
+            sink.commit()
+
+
+async def _read(entry) -> bytes:
+    return b"".join([bytes(data) async for data in entry.segments()])
+
+
+def test_serves_cached_image_while_origin_is_down(tmp_path):
+    image = os.urandom(5000)
+    origin = Origin(image, "1.0.1")
+
+    async def run():
+        cache = ImageCache(str(tmp_path), 1 << 20, origin.fetch, refresh=0.0)
+        entry = await cache.open()
+        assert await _read(entry) == image
+
+        origin.down = True
+        for _ in range(3):
+            entry = await cache.open()
+            assert entry.firmware_ver == "1.0.1"
+            assert await _read(entry) == image
+
+        # A restarted relay still knows the image and its version
+        restarted = ImageCache(str(tmp_path), 1 << 20, origin.fetch, refresh=0.0)
+        entry = await restarted.open()
+        assert entry.firmware_ver == "1.0.1"
+        assert await _read(entry) == image
+
+    asyncio.run(run())
+
+
+def test_failed_new_image_falls_back_to_previous(tmp_path):
+    old, new = os.urandom(5000), os.urandom(6000)
+    origin = Origin(old, "1.0.1")
+
+    async def fetch_partially(sink):
+        # The origin announces a new image but drops the transfer midway
+        sha256 = hashlib.sha256(new).hexdigest()
+        sink.open("1.0.2", sha256, len(new))
+        sink.write(new[:1000])
+        raise ConnectionError("Origin went away")
+
+    async def run():
+        cache = ImageCache(str(tmp_path), 1 << 20, origin.fetch, refresh=0.0)
+        await cache.open()
+        cache.fetch = fetch_partially
+        # A session that joined the new image fails along with it
+        with pytest.raises(ConnectionError):
+            await _read(await cache.open())
+
+        # Later sessions get the previous image until the next refresh
+        cache.refresh = 60.0
+        entry = await cache.open()
+        assert entry.firmware_ver == "1.0.1"
+        assert await _read(entry) == old
+
+    asyncio.run(run())
+
+
+def test_unreachable_origin_is_not_asked_per_request(tmp_path):
+    origin = Origin(b"", "1.0.1")
+    origin.down = True
+
+    async def run():
+        cache = ImageCache(str(tmp_path), 1 << 20, origin.fetch, refresh=60.0)
+        for _ in range(10):
+            with pytest.raises(ConnectionError):
+                await cache.open()
+
+    asyncio.run(run())
+    assert origin.fetches == 1
@@ -0,0 +1,145 @@
+import asyncio
+import hashlib
+import os
+
+import pytest
+
+import common.pdu as pdu
+import server.entry as server_entry
+from client.sinks import SlotSink
+from client.version import ClientVer
+from common.memory_transport import LinkProfile, connection_pair, run_session
+from common.quic import QuicStreamEvent
+from server.images import MemoryImageSource
+from server.sessions import SessionRegistry
+
+IMAGE_LEN = 100_001
+CUT_AT = 40_000
+# Seconds a session may take before it counts as hung
+SESSION_TIMEOUT = 10.0
+
+
+class CutSink(SlotSink):
+    """Slot sink whose connection drops once ``limit`` bytes were written."""
+
+    limit = None
+
+    def write_at(self, offset, data):
+        if self.limit is not None and offset + len(data) > self.limit:
+            raise ConnectionError("Link dropped")
+        super().write_at(offset, data)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_resume_survives_reordering(tmp_path, seed):
+    image = os.urandom(IMAGE_LEN)
+    server_scope = {
+        "image_source": MemoryImageSource(image, "1.0.1"),
+        "session_registry": SessionRegistry(),
+    }
+    downlink = LinkProfile(latency=0.001, reorder=0.3, reorder_delay=0.005)
+
+    async def sessions():
+        sink = CutSink(str(tmp_path))
+        sink.limit = CUT_AT
+        cut = {"sink": sink, "device_id": "device-1"}
+        with pytest.raises(ConnectionError):
+            await run_session(server_scope, cut, downlink=downlink, seed=seed)
+        assert sink.partial()[1] == CUT_AT // 512 * 512
+
+        resumed = {"sink": CutSink(str(tmp_path)), "device_id": "device-1"}
+        await asyncio.wait_for(
+            run_session(server_scope, resumed, downlink=downlink, seed=seed),
+            SESSION_TIMEOUT,
+        )
+        return resumed
+
+    resumed = asyncio.run(sessions())
+    assert resumed["installed"]
+    assert resumed["image_sha256"] == hashlib.sha256(image).hexdigest()
+    with open(resumed["sink"].path, "rb") as f:
+        assert f.read() == image
+
+
+@pytest.mark.parametrize(
+    "resume",
+    [
+        {"sha256": "0" * 64},
+        {"offset": -512},
+        {"sha256": "0" * 64, "offset": 512, "token": 512},
+        [0, 512],
+        "512",
+    ],
+)
+def test_malformed_resume_offers_get_a_full_transfer(resume):
+    image = os.urandom(IMAGE_LEN)
+    sessions = SessionRegistry()
+    server_scope = {
+        "image_source": MemoryImageSource(image, "1.0.1"),
+        "session_registry": sessions,
+    }
+
+    async def offer():
+        options = {"device_id": "device-1"}
+        ack = await _exchange(server_scope, options)
+
+        # The device holds a session for the image now
+        if isinstance(resume, dict):
+            if "sha256" in resume:
+                resume["sha256"] = hashlib.sha256(image).hexdigest()
+            resume.setdefault("token", ack["resume_token"])
+        options["resume"] = resume
+        return await _exchange(server_scope, options)
+
+    ack = asyncio.run(offer())
+    assert "resume" not in ack
+    assert ack["size"] == IMAGE_LEN
+
+
+def test_resume_needs_the_token_the_session_was_handed_out_with():
+    image = os.urandom(IMAGE_LEN)
+    sessions = SessionRegistry()
+    server_scope = {
+        "image_source": MemoryImageSource(image, "1.0.1"),
+        "session_registry": sessions,
+    }
+    sha256 = hashlib.sha256(image).hexdigest()
+
+    async def offers():
+        victim = await _exchange(server_scope, {"device_id": "device-1"})
+        token = victim["resume_token"]
+        sessions.get(token).acked_segment = 10
+
+        # Another device claiming the same ID cannot take over the session
+        forged = {"sha256": sha256, "offset": 512, "token": "forged"}
+        hijack = await _exchange(
+            server_scope, {"device_id": "device-1", "resume": forged}
+        )
+        assert "resume" not in hijack
+        assert hijack["resume_token"] != token
+        assert sessions.get(token).acked_segment == 10
+
+        offer = {"sha256": sha256, "offset": 5120, "token": token}
+        return await _exchange(server_scope, {"device_id": "device-1", "resume": offer})
+
+    assert asyncio.run(offers())["resume"] == 5120
+
+
+async def _exchange(server_scope, options) -> dict:
+    # Send a version exchange to a fresh server connection and return the ack
+    server, client = connection_pair()
+    serving = asyncio.ensure_future(server_entry.run(server_scope, server))
+    await client.send(_version_exchange(client, options))
+    event = await client.receive()
+    serving.cancel()
+    return pdu.decode_options(pdu.Datagram.from_bytes(event.data).payload)
+
+
+def _version_exchange(client, options) -> QuicStreamEvent:
+    datagram = pdu.Datagram(
+        mtype=pdu.MSG_TYPE_VERSION_EXCHANGE,
+        payload=pdu.encode_options(options),
+        protocol_ver=ClientVer.protocol,
+        firmware_ver="0.0.0",
+    )
+    return QuicStreamEvent(client.new_stream(), datagram.to_bytes(), False)
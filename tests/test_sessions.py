@@ -0,0 +1,97 @@
+import asyncio
+import json
+import threading
+import time
+
+from server.sessions import SNAPSHOT_VERSION, DeviceSession, SessionRegistry
+
+TOKENS = ["rsu-1", 'quoted "id", with commas', "line\nbreak", "ünïcode", ""]
+
+
+def test_snapshot_restores_unexpired_sessions(tmp_path):
+    path = str(tmp_path / "sessions")
+    registry = SessionRegistry(path=path)
+    for i, token in enumerate(TOKENS):
+        transfer = "datagram-fec" if i % 2 else "stream"
+        session = DeviceSession("a" * 64, "9.0.0", 4096, transfer, i)
+        session.expires = time.time() + 60.5
+        registry.sessions[token] = session
+    expired = DeviceSession("b" * 64, "8.0.0", 1024, "stream", 3)
+    expired.expires = time.time() - 1
+    registry.sessions["expired"] = expired
+    registry.snapshot()
+
+    restored = SessionRegistry(path=path)
+    assert list(restored.sessions) == TOKENS
+    for i, token in enumerate(TOKENS):
+        session = restored.sessions[token]
+        original = registry.sessions[token]
+        assert (session.sha256, session.firmware_ver, session.size) == ("a" * 64, "9.0.0", 4096)
+        assert session.transfer == original.transfer
+        assert session.acked_segment == i
+        assert original.expires <= session.expires <= original.expires + 1
+
+
+def test_unknown_snapshot_format_is_ignored(tmp_path):
+    path = tmp_path / "sessions"
+    path.write_text('["rsu-1", "aa", "9.0.0", 4096, "stream", 0, 1e12]\n')
+    assert len(SessionRegistry(path=str(path)).sessions) == 0
+
+
+def test_malformed_snapshot_rows_are_skipped(tmp_path):
+    path = tmp_path / "sessions"
+    expires = int(time.time()) + 60
+    image = ["a" * 64, "9.0.0", 4096, "stream"]
+    header = json.dumps({"version": SNAPSHOT_VERSION, "images": [image, ["a" * 64, 1]]})
+    rows = [
+        f"rsu-1,0,2,{expires}",
+        "truncated,0",
+        f"bad-int,0,two,{expires}",
+        f"out-of-range,5,0,{expires}",
+        f"negative,-1,0,{expires}",
+        f"bad-image,1,0,{expires}",
+        f"rsu-2,0,7,{expires}",
+    ]
+    path.write_text(header + "\n" + "\n".join(rows) + "\n")
+
+    registry = SessionRegistry(path=str(path))
+    assert list(registry.sessions) == ["rsu-1", "rsu-2"]
+    assert registry.sessions["rsu-2"].acked_segment == 7
+
+
+def test_damaged_snapshot_header_is_ignored(tmp_path):
+    path = tmp_path / "sessions"
+    path.write_text('{"version": ' + str(SNAPSHOT_VERSION) + ', "ima\nrsu-1,0,0,0\n')
+    assert len(SessionRegistry(path=str(path)).sessions) == 0
+
+
+def test_snapshot_leaves_no_temporary_file(tmp_path):
+    path = tmp_path / "sessions"
+    registry = SessionRegistry(path=str(path))
+    session = DeviceSession("a" * 64, "9.0.0", 4096, "stream", 1)
+    session.expires = time.time() + 60
+    registry.sessions["rsu-1"] = session
+    registry.snapshot()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["sessions"]
+
+
+def test_periodic_snapshot_is_written_off_the_event_loop(tmp_path):
+    path = str(tmp_path / "sessions")
+    registry = SessionRegistry(path=path, snapshot_interval=0.01)
+    writers = []
+    write = registry._write
+
+    def record_thread(entries):
+        writers.append(threading.current_thread())
+        write(entries)
+
+    registry._write = record_thread
+
+    async def main():
+        registry.put("rsu-1", DeviceSession("a" * 64, "9.0.0", 4096, "stream", 2))
+        while not writers:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(main())
+    assert writers[0] is not threading.main_thread()
+    assert SessionRegistry(path=path).sessions["rsu-1"].acked_segment == 2
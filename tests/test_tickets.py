@@ -0,0 +1,61 @@
+import datetime
+import json
+import os
+import pickle
+import stat
+
+from aioquic.tls import CipherSuite, SessionTicket
+
+from common.engine import SessionTicketCache
+
+
+def _ticket(server_name: str = "rsu.example") -> SessionTicket:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return SessionTicket(
+        age_add=12345,
+        cipher_suite=CipherSuite.AES_128_GCM_SHA256,
+        not_valid_after=now + datetime.timedelta(days=1),
+        not_valid_before=now,
+        resumption_secret=os.urandom(32),
+        server_name=server_name,
+        ticket=os.urandom(64),
+        max_early_data_size=0xFFFFFFFF,
+        other_extensions=[(0x2A, b"\x00\x01")],
+    )
+
+
+def test_tickets_survive_a_restart(tmp_path):
+    path = str(tmp_path / "tickets.json")
+    ticket = _ticket()
+    SessionTicketCache(path).add("rsu.example", 4433, ticket)
+
+    assert SessionTicketCache(path).get("rsu.example", 4433) == ticket
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+
+def test_pickled_ticket_files_are_not_loaded(tmp_path):
+    class Exploit:
+        def __reduce__(self):
+            return (os.mkdir, (str(tmp_path / "pwned"),))
+
+    path = tmp_path / "tickets.json"
+    path.write_bytes(pickle.dumps({"rsu.example:4433": Exploit()}))
+
+    assert SessionTicketCache(str(path)).get("rsu.example", 4433) is None
+    assert not (tmp_path / "pwned").exists()
+
+
+def test_malformed_tickets_are_skipped(tmp_path):
+    path = str(tmp_path / "tickets.json")
+    SessionTicketCache(path).add("rsu.example", 4433, _ticket())
+    with open(path) as f:
+        records = json.load(f)
+    records["other:4433"] = dict(records["rsu.example:4433"], ticket="not base64!")
+    records["third:4433"] = {"age_add": "1"}
+    with open(path, "w") as f:
+        json.dump(records, f)
+
+    cache = SessionTicketCache(path)
+    assert cache.get("rsu.example", 4433) is not None
+    assert cache.get("other", 4433) is None
+    assert cache.get("third", 4433) is None